@@ -0,0 +1,32 @@
+from app.allocation.adapters import metrics
+from app.allocation.adapters.redis import Redis
+from app.allocation.constants import ALLOCATIONS_VIEW_CACHE_KEY
+
+CACHE_HITS = metrics.Counter("allocations_view_cache_hits_total", "Reads of /allocations/{sku} served from cache")
+CACHE_MISSES = metrics.Counter("allocations_view_cache_misses_total", "Reads of /allocations/{sku} that hit the DB")
+
+
+class AllocationsViewCache:
+    """Serialized allocations_view rows per sku, invalidated by the worker whenever the view changes.
+
+    The TTL bounds staleness if a read that missed races with an invalidation.
+    """
+
+    def __init__(self, redis: Redis, ttl: int) -> None:
+        self._redis = redis
+        self._ttl = ttl
+
+    async def get(self, sku: str) -> bytes | None:
+        value = await self._redis.get(ALLOCATIONS_VIEW_CACHE_KEY.format(sku=sku))
+        if value is None:
+            CACHE_MISSES.inc()
+        else:
+            CACHE_HITS.inc()
+        return value
+
+    async def set(self, sku: str, value: bytes) -> None:
+        await self._redis.set(ALLOCATIONS_VIEW_CACHE_KEY.format(sku=sku), value, ex=self._ttl)
+
+    async def invalidate(self, *skus: str) -> None:
+        if skus:
+            await self._redis.delete(*(ALLOCATIONS_VIEW_CACHE_KEY.format(sku=sku) for sku in skus))
@@ -0,0 +1,69 @@
+"""Events as the messages published on channels, and the messages the worker consumes as commands and events."""
+from collections.abc import Callable
+from datetime import date
+from typing import Any
+from uuid import UUID
+
+import orjson
+
+from app.allocation.adapters.outbox import Message
+from app.allocation.constants import (
+    BATCH_CHANGED_CHANNEL,
+    BATCH_QUANTITY_CHANGED_CHANNEL,
+    ORDER_ALLOCATED_CHANNEL,
+    ORDER_DEALLOCATED_CHANNEL,
+    ORDERS_REALLOCATED_CHANNEL,
+)
+from app.allocation.domain import commands, events
+
+
+def encode(event: events.Event) -> Message | None:
+    """The message publishing event, None for events that are only handled in process."""
+    if isinstance(event, events.Allocated):
+        data = dict(order_id=str(event.order_id), sku=event.sku, qty=event.qty, batch_id=str(event.batch_id))
+        return Message(ORDER_ALLOCATED_CHANNEL, event.sku, orjson.dumps(data))
+    if isinstance(event, events.Deallocated):
+        data = dict(order_id=str(event.order_id), sku=event.sku, qty=event.qty)
+        return Message(ORDER_DEALLOCATED_CHANNEL, event.sku, orjson.dumps(data))
+    if isinstance(event, events.Reallocated):
+        allocations = [dict(order_id=str(e.order_id), qty=e.qty, batch_id=str(e.batch_id)) for e in event.allocations]
+        data = dict(sku=event.sku, allocations=allocations)
+        return Message(ORDERS_REALLOCATED_CHANNEL, event.sku, orjson.dumps(data))
+    if isinstance(event, events.BatchChanged):
+        data = dict(batch_id=str(event.batch_id), sku=event.sku, qty=event.qty, eta=event.eta)
+        return Message(BATCH_CHANGED_CHANNEL, event.sku, orjson.dumps(data))
+    return None
+
+
+def decode(channel: str, data: bytes) -> commands.Command | events.Event | None:
+    """The command or event a message on channel carries, None for channels nobody handles."""
+    decoder = _DECODERS.get(channel)
+    return None if decoder is None else decoder(orjson.loads(data))
+
+
+def _decode_allocated(data: dict[str, Any]) -> events.Allocated:
+    return events.Allocated(
+        order_id=UUID(data["order_id"]), sku=data["sku"], qty=data["qty"], batch_id=UUID(data["batch_id"])
+    )
+
+
+def _decode_reallocated(data: dict[str, Any]) -> events.Reallocated:
+    return events.Reallocated(
+        sku=data["sku"], allocations=[_decode_allocated(dict(a, sku=data["sku"])) for a in data["allocations"]]
+    )
+
+
+def _decode_batch_changed(data: dict[str, Any]) -> events.BatchChanged:
+    eta = None if data["eta"] is None else date.fromisoformat(data["eta"])
+    return events.BatchChanged(batch_id=UUID(data["batch_id"]), sku=data["sku"], qty=data["qty"], eta=eta)
+
+
+_DECODERS: dict[str, Callable[[dict[str, Any]], commands.Command | events.Event]] = {
+    BATCH_QUANTITY_CHANGED_CHANNEL: lambda data: commands.ChangeBatchQuantity(id=UUID(data["id"]), qty=data["qty"]),
+    ORDER_ALLOCATED_CHANNEL: _decode_allocated,
+    ORDER_DEALLOCATED_CHANNEL: lambda data: events.Deallocated(
+        order_id=UUID(data["order_id"]), sku=data["sku"], qty=data["qty"]
+    ),
+    ORDERS_REALLOCATED_CHANNEL: _decode_reallocated,
+    BATCH_CHANGED_CHANNEL: _decode_batch_changed,
+}
@@ -1,16 +1,53 @@
+import typing
+from collections.abc import AsyncIterator
+from uuid import UUID
+
 import sqlalchemy as sa
 from sqlalchemy.ext.asyncio import AsyncSession
 
-from app.allocation.adapters.dto import Allocation
+from app.allocation.adapters.dto import Allocation, BatchStock
+
+ALLOCATIONS = (
+    "SELECT allocations_view.order_id::text AS order_id, allocations_view.batch_id::text AS batch_id, "
+    'allocations_view.sku, "order".qty FROM allocations_view JOIN "order" '
+    'ON allocations_view.order_id = "order".id WHERE allocations_view.sku = :sku'
+)
+
+STOCK = (
+    "SELECT batch_id::text AS batch_id, eta, qty, allocated, qty - allocated AS available FROM stock_view "
+    "WHERE sku = :sku ORDER BY eta NULLS FIRST, batch_id"
+)
 
 
 async def allocations(sku: str, session: AsyncSession) -> list[Allocation]:
+    result = await session.execute(sa.text(ALLOCATIONS), dict(sku=sku))
+    return [typing.cast(Allocation, dict(row)) for row in result.mappings()]
+
+
+async def allocations_page(sku: str, session: AsyncSession, limit: int, after: UUID = None) -> list[Allocation]:
+    """The first limit allocations of sku by order_id, after the order_id after if given."""
+    query = ALLOCATIONS if after is None else ALLOCATIONS + " AND allocations_view.order_id > :after"
     result = await session.execute(
-        sa.text(
-            "SELECT allocations_view.order_id, allocations_view.batch_id, "
-            'allocations_view.sku, "order".qty FROM allocations_view JOIN "order" '
-            'ON allocations_view.order_id = "order".id WHERE allocations_view.sku = :sku'
-        ),
-        dict(sku=sku),
+        sa.text(query + " ORDER BY allocations_view.order_id LIMIT :limit"),
+        dict(sku=sku, after=after, limit=limit),
     )
-    return [Allocation(**dict(r)) for r in result.fetchall()]
+    return [typing.cast(Allocation, dict(row)) for row in result.mappings()]
+
+
+async def stream_allocations(sku: str, session: AsyncSession, size: int) -> AsyncIterator[list[Allocation]]:
+    """Allocations of sku in lists of up to size rows, read from a server side cursor as they are consumed."""
+    result = await session.stream(sa.text(ALLOCATIONS), dict(sku=sku))
+    rows: list[Allocation] = []
+    async for row in result.mappings():
+        rows.append(typing.cast(Allocation, dict(row)))
+        if len(rows) == size:
+            yield rows
+            rows = []
+    if rows:
+        yield rows
+
+
+async def stock(sku: str, session: AsyncSession) -> list[BatchStock]:
+    """The batches of sku, the ones in stock first then by eta, with what is allocated and still available."""
+    result = await session.execute(sa.text(STOCK), dict(sku=sku))
+    return [typing.cast(BatchStock, dict(row)) for row in result.mappings()]
@@ -1,13 +1,81 @@
+import functools
+import time
 from asyncio import current_task
 from collections.abc import AsyncGenerator
 from contextlib import asynccontextmanager
+from typing import Any
 
-from sqlalchemy.ext.asyncio import AsyncSession, async_scoped_session, create_async_engine
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession, async_scoped_session, create_async_engine
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool
 
+from app.allocation.adapters import instrumentation, metrics
 from app.config import config
 
-ENGINE = create_async_engine(config.PG_DSN, echo=False)
+POOL_CHECKOUTS = metrics.Counter("db_pool_checkouts_total", "Connections checked out of the pool", ("database",))
+POOL_CHECKOUT_WAIT = metrics.Counter(
+    "db_pool_checkout_wait_seconds_total", "Time spent waiting for a pooled connection", ("database",)
+)
+POOL_IN_USE = metrics.Gauge("db_pool_connections_in_use", "Connections currently checked out", ("database",))
+POOL_OVERFLOW = metrics.Gauge(
+    "db_pool_overflow_connections", "Connections open beyond pool_size, negative while the pool fills", ("database",)
+)
+
+
+class InstrumentedAsyncAdaptedQueuePool(AsyncAdaptedQueuePool):
+    """Pool exporting checkout wait and usage, labelled with its pool_logging_name."""
+
+    def __init__(self, *args: Any, **kwargs: Any) -> None:
+        super().__init__(*args, **kwargs)
+        # Pool.recreate passes logging_name on to the new pool
+        self._database = kwargs.get("logging_name")
+
+    def _do_get(self) -> Any:
+        start = time.perf_counter()
+        try:
+            return super()._do_get()  # type: ignore
+        finally:
+            POOL_CHECKOUTS.inc(database=self._database)
+            POOL_CHECKOUT_WAIT.inc(time.perf_counter() - start, database=self._database)
+            self._observe()
+
+    def _do_return_conn(self, conn: Any) -> None:
+        super()._do_return_conn(conn)  # type: ignore
+        self._observe()
+
+    def _observe(self) -> None:
+        POOL_IN_USE.set(self.checkedout(), database=self._database)  # type: ignore
+        POOL_OVERFLOW.set(self.overflow(), database=self._database)  # type: ignore
+
+
+@functools.lru_cache
+def engine(url: str) -> AsyncEngine:
+    """The process wide engine of url, configured from Config. Every session factory shares it."""
+    connect_args = {}
+    if make_url(url).get_driver_name() == "asyncpg":
+        # asyncpg's own cache, and the one of SQLAlchemy's asyncpg adapter
+        connect_args = {
+            "statement_cache_size": config.PG_STATEMENT_CACHE_SIZE,
+            "prepared_statement_cache_size": config.PG_PREPARED_STATEMENT_CACHE_SIZE,
+        }
+    engine = create_async_engine(
+        url,
+        echo=False,
+        poolclass=InstrumentedAsyncAdaptedQueuePool,
+        pool_logging_name=make_url(url).database,
+        pool_size=config.PG_POOL_SIZE,
+        max_overflow=config.PG_MAX_OVERFLOW,
+        pool_timeout=config.PG_POOL_TIMEOUT,
+        pool_recycle=config.PG_POOL_RECYCLE,
+        pool_pre_ping=config.PG_POOL_PRE_PING,
+        connect_args=connect_args,
+    )
+    instrumentation.instrument_engine(engine.sync_engine)
+    return engine
+
+
+ENGINE = engine(config.PG_DSN)
 SESSION_FACTORY = async_scoped_session(
     sessionmaker(autocommit=False, class_=AsyncSession, bind=ENGINE), scopefunc=current_task
 )
@@ -15,7 +83,7 @@ SESSION_FACTORY = async_scoped_session(
 
 class DB:
     def __init__(self, url: str) -> None:
-        self._engine = create_async_engine(url, echo=False)
+        self._engine = engine(url)
         self._session_factory = async_scoped_session(
             sessionmaker(
                 autocommit=False,
@@ -0,0 +1,51 @@
+import asyncio
+import zlib
+from collections.abc import Awaitable, Callable, Coroutine
+from typing import Any
+
+from app.allocation.adapters import metrics
+
+LANE_QUEUE_DEPTH = metrics.Gauge(
+    "allocation_worker_lane_queue_depth", "Calls waiting for a lane of the worker's dispatcher", ("lane",)
+)
+
+Call = tuple[Callable[[], Awaitable[None]], "asyncio.Future[None]"]
+
+
+def spawn(tasks: set["asyncio.Task[None]"], coro: Coroutine[Any, Any, None]) -> "asyncio.Task[None]":
+    """Run coro in a task that tasks holds until it is done, the event loop only keeps weak references to tasks."""
+    task = asyncio.create_task(coro)
+    tasks.add(task)
+    task.add_done_callback(tasks.discard)
+    return task
+
+
+class KeyedDispatcher:
+    """Run calls on a fixed set of lanes by a hash of their key: calls with the same key one at a time in order."""
+
+    def __init__(self, lanes: int, queue_size: int) -> None:
+        self._queues: list[asyncio.Queue[Call]] = [asyncio.Queue(queue_size) for _ in range(lanes)]
+        self._workers: set[asyncio.Task[None]] = set()
+
+    async def submit(self, key: bytes, call: Callable[[], Awaitable[None]]) -> "asyncio.Future[None]":
+        """Queue call and return a future of its outcome, once it is queued."""
+        if not self._workers:
+            for lane, queue in enumerate(self._queues):
+                spawn(self._workers, self._work(lane, queue))
+        lane = zlib.crc32(key) % len(self._queues)
+        queue = self._queues[lane]
+        future: asyncio.Future[None] = asyncio.get_running_loop().create_future()
+        await queue.put((call, future))
+        LANE_QUEUE_DEPTH.set(queue.qsize(), lane=str(lane))
+        return future
+
+    async def _work(self, lane: int, queue: asyncio.Queue[Call]) -> None:
+        while True:
+            call, future = await queue.get()
+            LANE_QUEUE_DEPTH.set(queue.qsize(), lane=str(lane))
+            try:
+                await call()
+            except Exception as e:
+                future.set_exception(e)
+            else:
+                future.set_result(None)
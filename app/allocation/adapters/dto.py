@@ -1,10 +1,28 @@
-from uuid import UUID
+from datetime import date
+from typing import TypedDict
 
 from pydantic import BaseModel
 
 
-class Allocation(BaseModel):
-    order_id: UUID
+class Allocation(TypedDict):
+    """A row of the allocations view, ready to serialize: ids come as text."""
+
+    order_id: str
     sku: str
     qty: int
-    batch_id: UUID
+    batch_id: str
+
+
+class BatchStock(TypedDict):
+    """A row of the stock view, ready to serialize."""
+
+    batch_id: str
+    eta: date | None
+    qty: int
+    allocated: int
+    available: int
+
+
+class OrderLine(BaseModel):
+    sku: str
+    quantity: int
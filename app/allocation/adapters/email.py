@@ -1,6 +1,91 @@
-from typing import Any
+"""Emails to the people running the warehouse, sent over SMTP without blocking the event loop."""
+import asyncio
+import logging
+import smtplib
+from email.message import EmailMessage
 
+from app.allocation.adapters import metrics
+from app.config import config
 
-def send(*args: Any) -> None:
-    """Send an email to the user."""
-    print("Sending email to user", *args)
+logger = logging.getLogger(__name__)
+
+EMAILS_SENT = metrics.Counter("emails_sent_total", "Digest emails sent", ("digest",))
+EMAIL_FAILURES = metrics.Counter("email_failures_total", "Digest emails that could not be sent", ("digest",))
+DIGEST_LINES_DROPPED = metrics.Counter(
+    "email_digest_lines_dropped_total", "Lines dropped because the digest queue was full", ("digest",)
+)
+
+
+async def send(to: str, subject: str, body: str) -> None:
+    message = EmailMessage()
+    message["From"] = config.EMAIL_FROM
+    message["To"] = to
+    message["Subject"] = subject
+    message.set_content(body)
+    # smtplib blocks, it runs in the default executor
+    await asyncio.to_thread(_send, message)
+
+
+def _send(message: EmailMessage) -> None:
+    with smtplib.SMTP(config.SMTP_HOST, config.SMTP_PORT, timeout=config.SMTP_TIMEOUT) as smtp:
+        smtp.send_message(message)
+
+
+class Digest:
+    """Lines emailed to to by a background sender, each line at most once per email.
+
+    add never waits: lines queue up to EMAIL_DIGEST_QUEUE_SIZE, beyond which they are dropped and counted. The
+    sender, started by add when none is running, takes a line, gathers the lines added in the next
+    EMAIL_DIGEST_WINDOW_MS and sends them without duplicates as one email, until nothing is left queued. A failed
+    email is logged and its lines are not retried.
+    """
+
+    def __init__(self, name: str, to: str, subject: str) -> None:
+        self.name = name
+        self._to = to
+        self._subject = subject
+        self._queue: asyncio.Queue[str] = None
+        self._sender: asyncio.Task[None] = None
+
+    def add(self, line: str) -> None:
+        if self._sender is None or self._sender.done():
+            # a queue is bound to the event loop it is first used in
+            self._queue = asyncio.Queue(config.EMAIL_DIGEST_QUEUE_SIZE)
+            self._sender = asyncio.create_task(self._send_digests())
+        try:
+            self._queue.put_nowait(line)
+        except asyncio.QueueFull:
+            DIGEST_LINES_DROPPED.inc(digest=self.name)
+
+    async def join(self) -> None:
+        """Wait until the lines added so far were sent, or failed to be."""
+        if self._queue is not None:
+            await self._queue.join()
+
+    async def _send_digests(self) -> None:
+        loop = asyncio.get_running_loop()
+        # add starts a new sender once this one returned, there is no await between the check and the return
+        while not self._queue.empty():
+            lines = [self._queue.get_nowait()]
+            deadline = loop.time() + config.EMAIL_DIGEST_WINDOW_MS / 1000
+            while (remaining := deadline - loop.time()) > 0:
+                try:
+                    lines.append(await asyncio.wait_for(self._queue.get(), remaining))
+                except asyncio.TimeoutError:
+                    break
+            while not self._queue.empty():
+                lines.append(self._queue.get_nowait())
+            unique = list(dict.fromkeys(lines))
+            try:
+                await send(self._to, self._subject, "\n".join(unique))
+                EMAILS_SENT.inc(digest=self.name)
+            except Exception:
+                EMAIL_FAILURES.inc(digest=self.name)
+                logger.exception("Failed to send the %s digest of %s lines", self.name, len(unique))
+            finally:
+                for _ in lines:
+                    self._queue.task_done()
+
+
+# the skus that ran out of stock, see handlers.notify_out_of_stock
+OUT_OF_STOCK = Digest("out_of_stock", config.OUT_OF_STOCK_EMAIL, "Out of stock")
@@ -0,0 +1,137 @@
+"""Where the hot path spends its time: handlers, unit of work commits, statements and Redis round trips.
+
+Everything here is a no-op when INSTRUMENTATION_ENABLED is off: decorators return the function they decorate,
+tracked is an empty context manager, and neither engine listeners nor the Redis subclass are installed.
+"""
+import functools
+import time
+from collections.abc import Awaitable, Callable, Iterator
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, TypeVar, cast
+
+import sqlalchemy as sa
+from sqlalchemy.engine import Engine
+from starlette.types import ASGIApp, Receive, Scope, Send
+
+from app.allocation.adapters import metrics
+from app.config import config
+
+F = TypeVar("F", bound=Callable[..., Awaitable[Any]])
+
+# a Redis round trip or a statement is well under the 5ms the default buckets start at
+FAST_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100, 200, 500, 1_000)
+
+HANDLER_SECONDS = metrics.Histogram(
+    "allocation_handler_duration_seconds", "Time handling a command, retries included", ("handler",)
+)
+UOW_SECONDS = metrics.Histogram(
+    "allocation_uow_duration_seconds", "Time committing or rolling back a unit of work", ("operation",), FAST_BUCKETS
+)
+QUERIES = metrics.Histogram(
+    "db_queries_per_operation", "Statements executed by a request or a message", ("operation",), COUNT_BUCKETS
+)
+QUERY_SECONDS = metrics.Histogram(
+    "db_query_duration_seconds_per_operation", "Time executing statements for a request or a message", ("operation",)
+)
+REDIS_SECONDS = metrics.Histogram(
+    "redis_command_duration_seconds", "Time of a Redis command or pipeline round trip", ("command",), FAST_BUCKETS
+)
+
+
+class _Queries:
+    __slots__ = ("count", "seconds")
+
+    def __init__(self) -> None:
+        self.count = 0
+        self.seconds = 0.0
+
+
+# the statements of the request or message being handled by the current task
+_QUERIES: ContextVar[_Queries | None] = ContextVar("queries", default=None)
+
+
+def timed(histogram: metrics.Histogram, **labels: str) -> Callable[[F], F]:
+    """Observe how long the decorated coroutine function takes in histogram."""
+
+    def decorator(func: F) -> F:
+        if not config.INSTRUMENTATION_ENABLED:
+            return func
+
+        @functools.wraps(func)
+        async def wrapper(*args: Any, **kwargs: Any) -> Any:
+            start = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                histogram.observe(time.perf_counter() - start, **labels)
+
+        return cast(F, wrapper)
+
+    return decorator
+
+
+def timed_handler(handle: F) -> F:
+    """Observe a Handler's handle in HANDLER_SECONDS, labelled with the class defining it."""
+    return timed(HANDLER_SECONDS, handler=handle.__qualname__.split(".")[0])(handle)
+
+
+@contextmanager
+def tracked(operation: str) -> Iterator[None]:
+    """Count the statements the current task executes inside the block and how long they take, as operation."""
+    if not config.INSTRUMENTATION_ENABLED:
+        yield
+        return
+    queries = _Queries()
+    token = _QUERIES.set(queries)
+    try:
+        yield
+    finally:
+        _QUERIES.reset(token)
+        _observe(queries, operation)
+
+
+def _observe(queries: _Queries, operation: str) -> None:
+    QUERIES.observe(queries.count, operation=operation)
+    QUERY_SECONDS.observe(queries.seconds, operation=operation)
+
+
+def instrument_engine(engine: Engine) -> None:
+    """Time the statements of engine run inside tracked, the sync_engine of an AsyncEngine."""
+    if not config.INSTRUMENTATION_ENABLED:
+        return
+    sa.event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+    sa.event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+
+
+def _before_cursor_execute(conn: Any, *args: Any) -> None:
+    if _QUERIES.get() is not None:
+        conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn: Any, *args: Any) -> None:
+    queries = _QUERIES.get()
+    if queries is not None and conn.info.get("query_start"):
+        queries.count += 1
+        queries.seconds += time.perf_counter() - conn.info["query_start"].pop()
+
+
+class TrackingMiddleware:
+    """Track the statements of every HTTP request, as the name of the endpoint that handled it."""
+
+    def __init__(self, app: ASGIApp) -> None:
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        queries = _Queries()
+        token = _QUERIES.set(queries)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            _QUERIES.reset(token)
+            # the router puts the endpoint it matched in scope
+            _observe(queries, getattr(scope.get("endpoint"), "__name__", "unmatched"))
@@ -1,6 +1,10 @@
+import itertools
+from typing import Any
+
 import sqlalchemy as sa
+from sqlalchemy import event
 from sqlalchemy.dialects.postgresql import UUID
-from sqlalchemy.orm import registry, relationship
+from sqlalchemy.orm import Session, UOWTransaction, registry, relationship
 
 from app.allocation.domain import models
 
@@ -22,6 +26,10 @@ batch_table = sa.Table(
     sa.Column("sku", sa.ForeignKey("product.sku")),
     sa.Column("qty", sa.Integer),
     sa.Column("eta", sa.Date, nullable=True),
+    # sum of the qty of the batch's allocations, kept up to date by _update_allocated_qty
+    sa.Column("allocated_qty", sa.Integer, nullable=False, server_default="0"),
+    # loading a product joins its batches by sku
+    sa.Index("ix_batch_sku", "sku"),
 )
 
 allocation_table = sa.Table(
@@ -30,7 +38,9 @@ allocation_table = sa.Table(
     sa.Column("id", sa.Integer, primary_key=True, autoincrement=True),
     sa.Column("order_id", sa.ForeignKey("order.id")),
     sa.Column("batch_id", sa.ForeignKey("batch.id")),
+    # the unique constraint's index serves lookups by order_id, this one the allocations of a batch
     sa.UniqueConstraint("order_id", "batch_id"),
+    sa.Index("ix_allocation_batch_id", "batch_id"),
 )
 
 product_table = sa.Table(
@@ -48,6 +58,31 @@ allocations_view = sa.Table(
     sa.Column("sku", sa.String(255)),
     sa.Column("batch_id", UUID),
     sa.UniqueConstraint("order_id", "batch_id"),
+    # serves lookups by sku and the keyset pages of GET /allocations/{sku}
+    sa.Index("ix_allocations_view_sku_order_id", "sku", "order_id"),
+)
+
+# one row per batch, what GET /stock/{sku} serves. allocated is the qty of the batch's rows in allocations_view
+stock_view = sa.Table(
+    "stock_view",
+    metadata,
+    sa.Column("batch_id", UUID, primary_key=True),
+    sa.Column("sku", sa.String(255), nullable=False),
+    sa.Column("qty", sa.Integer, nullable=False),
+    sa.Column("eta", sa.Date, nullable=True),
+    sa.Column("allocated", sa.Integer, nullable=False, server_default="0"),
+    sa.Index("ix_stock_view_sku", "sku"),
+)
+
+# events waiting to be published, written in the same transaction as the change that raised them
+outbox_table = sa.Table(
+    "outbox",
+    metadata,
+    sa.Column("id", sa.BigInteger, primary_key=True, autoincrement=True),
+    sa.Column("message_id", UUID(as_uuid=True), nullable=False),
+    sa.Column("channel", sa.String(255), nullable=False),
+    sa.Column("key", sa.String(255), nullable=False),
+    sa.Column("data", sa.LargeBinary, nullable=False),
 )
 
 
@@ -57,6 +92,8 @@ def start_mappers() -> None:
         models.Batch,
         batch_table,
         properties={"allocations": relationship(order_mapper, secondary=allocation_table, collection_class=set)},
+        # maintained in SQL, repositories read it into the batch's running allocated quantity
+        exclude_properties=["allocated_qty"],
     )
     mapper_registry.map_imperatively(
         models.Product,
@@ -64,3 +101,66 @@ def start_mappers() -> None:
         properties={"batches": relationship(batches_mapper)},
         version_id_col=product_table.c.version_number,
     )
+
+    # batches and allocations are (re)populated by the ORM without going through the domain methods,
+    # so the state derived from them has to be rebuilt
+    for identifier in ("load", "refresh", "expire"):
+        event.listen(models.Batch, identifier, _reset_allocated_quantity)
+        event.listen(models.Product, identifier, _reset_batch_queue)
+    # the ORM does not call __init__
+    event.listen(models.Product, "load", _init_events)
+    event.listen(Session, "after_flush", _update_allocated_qty)
+    event.listen(Session, "after_flush", _delete_deallocated_orders)
+
+
+# "expire" is also emitted for instances that were already garbage collected
+def _reset_allocated_quantity(batch: models.Batch, *args: Any) -> None:
+    if batch is not None:
+        batch.reset_allocated_quantity()
+
+
+def _reset_batch_queue(product: models.Product, *args: Any) -> None:
+    if product is not None:
+        product.reset_batch_queue()
+
+
+def _init_events(product: models.Product, *args: Any) -> None:
+    product.events = []
+
+
+def _update_allocated_qty(session: Session, flush_context: UOWTransaction) -> None:
+    """Add the qty of the orders a flush allocated to or deallocated from a batch to its allocated_qty.
+
+    The update is relative, so batches changed by concurrent transactions without a new version of their
+    product, e.g. a deallocation and an allocation to another batch, do not overwrite each other's counts.
+    """
+    deltas = []
+    for obj in itertools.chain(session.new, session.dirty):
+        if isinstance(obj, models.Batch):
+            history = sa.inspect(obj).attrs.allocations.history
+            delta = sum(order.qty for order in history.added) - sum(order.qty for order in history.deleted)
+            if delta:
+                deltas.append({"batch_id": obj.id, "delta": delta})
+    if deltas:
+        session.connection().execute(
+            batch_table.update()
+            .where(batch_table.c.id == sa.bindparam("batch_id"))
+            .values(allocated_qty=batch_table.c.allocated_qty + sa.bindparam("delta")),
+            deltas,
+        )
+
+
+def _delete_deallocated_orders(session: Session, flush_context: UOWTransaction) -> None:
+    """Delete the orders a flush deallocated without allocating them to another batch.
+
+    Like a delete-orphan cascade, which the Orders the in-memory repository shares between batches rule out.
+    """
+    deallocated: set[models.Order] = set()
+    allocated: set[models.Order] = set()
+    for obj in itertools.chain(session.new, session.dirty):
+        if isinstance(obj, models.Batch):
+            history = sa.inspect(obj).attrs.allocations.history
+            deallocated.update(history.deleted)
+            allocated.update(history.added)
+    if orphans := deallocated - allocated:
+        session.connection().execute(order_table.delete().where(order_table.c.id.in_([o.id for o in orphans])))
@@ -0,0 +1,94 @@
+import abc
+import asyncio
+import logging
+from typing import NamedTuple
+from uuid import uuid4
+
+import sqlalchemy as sa
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.allocation.adapters import stream
+from app.allocation.adapters.db import DB
+from app.allocation.adapters.orm import outbox_table
+from app.allocation.adapters.redis import Redis
+from app.config import config
+
+logger = logging.getLogger(__name__)
+
+# held by the relay publishing a batch. One relay at a time keeps messages in outbox order
+RELAY_LOCK_ID = 0x6F7574626F78
+
+
+class Message(NamedTuple):
+    channel: str
+    key: str
+    data: bytes
+
+
+class AbstractOutbox(abc.ABC):
+    @abc.abstractmethod
+    async def add(self, *messages: Message) -> None:
+        raise NotImplementedError
+
+
+class PGOutbox(AbstractOutbox):
+    """Messages are written in the session of the unit of work, so they are only published if it commits."""
+
+    def __init__(self, session: AsyncSession) -> None:
+        self._session = session
+
+    async def add(self, *messages: Message) -> None:
+        if not messages:
+            return
+        await self._session.execute(
+            outbox_table.insert(),
+            [dict(message_id=uuid4(), channel=m.channel, key=m.key, data=m.data) for m in messages],
+        )
+
+
+class InMemoryOutbox(AbstractOutbox):
+    """Messages of a unit of work that are not published yet."""
+
+    def __init__(self) -> None:
+        self.messages: list[Message] = []
+
+    async def add(self, *messages: Message) -> None:
+        self.messages.extend(messages)
+
+
+async def relay(session: AsyncSession, redis: Redis, limit: int) -> int:
+    """Publish up to limit of the oldest outbox messages in one pipeline and delete them.
+
+    Returns 0 without publishing while another relay holds the lock. A crash between publishing and committing
+    publishes the batch again, which consumers dedupe by message id.
+    """
+    lock = sa.func.pg_try_advisory_xact_lock(sa.literal(RELAY_LOCK_ID, sa.BigInteger))
+    if not (await session.execute(sa.select(lock))).scalar():
+        return 0
+    rows = (await session.execute(sa.select(outbox_table).order_by(outbox_table.c.id).limit(limit))).all()
+    if not rows:
+        return 0
+    pipe = redis.pipeline(transaction=False)
+    for row in rows:
+        stream.xadd(pipe, row.channel, row.key, row.data, message_id=str(row.message_id))
+    await pipe.execute()
+    await session.execute(outbox_table.delete().where(outbox_table.c.id.in_([row.id for row in rows])))
+    return len(rows)
+
+
+class OutboxRelay:
+    def __init__(self, db: DB, redis: Redis) -> None:
+        self._db = db
+        self._redis = redis
+
+    async def run(self) -> None:
+        while True:
+            try:
+                async with self._db.session() as session:
+                    relayed = await relay(session, self._redis, config.OUTBOX_RELAY_BATCH_SIZE)
+            except Exception:
+                logger.exception("Failed to relay outbox messages")
+                relayed = 0
+            # keep draining while there is a backlog
+            if relayed < config.OUTBOX_RELAY_BATCH_SIZE:
+                await asyncio.sleep(config.OUTBOX_RELAY_INTERVAL_MS / 1000)
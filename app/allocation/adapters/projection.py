@@ -0,0 +1,139 @@
+import itertools
+import typing
+from collections import defaultdict
+
+import sqlalchemy as sa
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.allocation.adapters import metrics
+from app.allocation.adapters.cache import AllocationsViewCache
+from app.allocation.adapters.db import DB
+from app.allocation.adapters.orm import allocations_view, batch_table, order_table, stock_view
+from app.allocation.domain import events
+
+PROJECTED_EVENTS = metrics.Counter("allocations_view_projected_events_total", "Events applied to allocations_view")
+PROJECTION_FLUSHES = metrics.Counter("allocations_view_projection_flushes_total", "Transactions applying events")
+
+
+class AllocationsViewProjection:
+    """Buffer Allocated/Deallocated/BatchChanged events and apply them to allocations_view and stock_view in one
+    transaction.
+
+    Consecutive events of the same kind become one multi-row statement, and runs are applied in the order the
+    events were buffered, so the events of an order_id keep their order. A batch's allocated quantity in
+    stock_view only moves by the rows the same transaction actually inserted into or deleted from
+    allocations_view, so redelivered events count once.
+    """
+
+    def __init__(self, db: DB, cache: AllocationsViewCache) -> None:
+        self._db = db
+        self._cache = cache
+        self._buffer: list[events.Allocated | events.Deallocated | events.BatchChanged] = []
+
+    def __len__(self) -> int:
+        return len(self._buffer)
+
+    def add(self, event: events.Allocated) -> None:
+        self._buffer.append(event)
+
+    def remove(self, event: events.Deallocated) -> None:
+        self._buffer.append(event)
+
+    def change(self, event: events.BatchChanged) -> None:
+        self._buffer.append(event)
+
+    async def flush(self) -> None:
+        if not self._buffer:
+            return
+        # a failed flush drops the buffer, the stream redelivers the unacknowledged events
+        buffer, self._buffer = self._buffer, []
+        async with self._db.session() as session:
+            for kind, run in itertools.groupby(buffer, key=type):
+                if kind is events.Allocated:
+                    await self._insert(session, typing.cast(list[events.Allocated], list(run)))
+                elif kind is events.Deallocated:
+                    await self._delete(session, typing.cast(list[events.Deallocated], list(run)))
+                else:
+                    await self._upsert_batches(session, typing.cast(list[events.BatchChanged], list(run)))
+        PROJECTION_FLUSHES.inc()
+        PROJECTED_EVENTS.inc(len(buffer))
+        if skus := {e.sku for e in buffer if not isinstance(e, events.BatchChanged)}:
+            await self._cache.invalidate(*skus)
+
+    async def backfill_stock(self) -> None:
+        """Insert the stock_view rows of the batches that have none, e.g. batches created before stock_view existed.
+
+        Their allocated quantity is counted from their rows in allocations_view rather than taken from
+        batch.allocated_qty, so that the Allocated and Deallocated events still waiting in the stream move it
+        like they would move the quantity of any other batch.
+        """
+        allocated = (
+            sa.select(sa.func.coalesce(sa.func.sum(order_table.c.qty), 0))
+            .select_from(allocations_view.join(order_table, order_table.c.id == allocations_view.c.order_id))
+            .where(allocations_view.c.batch_id == batch_table.c.id)
+            .scalar_subquery()
+        )
+        async with self._db.session() as session:
+            await session.execute(
+                insert(stock_view)
+                .from_select(
+                    ["batch_id", "sku", "qty", "eta", "allocated"],
+                    sa.select(batch_table.c.id, batch_table.c.sku, batch_table.c.qty, batch_table.c.eta, allocated),
+                )
+                .on_conflict_do_nothing()
+            )
+
+    async def _insert(self, session: AsyncSession, allocated: list[events.Allocated]) -> None:
+        # allocations_view keeps its ids as strings
+        by_row = {(str(e.order_id), str(e.batch_id)): e for e in allocated}
+        result = await session.execute(
+            insert(allocations_view)
+            .values(
+                [dict(order_id=order_id, sku=e.sku, batch_id=batch_id) for (order_id, batch_id), e in by_row.items()]
+            )
+            .on_conflict_do_nothing()
+            .returning(allocations_view.c.order_id, allocations_view.c.batch_id)
+        )
+        await self._add_allocated(
+            session, [(batch_id, by_row[order_id, batch_id].qty) for order_id, batch_id in result]
+        )
+
+    async def _delete(self, session: AsyncSession, deallocated: list[events.Deallocated]) -> None:
+        qty = {str(e.order_id): e.qty for e in deallocated}
+        result = await session.execute(
+            allocations_view.delete()
+            .where(
+                sa.tuple_(allocations_view.c.order_id, allocations_view.c.sku).in_(
+                    [(str(e.order_id), e.sku) for e in deallocated]
+                )
+            )
+            .returning(allocations_view.c.order_id, allocations_view.c.batch_id)
+        )
+        await self._add_allocated(session, [(batch_id, -qty[order_id]) for order_id, batch_id in result])
+
+    async def _add_allocated(self, session: AsyncSession, deltas: list[tuple[str, int]]) -> None:
+        by_batch: dict[str, int] = defaultdict(int)
+        for batch_id, delta in deltas:
+            by_batch[batch_id] += delta
+        if not by_batch:
+            return
+        await session.execute(
+            stock_view.update()
+            .where(stock_view.c.batch_id == sa.bindparam("b_batch_id"))
+            .values(allocated=stock_view.c.allocated + sa.bindparam("delta")),
+            [dict(b_batch_id=batch_id, delta=delta) for batch_id, delta in by_batch.items()],
+        )
+
+    async def _upsert_batches(self, session: AsyncSession, changed: list[events.BatchChanged]) -> None:
+        # a statement can only update a row once: the last change of a batch wins
+        latest = {e.batch_id: e for e in changed}
+        statement = insert(stock_view).values(
+            [dict(batch_id=str(e.batch_id), sku=e.sku, qty=e.qty, eta=e.eta) for e in latest.values()]
+        )
+        await session.execute(
+            statement.on_conflict_do_update(
+                index_elements=[stock_view.c.batch_id],
+                set_=dict(qty=statement.excluded.qty, eta=statement.excluded.eta),
+            )
+        )
@@ -1,18 +1,48 @@
 # types-redis의 Generic 타입 이슈로 인해 아래와 같이 사용
 # https://github.com/python/typeshed/issues/8242
 
-from typing import TYPE_CHECKING
+import time
+from typing import TYPE_CHECKING, Any
 
+from redis.asyncio.client import Pipeline as Pipeline_
 from redis.asyncio.client import Redis as Redis_
 
+from app.allocation.adapters.instrumentation import REDIS_SECONDS
 from app.config import config
 
 if TYPE_CHECKING:
     Redis = Redis_[bytes]
+    Pipeline = Pipeline_[bytes]
 else:
     Redis = Redis_
+    Pipeline = Pipeline_
 
 
-__all__ = ["Redis"]
+__all__ = ["Redis", "Pipeline"]
 
-redis = Redis.from_url(config.REDIS_DSN)
+
+class InstrumentedRedis(Redis):
+    """Client observing the round trip of every command, and of every pipeline it creates, in REDIS_SECONDS."""
+
+    async def execute_command(self, *args: Any, **options: Any) -> Any:
+        start = time.perf_counter()
+        try:
+            return await super().execute_command(*args, **options)  # type: ignore
+        finally:
+            REDIS_SECONDS.observe(time.perf_counter() - start, command=str(args[0]).upper())
+
+    def pipeline(self, transaction: bool = True, shard_hint: str | None = None) -> Pipeline:
+        return InstrumentedPipeline(self.connection_pool, self.response_callbacks, transaction, shard_hint)
+
+
+class InstrumentedPipeline(Pipeline):
+    async def execute(self, raise_on_error: bool = True) -> list[Any]:
+        start = time.perf_counter()
+        try:
+            return await super().execute(raise_on_error)
+        finally:
+            REDIS_SECONDS.observe(time.perf_counter() - start, command="PIPELINE")
+
+
+client_class: type[Redis] = InstrumentedRedis if config.INSTRUMENTATION_ENABLED else Redis
+redis = client_class.from_url(config.REDIS_DSN)
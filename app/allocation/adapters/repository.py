@@ -1,54 +1,319 @@
 import abc
+from collections import OrderedDict
+from collections.abc import Collection
+from datetime import date
 from uuid import UUID
 
 import sqlalchemy as sa
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy.orm import selectinload, subqueryload
+from sqlalchemy.orm.attributes import set_committed_value
 
+from app.allocation.adapters.orm import allocation_table, batch_table, order_table, product_table
+from app.allocation.adapters.outbox import Message
 from app.allocation.domain import models
+from app.config import config
 
 
 class AbstractProductRepository(abc.ABC):
-    @abc.abstractmethod
+    def __init__(self) -> None:
+        # products added or handed out, whose events the unit of work collects when it commits
+        self.seen: set[models.Product] = set()
+
     async def add(self, product: models.Product) -> None:
+        await self._add(product)
+        self.seen.add(product)
+
+    async def get(self, sku: str, allocating: Collection[models.Order] = ()) -> models.Product:
+        """The product of sku, None if there is none.
+
+        Orders of allocating that are already allocated to one of its batches are loaded into the batch's
+        allocations, so that allocating them again does nothing, as if every allocation had been loaded.
+        """
+        product = self._seen(await self._get(sku))
+        if product is not None and allocating:
+            await self._load_allocated(product, allocating)
+        return product
+
+    async def get_by_batch_id(self, batch_id: UUID) -> models.Product:
+        return self._seen(await self._get_by_batch_id(batch_id))
+
+    def _seen(self, product: models.Product | None) -> models.Product:
+        if product is not None:
+            self.seen.add(product)
+        return product
+
+    @abc.abstractmethod
+    async def _add(self, product: models.Product) -> None:
         raise NotImplementedError
 
     @abc.abstractmethod
-    async def get(self, sku: str) -> models.Product:
+    async def _get(self, sku: str) -> models.Product:
         raise NotImplementedError
 
     @abc.abstractmethod
-    async def get_by_batch_id(self, batch_id: UUID) -> models.Product:
+    async def _get_by_batch_id(self, batch_id: UUID) -> models.Product:
         raise NotImplementedError
 
+    async def _load_allocated(self, product: models.Product, orders: Collection[models.Order]) -> None:
+        # nothing to do for repositories whose batches come with all their allocations
+        pass
+
+
+class BatchSkuCache:
+    """The sku of the batches most recently looked up by id, at most maxsize of them, none if it is 0.
+
+    A batch never moves to another product, so an entry never goes stale, it is only evicted.
+    """
+
+    def __init__(self, maxsize: int) -> None:
+        self._maxsize = maxsize
+        self._skus: OrderedDict[UUID, str] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._skus)
+
+    def get(self, batch_id: UUID) -> str | None:
+        sku = self._skus.get(batch_id)
+        if sku is not None:
+            self._skus.move_to_end(batch_id)
+        return sku
+
+    def put(self, batch_id: UUID, sku: str) -> None:
+        if self._maxsize <= 0:
+            return
+        self._skus[batch_id] = sku
+        self._skus.move_to_end(batch_id)
+        if len(self._skus) > self._maxsize:
+            self._skus.popitem(last=False)
+
+    def discard(self, batch_id: UUID) -> None:
+        self._skus.pop(batch_id, None)
+
+
+# shared by the repositories of a process
+BATCH_SKUS = BatchSkuCache(config.BATCH_SKU_CACHE_SIZE)
+
 
 class PGProductRepository(AbstractProductRepository):
-    def __init__(self, session: AsyncSession) -> None:
+    """Products are loaded with their batches and each batch's allocated quantity in one query.
+
+    Batches come without their allocations, which only deallocation needs: the allocations collection is set
+    to an empty, loaded set that new allocations are added to, and the batch's running allocated quantity is
+    set from its allocated_qty column, which every flush keeps up to date (see orm.py). get_by_batch_id also
+    loads the allocations of the batch it was asked for, and get those of the orders it is about to allocate.
+
+    get_by_batch_id looks the sku of a batch up in batch_skus first and then loads the product like get does.
+    Otherwise it finds the sku through the primary key of batch in the same query, and remembers it.
+    """
+
+    def __init__(self, session: AsyncSession, batch_skus: BatchSkuCache = BATCH_SKUS) -> None:
         super().__init__()
         self._session = session
+        self._batch_skus = batch_skus
 
-    async def add(self, product: models.Product) -> None:
+    async def _add(self, product: models.Product) -> None:
         self._session.add(product)
         await self._session.flush()
 
-    async def get(self, sku: str) -> models.Product:
-        # async sqlalchemy doesn't support relationship
-        # It raise 'greenlet_spawn has not been called; can't call await_() here. Was IO attempted in an unexpected place?' # noqa E501
+    async def _get(self, sku: str) -> models.Product:
+        return await self._load(product_table.c.sku == sku)
+
+    async def _get_by_batch_id(self, batch_id: UUID) -> models.Product:
+        sku = self._batch_skus.get(batch_id)
+        product = None if sku is None else await self._get(sku)
+        batch = self._batch(product, batch_id)
+        if batch is None:
+            # not remembered, or remembered from a transaction that was rolled back
+            self._batch_skus.discard(batch_id)
+            subquery = sa.select(batch_table.c.sku).where(batch_table.c.id == batch_id).scalar_subquery()
+            product = await self._load(product_table.c.sku == subquery)
+            batch = self._batch(product, batch_id)
+            if batch is None:
+                return None
+            self._batch_skus.put(batch_id, product.sku)
+        await self._load_allocations(batch)
+        return product
+
+    @staticmethod
+    def _batch(product: models.Product | None, batch_id: UUID) -> models.Batch | None:
+        return None if product is None else next((b for b in product.batches if b.id == batch_id), None)
+
+    async def _load(self, where: sa.sql.ColumnElement[sa.Boolean]) -> models.Product:
         result = await self._session.execute(
-            sa.select(models.Product)
-            .where(models.Product.sku == sku)
-            .options(
-                selectinload(models.Product.batches).options(selectinload(models.Batch.allocations))
-            )
+            sa.select(models.Product, models.Batch, batch_table.c.allocated_qty)
+            .select_from(product_table)
+            .outerjoin(batch_table, batch_table.c.sku == product_table.c.sku)
+            .where(where)
+            .order_by(batch_table.c.eta.nulls_first(), batch_table.c.id)
         )
-        return result.scalar_one_or_none()
+        rows = result.all()
+        if not rows:
+            return None
+        product = rows[0][0]
+        # like any ORM load, state that is already loaded in this session is left alone
+        if "batches" in sa.inspect(product).unloaded:
+            batches = [batch for _, batch, _ in rows if batch is not None]
+            set_committed_value(product, "batches", batches)
+        for _, batch, allocated_quantity in rows:
+            if batch is None:
+                continue
+            if "allocations" in sa.inspect(batch).unloaded:
+                set_committed_value(batch, "allocations", set())
+            # the query autoflushed, so the column is up to date even if the batch was expired or refreshed since
+            # its allocations were loaded, which resets the running quantity
+            batch._allocated_quantity = allocated_quantity
+        return product
 
-    async def get_by_batch_id(self, batch_id: UUID) -> models.Product:
+    async def _load_allocated(self, product: models.Product, orders: Collection[models.Order]) -> None:
         result = await self._session.execute(
-            sa.select(models.Product)
-            .where(models.Product.batches.any(models.Batch.id == batch_id))  # type: ignore
-            .options(
-                subqueryload(models.Product.batches).options(subqueryload(models.Batch.allocations))
-            )
+            sa.select(models.Order, allocation_table.c.batch_id)
+            .join(allocation_table, allocation_table.c.order_id == order_table.c.id)
+            .where(order_table.c.id.in_([order.id for order in orders]))
         )
-        return result.scalar_one_or_none()
+        batches = {batch.id: batch for batch in product.batches}
+        for order, batch_id in result.all():
+            batch = batches.get(batch_id)
+            if batch is not None and order not in batch.allocations:
+                allocated_quantity = batch.allocated_quantity
+                set_committed_value(batch, "allocations", batch.allocations | {order})
+                batch._allocated_quantity = allocated_quantity
+
+    async def _load_allocations(self, batch: models.Batch) -> None:
+        if sum(order.qty for order in batch.allocations) == batch.allocated_quantity:
+            return
+        result = await self._session.execute(
+            sa.select(models.Order)
+            .join(allocation_table, allocation_table.c.order_id == order_table.c.id)
+            .where(allocation_table.c.batch_id == batch.id)
+        )
+        set_committed_value(batch, "allocations", set(result.scalars()))
+        batch.reset_allocated_quantity()
+
+
+class StaleProduct(Exception):
+    pass
+
+
+class InMemoryDatabase:
+    """Committed products indexed by sku and by batch id, and published outbox messages.
+
+    Shared by the InMemoryUnitOfWorks of a simulation or a test like they would share Postgres.
+    """
+
+    def __init__(self) -> None:
+        self.products: dict[str, models.Product] = {}
+        self.sku_by_batch_id: dict[UUID, str] = {}
+        self.messages: list[Message] = []
+
+
+# a batch as its unit of work loaded it: qty, eta and the allocations it was given
+BatchState = tuple[int, date, frozenset[models.Order]]
+
+
+class InMemoryProductRepository(AbstractProductRepository):
+    """Products of an InMemoryDatabase, copied for one unit of work and written back by save.
+
+    Like PGProductRepository, batches come without their allocations but with their allocated quantity, except
+    the batch get_by_batch_id was asked for. A product is copied once, later gets return the same copy.
+    """
+
+    def __init__(self, db: InMemoryDatabase) -> None:
+        super().__init__()
+        self._db = db
+        self._products: dict[str, models.Product] = {}
+        # what was loaded, to tell what changed since. New products have no version and their batches no state
+        self._versions: dict[str, int] = {}
+        self._batches: dict[UUID, BatchState] = {}
+
+    async def _add(self, product: models.Product) -> None:
+        self._products[product.sku] = product
+
+    async def _get(self, sku: str) -> models.Product:
+        product = self._products.get(sku)
+        if product is None and sku in self._db.products:
+            product = self._products[sku] = self._copy(self._db.products[sku])
+        return product
+
+    async def _get_by_batch_id(self, batch_id: UUID) -> models.Product:
+        product = await self._get(self._db.sku_by_batch_id.get(batch_id))
+        if product is not None and batch_id in self._batches:
+            self._load_allocations(next(b for b in product.batches if b.id == batch_id))
+        return product
+
+    def _copy(self, stored: models.Product) -> models.Product:
+        self._versions[stored.sku] = stored.version_number
+        batches = []
+        for b in stored.batches:
+            batch = models.Batch(id=b.id, sku=b.sku, eta=b.eta, qty=b.qty, allocations=set())
+            batch._allocated_quantity = b.allocated_quantity
+            self._batches[b.id] = (b.qty, b.eta, frozenset())
+            batches.append(batch)
+        return models.Product(sku=stored.sku, batches=batches, version_number=stored.version_number)
+
+    async def _load_allocated(self, product: models.Product, orders: Collection[models.Order]) -> None:
+        for stored in self._db.products[product.sku].batches:
+            allocated = stored.allocations.intersection(orders)
+            if not allocated or stored.id not in self._batches:
+                continue
+            batch = next(b for b in product.batches if b.id == stored.id)
+            qty, eta, loaded = self._batches[batch.id]
+            self._batches[batch.id] = (qty, eta, loaded | allocated)
+            allocated_quantity = batch.allocated_quantity
+            batch.allocations |= allocated - loaded
+            batch._allocated_quantity = allocated_quantity
+
+    def _load_allocations(self, batch: models.Batch) -> None:
+        qty, eta, loaded = self._batches[batch.id]
+        if sum(order.qty for order in batch.allocations) == batch.allocated_quantity:
+            return
+        stored = next(b for b in self._db.products[batch.sku].batches if b.id == batch.id)
+        self._batches[batch.id] = (qty, eta, frozenset(stored.allocations))
+        batch.allocations |= stored.allocations
+        batch.reset_allocated_quantity()
+
+    def save(self) -> None:
+        """Write the products added or changed since they were loaded to the database, all of them or none.
+
+        Raises StaleProduct if another unit of work saved the sku of a new product, or a new version of a product
+        whose version_number changed. Like the ORM, only a change of version_number is checked, the other changes
+        are written batch by batch, and a saved product's version_number is one more than the loaded one.
+        """
+        products = []
+        for sku, product in self._products.items():
+            stored = self._db.products.get(sku)
+            version = self._versions.get(sku)
+            if version is None and stored is not None:
+                raise StaleProduct(f"Product {sku} was added concurrently")
+            if version is not None and product.version_number != version and stored.version_number != version:
+                raise StaleProduct(f"Product {sku} was changed concurrently")
+            products.append((product, stored, version))
+        for product, stored, version in products:
+            if stored is None:
+                stored = self._db.products[product.sku] = models.Product(sku=product.sku, batches=[])
+            if version is None or product.version_number != version:
+                product.version_number = stored.version_number = (version or 0) + 1
+            self._versions[product.sku] = product.version_number
+            for batch in product.batches:
+                self._save_batch(stored, batch)
+
+    def _save_batch(self, product: models.Product, batch: models.Batch) -> None:
+        loaded = self._batches.get(batch.id)
+        # most batches of a product are left alone, compared without building their state
+        if loaded is not None and loaded[0] == batch.qty and loaded[1] == batch.eta and loaded[2] == batch.allocations:
+            return
+        state = self._batches[batch.id] = (batch.qty, batch.eta, frozenset(batch.allocations))
+        if loaded is None:
+            product.batches.append(
+                models.Batch(
+                    id=batch.id, sku=batch.sku, eta=batch.eta, qty=batch.qty, allocations=set(batch.allocations)
+                )
+            )
+            self._db.sku_by_batch_id[batch.id] = batch.sku
+            return
+        stored = next(b for b in product.batches if b.id == batch.id)
+        removed, added = loaded[2] - state[2], state[2] - loaded[2]
+        allocated_quantity = stored.allocated_quantity - sum(o.qty for o in removed) + sum(o.qty for o in added)
+        stored.qty, stored.eta = batch.qty, batch.eta
+        stored.allocations -= removed
+        stored.allocations |= added
+        stored._allocated_quantity = allocated_quantity
@@ -0,0 +1,309 @@
+import asyncio
+import functools
+import logging
+import time
+import zlib
+from collections.abc import Awaitable, Callable
+from typing import Any
+
+from redis.exceptions import ResponseError
+
+from app.allocation.adapters import metrics
+from app.allocation.adapters.dispatcher import KeyedDispatcher
+from app.allocation.adapters.redis import Pipeline, Redis
+from app.allocation.constants import ALLOCATION_STREAM, HANDLED_MESSAGE_KEY
+from app.config import config
+
+logger = logging.getLogger(__name__)
+
+# (channel, data) of a stream entry
+MessageHandler = Callable[[str, bytes], Awaitable[None]]
+Entry = tuple[bytes, dict[bytes, bytes]]
+
+
+class _KeyFailed(Exception):
+    pass
+
+
+DEAD_LETTERS = metrics.Counter(
+    "allocation_stream_dead_letters_total",
+    "Messages moved to the dead letter stream after STREAM_MAX_DELIVERIES deliveries",
+    ("stream",),
+)
+CONSUMER_LAG = metrics.Gauge(
+    "allocation_stream_consumer_lag_seconds",
+    "Age of the last message acknowledged by the consumer of a stream partition, 0 once it is caught up",
+    ("stream",),
+)
+
+
+def partition(key: str, partitions: int = None) -> int:
+    return zlib.crc32(key.encode()) % (partitions or config.STREAM_PARTITIONS)
+
+
+def stream_name(stream: str, partition: int) -> str:
+    return f"{stream}:{partition}"
+
+
+def xadd(
+    client: Redis | Pipeline,
+    channel: str,
+    key: str,
+    data: bytes,
+    stream: str = ALLOCATION_STREAM,
+    partitions: int = None,
+    message_id: str = None,
+) -> Any:
+    """Append a message to the stream partition of key. Messages with the same key are consumed in order.
+
+    Messages with a message_id are handled at most once per consumer group, even if they are published twice.
+    Returns an awaitable for Redis, and the pipeline itself for Pipeline.
+    """
+    fields = {"channel": channel, "key": key, "data": data}
+    if message_id is not None:
+        fields["message_id"] = message_id
+    # not capped: consumers trim what their group has acknowledged, see StreamConsumer
+    return client.xadd(stream_name(stream, partition(key, partitions)), fields)
+
+
+class StreamConsumer:
+    """Consume one partition of a stream as a member of a consumer group, in publish order per key.
+
+    Messages are acknowledged once handled and flushed, failed ones are claimed again and dead lettered after
+    STREAM_MAX_DELIVERIES deliveries.
+    """
+
+    def __init__(
+        self,
+        redis: Redis,
+        group: str,
+        stream: str,
+        partition: int,
+        handler: MessageHandler,
+        flush: Callable[[], Awaitable[None]] = None,
+        dispatcher: KeyedDispatcher = None,
+    ) -> None:
+        self._redis = redis
+        self._group = group
+        self._stream = stream_name(stream, partition)
+        self._dead_letters = f"{self._stream}:dead"
+        # stable per partition, so a restarted worker picks up its own pending messages straight away
+        self._consumer = f"consumer-{partition}"
+        self._handler = handler
+        self._flush = flush
+        self._dispatcher = dispatcher
+        # id of the last new message read, everything before it was delivered to the group
+        self._last_delivered: bytes = None
+
+    async def run(self) -> None:
+        await self._create_group()
+        # our pending messages, read once each: the ones still failing are claimed again later
+        pending_id = b"0"
+        while entries := await self._read(pending_id):
+            await self._process(entries)
+            pending_id = entries[-1][0]
+        loop = asyncio.get_running_loop()
+        claimed_at = loop.time()
+        while True:
+            if loop.time() - claimed_at > config.STREAM_CLAIM_MIN_IDLE_MS / 1000:
+                await self._process(await self._claim())
+                await self._trim()
+                claimed_at = loop.time()
+            entries = await self._read_batch()
+            if not entries:
+                CONSUMER_LAG.set(0, stream=self._stream)
+            await self._process(entries)
+
+    async def _create_group(self) -> None:
+        try:
+            await self._redis.xgroup_create(self._stream, self._group, id="0", mkstream=True)
+        except ResponseError as e:
+            if "BUSYGROUP" not in str(e):
+                raise
+
+    async def _read_batch(self) -> list[Entry]:
+        entries = await self._read(">", block=config.STREAM_BLOCK_MS)
+        if entries:
+            self._last_delivered = entries[-1][0]
+        if self._flush is None or not entries:
+            return entries
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + config.STREAM_BATCH_LINGER_MS / 1000
+        while len(entries) < config.STREAM_READ_COUNT and (remaining := deadline - loop.time()) > 0:
+            more = await self._read(
+                ">", count=config.STREAM_READ_COUNT - len(entries), block=max(1, int(remaining * 1000))
+            )
+            if not more:
+                break
+            entries += more
+            self._last_delivered = entries[-1][0]
+        return entries
+
+    async def _read(self, id: bytes | str, count: int = None, block: int = None) -> list[Entry]:
+        try:
+            response = await self._redis.xreadgroup(
+                self._group,
+                self._consumer,
+                {self._stream: id},
+                count=count or config.STREAM_READ_COUNT,
+                block=block,
+            )
+        except ResponseError as e:
+            # the stream or the group was deleted under us
+            if "NOGROUP" not in str(e):
+                raise
+            await self._create_group()
+            return []
+        return [entry for _, entries in response for entry in entries]
+
+    async def _claim(self) -> list[Entry]:
+        try:
+            _, entries, *_ = await self._redis.xautoclaim(
+                self._stream,
+                self._group,
+                self._consumer,
+                min_idle_time=config.STREAM_CLAIM_MIN_IDLE_MS,
+                count=config.STREAM_READ_COUNT,
+            )
+        except ResponseError as e:
+            if "NOGROUP" not in str(e):
+                raise
+            return []
+        if not entries:
+            return entries
+        # our own recently failed messages may sit between the claimed ones
+        pending = await self._redis.xpending_range(
+            self._stream,
+            self._group,
+            entries[0][0],
+            entries[-1][0],
+            len(entries) + config.STREAM_READ_COUNT,
+            consumername=self._consumer,
+        )
+        deliveries = {p["message_id"]: p["times_delivered"] for p in pending}
+        # the messages behind a failing one of their key were delivered as often: only the first is dead lettered
+        dead, live, keys = [], [], set()
+        for entry in entries:
+            key = entry[1].get(b"key")
+            if deliveries.get(entry[0], 0) > config.STREAM_MAX_DELIVERIES and key not in keys:
+                dead.append(entry)
+            else:
+                live.append(entry)
+            keys.add(key)
+        if dead:
+            await self._dead_letter(dead)
+        return live
+
+    async def _dead_letter(self, entries: list[Entry]) -> None:
+        pipe = self._redis.pipeline(transaction=True)
+        for entry_id, fields in entries:
+            # fields are empty for messages that were trimmed from the stream, there is nothing to keep
+            if fields:
+                pipe.xadd(self._dead_letters, {**fields, b"entry_id": entry_id})
+        pipe.xack(self._stream, self._group, *(entry_id for entry_id, _ in entries))
+        await pipe.execute()
+        DEAD_LETTERS.inc(len(entries), stream=self._stream)
+        logger.error(
+            "Moved %s messages of %s delivered more than %s times to %s",
+            len(entries),
+            self._stream,
+            config.STREAM_MAX_DELIVERIES,
+            self._dead_letters,
+        )
+
+    async def _trim(self) -> None:
+        # producers do not cap the stream, this assumes the group is the partition's only reader
+        [oldest] = await self._redis.xpending_range(self._stream, self._group, "-", "+", 1) or [None]
+        min_id = self._last_delivered if oldest is None else oldest["message_id"]
+        if min_id is not None:
+            # entries before min_id were acknowledged by the group
+            await self._redis.xtrim(self._stream, minid=min_id, approximate=False)
+
+    async def _process(self, entries: list[Entry]) -> None:
+        if not entries:
+            return
+        # fields are empty for pending messages that were trimmed from the stream
+        keys = [self._handled_key(fields[b"message_id"]) if b"message_id" in fields else None for _, fields in entries]
+        pipe = self._redis.pipeline(transaction=False)
+        for key in keys:
+            if key is not None:
+                pipe.exists(key)
+        exists = await pipe.execute()
+        seen = {key for key in keys if key is not None and exists.pop(0)}
+        # a message published twice in this batch shares the outcome of its first delivery
+        dispatched: dict[str, asyncio.Future[None]] = {}
+        # the last message dispatched with each key it was published with
+        last: dict[bytes, asyncio.Future[None]] = {}
+        outcomes: list[asyncio.Future[None] | None] = []
+        for (_, fields), key in zip(entries, keys):
+            if not fields or key is not None and key in seen:
+                outcomes.append(None)
+            elif key is not None and key in dispatched:
+                outcomes.append(dispatched[key])
+            else:
+                ordering_key = fields.get(b"key", b"")
+                outcome = await self._dispatch(fields, after=last.get(ordering_key))
+                last[ordering_key] = outcome
+                if key is not None:
+                    dispatched[key] = outcome
+                outcomes.append(outcome)
+        if pending := {outcome for outcome in outcomes if outcome is not None and not outcome.done()}:
+            await asyncio.wait(pending)
+        handled = []
+        handled_keys = []
+        for (entry_id, _), key, outcome in zip(entries, keys, outcomes):
+            if outcome is not None:
+                if isinstance(outcome.exception(), _KeyFailed):
+                    logger.warning("Skipped %s %s behind a failed message of its key", self._stream, entry_id)
+                    continue
+                if outcome.exception() is not None:
+                    logger.error(
+                        "Failed to handle %s %s, leaving it pending",
+                        self._stream,
+                        entry_id,
+                        exc_info=outcome.exception(),
+                    )
+                    continue
+                if key is not None:
+                    handled_keys.append(key)
+            handled.append(entry_id)
+        if self._flush is not None:
+            try:
+                await self._flush()
+            except Exception:
+                logger.exception("Failed to flush %s, leaving %s messages pending", self._stream, len(handled))
+                return
+        if handled:
+            # remembered with the acknowledgement, a message whose flush failed is handled again when redelivered
+            for key in handled_keys:
+                pipe.set(key, 1, ex=config.STREAM_DEDUPE_TTL)
+            pipe.xack(self._stream, self._group, *handled)
+            await pipe.execute()
+            # entry ids start with the publish time in milliseconds
+            published = int(handled[-1].split(b"-")[0]) / 1000
+            CONSUMER_LAG.set(max(0.0, time.time() - published), stream=self._stream)
+
+    async def _dispatch(
+        self, fields: dict[bytes, bytes], after: "asyncio.Future[None] | None"
+    ) -> "asyncio.Future[None]":
+        handle = functools.partial(self._handler, fields[b"channel"].decode(), fields[b"data"])
+
+        # after is done by the time call runs, messages with the same key are handled one at a time
+        async def call() -> None:
+            if after is not None and after.exception() is not None:
+                raise _KeyFailed()
+            await handle()
+
+        if self._dispatcher is not None:
+            return await self._dispatcher.submit(fields.get(b"key", b""), call)
+        outcome: asyncio.Future[None] = asyncio.get_running_loop().create_future()
+        try:
+            await call()
+        except Exception as e:
+            outcome.set_exception(e)
+        else:
+            outcome.set_result(None)
+        return outcome
+
+    def _handled_key(self, message_id: bytes) -> str:
+        return HANDLED_MESSAGE_KEY.format(group=self._group, message_id=message_id.decode())
@@ -1,3 +1,13 @@
 ORDER_DEALLOCATED_CHANNEL = "allocation:order_deallocated:v1"
 ORDER_ALLOCATED_CHANNEL = "allocation:order_allocated:v1"
+ORDERS_REALLOCATED_CHANNEL = "allocation:orders_reallocated:v1"
 BATCH_QUANTITY_CHANGED_CHANNEL = "allocation:batch_quantity_changed:v1"
+# published by the service, unlike BATCH_QUANTITY_CHANGED_CHANNEL which carries ChangeBatchQuantity commands
+BATCH_CHANGED_CHANNEL = "allocation:batch_changed:v1"
+
+# all channels share one stream per partition, so messages for the same sku are consumed in publish order
+ALLOCATION_STREAM = "allocation:events:v1"
+ALLOCATION_WORKER_GROUP = "allocation:worker"
+HANDLED_MESSAGE_KEY = "allocation:handled:v1:{group}:{message_id}"
+
+ALLOCATIONS_VIEW_CACHE_KEY = "allocation:allocations_view:v1:{sku}"
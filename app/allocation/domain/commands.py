@@ -4,10 +4,10 @@ from uuid import UUID
 
 
 class Command:
-    pass
+    __slots__ = ()
 
 
-@dataclass
+@dataclass(slots=True)
 class CreateBatch(Command):
     id: UUID
     sku: str
@@ -15,14 +15,19 @@ class CreateBatch(Command):
     eta: date = None
 
 
-@dataclass
+@dataclass(slots=True)
 class ChangeBatchQuantity(Command):
     id: UUID
     qty: int
 
 
-@dataclass
+@dataclass(slots=True)
 class Allocate(Command):
     order_id: UUID
     sku: str
     qty: int
+
+
+@dataclass(slots=True)
+class AllocateMany(Command):
+    orders: list[Allocate]
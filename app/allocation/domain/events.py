@@ -1,12 +1,14 @@
 from dataclasses import dataclass
+from datetime import date
 from uuid import UUID
 
 
 class Event:
-    pass
+    # subclasses are slotted dataclasses: no per-instance __dict__
+    __slots__ = ()
 
 
-@dataclass
+@dataclass(slots=True)
 class Allocated(Event):
     order_id: UUID
     sku: str
@@ -14,13 +16,31 @@ class Allocated(Event):
     batch_id: UUID
 
 
-@dataclass
+@dataclass(slots=True)
 class OutOfStock(Event):
     sku: str
 
 
-@dataclass
+@dataclass(slots=True)
 class Deallocated(Event):
     order_id: UUID
     sku: str
     qty: int
+
+
+@dataclass(slots=True)
+class Reallocated(Event):
+    """Orders moved off a batch whose quantity went down, each now allocated to the batch of its Allocated."""
+
+    sku: str
+    allocations: list[Allocated]
+
+
+@dataclass(slots=True)
+class BatchChanged(Event):
+    """A batch was added to its product, or its quantity or eta changed. Carries what the batch is now."""
+
+    batch_id: UUID
+    sku: str
+    qty: int
+    eta: date | None
@@ -1,9 +1,14 @@
 from __future__ import annotations
 
+from bisect import bisect_left, insort
+from collections.abc import Callable, Collection, Iterator
 from dataclasses import dataclass, field
 from datetime import date
+from heapq import heapify, heappop
 from uuid import UUID, uuid4
 
+from app.allocation.domain.events import Allocated, BatchChanged, Deallocated, Event, OutOfStock, Reallocated
+
 
 @dataclass(unsafe_hash=True, kw_only=True)
 class Order:
@@ -19,6 +24,8 @@ class Batch:
     eta: date = None
     qty: int
     allocations: set[Order] = field(default_factory=lambda: set())
+    # running total of allocations' qty. None means "not counted yet" (e.g. right after the ORM loads the batch)
+    _allocated_quantity: int = field(default=None, init=False, repr=False, compare=False)
 
     def __repr__(self) -> str:
         return f"<Batch {self.id}>"
@@ -41,13 +48,27 @@ class Batch:
     def allocate(self, order: Order) -> None:
         if self.can_allocate(order):
             self.allocations.add(order)
+            self._allocated_quantity += order.qty
 
     def deallocate_one(self) -> Order:
-        return self.allocations.pop()
+        allocated_quantity = self.allocated_quantity
+        order = self.allocations.pop()
+        self._allocated_quantity = allocated_quantity - order.qty
+        return order
+
+    def deallocate(self, orders: list[Order]) -> None:
+        allocated_quantity = self.allocated_quantity
+        self.allocations.difference_update(orders)
+        self._allocated_quantity = allocated_quantity - sum(order.qty for order in orders)
 
     @property
     def allocated_quantity(self) -> int:
-        return sum(order.qty for order in self.allocations)
+        if self._allocated_quantity is None:
+            self._allocated_quantity = sum(order.qty for order in self.allocations)
+        return self._allocated_quantity
+
+    def reset_allocated_quantity(self) -> None:
+        self._allocated_quantity = None
 
     @property
     def available_quantity(self) -> int:
@@ -57,29 +78,211 @@ class Batch:
         return self.sku == order.sku and self.available_quantity >= order.qty and order not in self.allocations
 
 
+# chooses the allocations to deallocate to free at least deficit
+DeallocationStrategy = Callable[[Collection[Order], int], list[Order]]
+
+
+def arbitrary(allocations: Collection[Order], deficit: int) -> list[Order]:
+    """Orders in iteration order, as deallocate_one would pop them."""
+    deallocated = []
+    for order in allocations:
+        if deficit <= 0:
+            break
+        deallocated.append(order)
+        deficit -= order.qty
+    return deallocated
+
+
+def largest_first(allocations: Collection[Order], deficit: int) -> list[Order]:
+    """The fewest orders: no k orders free more than the k largest ones."""
+    # ties are broken by position, so orders themselves are never compared
+    heap = [(-order.qty, i, order) for i, order in enumerate(allocations)]
+    heapify(heap)
+    deallocated = []
+    while deficit > 0 and heap:
+        _, _, order = heappop(heap)
+        deallocated.append(order)
+        deficit -= order.qty
+    return deallocated
+
+
+def best_fit(allocations: Collection[Order], deficit: int) -> list[Order]:
+    """As many orders as largest_first, the last being the smallest that covers what is left of the deficit."""
+    orders = sorted(allocations, key=_qty)
+    deallocated = []
+    while deficit > 0 and orders:
+        i = bisect_left(orders, deficit, key=_qty)
+        if i < len(orders):
+            deallocated.append(orders[i])
+            break
+        order = orders.pop()
+        deallocated.append(order)
+        deficit -= order.qty
+    return deallocated
+
+
+def _qty(order: Order) -> int:
+    return order.qty
+
+
+DEALLOCATION_STRATEGIES: dict[str, DeallocationStrategy] = {
+    "arbitrary": arbitrary,
+    "largest_first": largest_first,
+    "best_fit": best_fit,
+}
+
+
+class BatchQueue:
+    """Batches that still have stock, in allocation preference order.
+
+    Warehouse stock (no eta) comes first, then shipments by earliest eta. Ties keep the order in which
+    batches were added, like a stable sort of Product.batches would.
+    """
+
+    def __init__(self, batches: list[Batch]) -> None:
+        self._entries: list[tuple[tuple[bool, date, int], Batch]] = []
+        self._keys: dict[Batch, tuple[bool, date, int]] = {}
+        self._sequence = 0
+        # number of the product's batches this queue knows about, used to detect batches appended behind its back
+        self.tracked = 0
+        for batch in batches:
+            self.add(batch)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __iter__(self) -> Iterator[Batch]:
+        return (batch for _, batch in self._entries)
+
+    def add(self, batch: Batch) -> None:
+        self.tracked += 1
+        self.update(batch)
+
+    def update(self, batch: Batch) -> None:
+        """Re-evaluate whether the batch still has stock to offer."""
+        if batch.available_quantity <= 0:
+            self.discard(batch)
+        elif batch not in self._keys:
+            key = (batch.eta is not None, batch.eta or date.min, self._sequence)
+            self._sequence += 1
+            self._keys[batch] = key
+            insort(self._entries, (key, batch))
+
+    def discard(self, batch: Batch) -> None:
+        key = self._keys.pop(batch, None)
+        if key is not None:
+            del self._entries[bisect_left(self._entries, (key,))]
+
+    def find(self, order: Order) -> Batch | None:
+        exhausted = []
+        found = None
+        for _, batch in self._entries:
+            if batch.available_quantity <= 0:
+                exhausted.append(batch)
+            elif batch.can_allocate(order):
+                found = batch
+                break
+        for batch in exhausted:
+            self.discard(batch)
+        return found
+
+
 @dataclass(kw_only=True)
 class Product:
     sku: str
     batches: list[Batch]
     version_number: int = 0
+    # built lazily from batches. None means "not built yet" (e.g. right after the ORM loads the product)
+    _queue: BatchQueue = field(default=None, init=False, repr=False, compare=False)
+    # raised by the methods below, collected by the unit of work when it commits
+    events: list[Event] = field(default_factory=list, init=False, repr=False, compare=False)
 
     def allocate(self, order: Order) -> UUID:
-        try:
-            batch = next(b for b in sorted(self.batches) if b.can_allocate(order))
-            batch.allocate(order)
+        batch_id = self._allocate(order)
+        if batch_id is not None:
+            self.version_number += 1
+        self._raise_allocation(order, batch_id)
+        return batch_id
+
+    def allocate_many(self, orders: list[Order]) -> list[UUID]:
+        """Allocate orders in the given order, bumping the version once for the whole lot."""
+        batch_ids = [self._allocate(order) for order in orders]
+        if any(batch_id is not None for batch_id in batch_ids):
+            self.version_number += 1
+        for order, batch_id in zip(orders, batch_ids):
+            self._raise_allocation(order, batch_id)
+        return batch_ids
+
+    def reallocate(self, orders: list[Order]) -> list[UUID]:
+        """Allocate orders change_batch_quantity just deallocated to the other batches.
+
+        The Deallocated events of the orders that fit are replaced by one Reallocated event. The others keep
+        theirs, and raise no OutOfStock.
+        """
+        batch_ids = [self._allocate(order) for order in orders]
+        reallocated = {
+            order.id: Allocated(order.id, order.sku, order.qty, batch_id)
+            for order, batch_id in zip(orders, batch_ids)
+            if batch_id is not None
+        }
+        if reallocated:
             self.version_number += 1
-            return batch.id
-        except StopIteration:
+            self.events = [e for e in self.events if not (isinstance(e, Deallocated) and e.order_id in reallocated)]
+            self.events.append(Reallocated(self.sku, list(reallocated.values())))
+        return batch_ids
+
+    def _raise_allocation(self, order: Order, batch_id: UUID | None) -> None:
+        if batch_id is None:
+            self.events.append(OutOfStock(self.sku))
+        else:
+            self.events.append(Allocated(order.id, order.sku, order.qty, batch_id))
+
+    def _allocate(self, order: Order) -> UUID:
+        queue = self.batch_queue
+        batch = queue.find(order)
+        if batch is None:
             return None
+        batch.allocate(order)
+        queue.update(batch)
+        return batch.id
+
+    def add_batch(self, batch: Batch) -> None:
+        queue = self.batch_queue
+        self.batches.append(batch)
+        queue.add(batch)
+        self._raise_batch_changed(batch)
 
-    def change_batch_quantity(self, id: UUID, qty: int) -> list[Order]:
+    def change_batch_quantity(self, id: UUID, qty: int, strategy: DeallocationStrategy = largest_first) -> list[Order]:
         batch = next(b for b in self.batches if b.id == id)
         batch.qty = qty
+        self._raise_batch_changed(batch)
         deallocated_orders = []
-        while batch.available_quantity < 0:
-            order = batch.deallocate_one()
-            deallocated_orders.append(order)
+        if batch.available_quantity < 0:
+            deallocated_orders = strategy(batch.allocations, -batch.available_quantity)
+            batch.deallocate(deallocated_orders)
+            self.events.extend(Deallocated(order.id, order.sku, order.qty) for order in deallocated_orders)
+        self.batch_queue.update(batch)
         return deallocated_orders
 
+    def change_batch_eta(self, id: UUID, eta: date) -> None:
+        batch = next(b for b in self.batches if b.id == id)
+        queue = self.batch_queue
+        queue.discard(batch)
+        batch.eta = eta
+        queue.update(batch)
+        self._raise_batch_changed(batch)
+
+    def _raise_batch_changed(self, batch: Batch) -> None:
+        self.events.append(BatchChanged(batch.id, batch.sku, batch.qty, batch.eta))
+
+    @property
+    def batch_queue(self) -> BatchQueue:
+        if self._queue is None or self._queue.tracked != len(self.batches):
+            self._queue = BatchQueue(self.batches)
+        return self._queue
+
+    def reset_batch_queue(self) -> None:
+        self._queue = None
+
     def __hash__(self) -> int:
         return hash(self.sku)
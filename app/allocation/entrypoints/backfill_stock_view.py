@@ -0,0 +1,21 @@
+import asyncio
+import logging
+
+from app.allocation.adapters.cache import AllocationsViewCache
+from app.allocation.adapters.db import DB
+from app.allocation.adapters.projection import AllocationsViewProjection
+from app.allocation.adapters.redis import redis
+from app.config import config
+
+
+# run once stock_view exists, before the workers are started on batches it has no rows for
+async def main() -> None:
+    projection = AllocationsViewProjection(
+        DB(config.PG_DSN), AllocationsViewCache(redis, config.ALLOCATIONS_VIEW_CACHE_TTL)
+    )
+    await projection.backfill_stock()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(main())
@@ -4,9 +4,14 @@ from collections.abc import AsyncGenerator
 from fastapi import Depends
 from sqlalchemy.ext.asyncio import AsyncSession
 
+from app.allocation.adapters.cache import AllocationsViewCache
 from app.allocation.adapters.db import DB
+from app.allocation.adapters.redis import redis
 from app.allocation.adapters.repository import AbstractProductRepository, PGProductRepository
-from app.allocation.service_layer.unit_of_work import AbstractUnitOfWork, PGUnitOfWork
+from app.allocation.domain import commands
+from app.allocation.service_layer import messagebus
+from app.allocation.service_layer.coalescing import CoalescingAllocateCmdHandler
+from app.allocation.service_layer.unit_of_work import PGUnitOfWork
 from app.config import config
 
 
@@ -26,5 +31,21 @@ def repository(
     return PGProductRepository(session)
 
 
-def batch_uow() -> AbstractUnitOfWork:
-    return PGUnitOfWork()
+@functools.lru_cache
+def message_bus(coalescing: bool) -> messagebus.MessageBus:
+    command_handlers = messagebus.command_handlers()
+    bus = messagebus.MessageBus(PGUnitOfWork, command_handlers, messagebus.EVENT_HANDLERS)
+    if coalescing:
+        # the owners allocate through the bus too, so the events of every micro-batch are handled
+        handler = CoalescingAllocateCmdHandler(bus)
+        command_handlers[commands.Allocate] = lambda _: handler
+    return bus
+
+
+def bus() -> messagebus.MessageBus:
+    return message_bus(config.ALLOCATION_COALESCING)
+
+
+@functools.lru_cache
+def allocations_view_cache() -> AllocationsViewCache:
+    return AllocationsViewCache(redis, config.ALLOCATIONS_VIEW_CACHE_TTL)
@@ -1,19 +1,27 @@
+from collections.abc import AsyncIterator
 from datetime import date
-from uuid import uuid4
+from typing import Any
+from uuid import UUID, uuid4
 
-from fastapi import Body, Depends, FastAPI, HTTPException
+import orjson
+from fastapi import Body, Depends, FastAPI, HTTPException, Query, Request, Response
+from fastapi.responses import ORJSONResponse, PlainTextResponse, StreamingResponse
 from sqlalchemy.ext.asyncio import AsyncSession
 
-from app.allocation.adapters import dao
-from app.allocation.adapters.dto import Allocation
+from app.allocation.adapters import dao, instrumentation, metrics
+from app.allocation.adapters.cache import AllocationsViewCache
+from app.allocation.adapters.dto import Allocation, OrderLine
 from app.allocation.adapters.orm import start_mappers
 from app.allocation.domain import commands
-from app.allocation.entrypoints.dependencies import batch_uow, session
-from app.allocation.service_layer import handlers
+from app.allocation.entrypoints.dependencies import allocations_view_cache, bus, session
 from app.allocation.service_layer.handlers import InvalidSku
-from app.allocation.service_layer.unit_of_work import AbstractUnitOfWork
+from app.allocation.service_layer.messagebus import MessageBus
+from app.allocation.service_layer.unit_of_work import ConcurrencyConflict
+from app.config import config
 
-app = FastAPI()
+app = FastAPI(default_response_class=ORJSONResponse)
+if config.INSTRUMENTATION_ENABLED:
+    app.add_middleware(instrumentation.TrackingMiddleware)
 start_mappers()
 
 
@@ -27,10 +35,10 @@ async def add_batch(
     sku: str = Body(),
     quantity: int = Body(),
     eta: date = Body(default=None),
-    uow: AbstractUnitOfWork = Depends(batch_uow),
+    bus: MessageBus = Depends(bus),
 ) -> dict[str, str]:
     cmd = commands.CreateBatch(uuid4(), sku, quantity, eta)
-    await handlers.CreateBatchCmdHandler(uow).handle(cmd)
+    await bus.handle(cmd)
     return {"batch_id": str(cmd.id)}
 
 
@@ -38,19 +46,102 @@ async def add_batch(
 async def allocate(
     sku: str = Body(),
     quantity: int = Body(),
-    uow: AbstractUnitOfWork = Depends(batch_uow),
+    bus: MessageBus = Depends(bus),
 ) -> dict[str, str]:
     try:
         cmd = commands.Allocate(uuid4(), sku, quantity)
-        batch_id = await handlers.AllocateCmdHandler(uow).handle(cmd)
+        batch_id = await bus.handle(cmd)
     except InvalidSku as e:
         raise HTTPException(status_code=400, detail=str(e))
+    except ConcurrencyConflict:
+        raise HTTPException(status_code=409, detail=f"Too many concurrent allocations for sku {sku}")
     return {"batch_id": str(batch_id)}
 
 
+@app.post("/allocate/bulk", status_code=201)
+async def allocate_bulk(
+    lines: list[OrderLine] = Body(embed=True),
+    bus: MessageBus = Depends(bus),
+) -> list[dict[str, str | None]]:
+    cmd = commands.AllocateMany([commands.Allocate(uuid4(), line.sku, line.quantity) for line in lines])
+    try:
+        batch_ids = await bus.handle(cmd)
+    except ConcurrencyConflict:
+        raise HTTPException(status_code=409, detail="Too many concurrent allocations")
+    results: list[dict[str, str | None]] = []
+    for order in cmd.orders:
+        if order.order_id not in batch_ids:
+            batch_id, status = None, "invalid_sku"
+        elif batch_ids[order.order_id] is None:
+            batch_id, status = None, "out_of_stock"
+        else:
+            batch_id, status = str(batch_ids[order.order_id]), "allocated"
+        results.append({"order_id": str(order.order_id), "sku": order.sku, "batch_id": batch_id, "status": status})
+    return results
+
+
 @app.get("/allocations/{sku}", status_code=200)
-async def allocations_view_endpoint(sku: str, session: AsyncSession = Depends(session)) -> list[Allocation]:
-    result = await dao.allocations(sku, session)
-    if not result:
+async def allocations_view_endpoint(
+    request: Request,
+    sku: str,
+    limit: int = Query(default=None, gt=0, le=config.ALLOCATIONS_PAGE_MAX_SIZE),
+    after: UUID = None,
+    session: AsyncSession = Depends(session),
+    cache: AllocationsViewCache = Depends(allocations_view_cache),
+) -> Response:
+    if limit is not None:
+        return await _allocations_page(request, sku, limit, after, session)
+    content = await cache.get(sku)
+    if content is None:
+        result = await dao.allocations(sku, session)
+        if not result:
+            raise HTTPException(status_code=404, detail="not found")
+        content = orjson.dumps(result)
+        await cache.set(sku, content)
+    return Response(content=content, media_type="application/json")
+
+
+async def _allocations_page(
+    request: Request, sku: str, limit: int, after: UUID | None, session: AsyncSession
+) -> Response:
+    page = await dao.allocations_page(sku, session, limit, after)
+    if not page and after is None:
+        raise HTTPException(status_code=404, detail="not found")
+    response = Response(content=orjson.dumps(page), media_type="application/json")
+    if len(page) == limit:
+        next_url = request.url.include_query_params(after=page[-1]["order_id"])
+        response.headers["Link"] = f'<{next_url}>; rel="next"'
+    return response
+
+
+@app.get("/allocations/{sku}/stream", status_code=200)
+async def allocations_stream_endpoint(sku: str, session: AsyncSession = Depends(session)) -> StreamingResponse:
+    chunks = dao.stream_allocations(sku, session, config.ALLOCATIONS_STREAM_BATCH_SIZE)
+    try:
+        first = await chunks.__anext__()
+    except StopAsyncIteration:
         raise HTTPException(status_code=404, detail="not found")
-    return result
+
+    async def ndjson() -> AsyncIterator[bytes]:
+        yield _ndjson(first)
+        async for rows in chunks:
+            yield _ndjson(rows)
+
+    return StreamingResponse(ndjson(), media_type="application/x-ndjson")
+
+
+def _ndjson(rows: list[Allocation]) -> bytes:
+    return b"".join(orjson.dumps(row) + b"\n" for row in rows)
+
+
+@app.get("/stock/{sku}", status_code=200)
+async def stock_endpoint(sku: str, session: AsyncSession = Depends(session)) -> dict[str, Any]:
+    batches = await dao.stock(sku, session)
+    if not batches:
+        raise HTTPException(status_code=404, detail="not found")
+    return {"sku": sku, "available": sum(batch["available"] for batch in batches), "batches": batches}
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics_endpoint() -> str:
+    return metrics.render()
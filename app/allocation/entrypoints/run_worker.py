@@ -1,71 +1,127 @@
 import asyncio
+import functools
+import logging
+from collections.abc import Sequence
 from uuid import UUID
 
-import orjson
 import sqlalchemy as sa
 
+from app.allocation.adapters import channels, instrumentation, metrics, stream
+from app.allocation.adapters.cache import AllocationsViewCache
 from app.allocation.adapters.db import DB
+from app.allocation.adapters.dispatcher import KeyedDispatcher
 from app.allocation.adapters.orm import start_mappers
+from app.allocation.adapters.outbox import OutboxRelay
+from app.allocation.adapters.projection import AllocationsViewProjection
 from app.allocation.adapters.redis import redis
-from app.allocation.constants import BATCH_QUANTITY_CHANGED_CHANNEL, ORDER_ALLOCATED_CHANNEL, ORDER_DEALLOCATED_CHANNEL
+from app.allocation.constants import ALLOCATION_STREAM, ALLOCATION_WORKER_GROUP
 from app.allocation.domain import commands, events
-from app.allocation.service_layer import handlers, unit_of_work
+from app.allocation.service_layer import messagebus, unit_of_work
 from app.config import config
 
 start_mappers()
 db = DB(config.PG_DSN)
+allocations_view_cache = AllocationsViewCache(redis, config.ALLOCATIONS_VIEW_CACHE_TTL)
+
 
-# TODO: prevent event loss
-# TODO: use same transaction, or make idempotent
 async def main() -> None:
-    pubsub = redis.pubsub(ignore_subscribe_messages=True)
-    await pubsub.subscribe(BATCH_QUANTITY_CHANGED_CHANNEL, ORDER_ALLOCATED_CHANNEL, ORDER_DEALLOCATED_CHANNEL)
-
-    async for m in pubsub.listen():
-        channel = m["channel"].decode("utf-8")
-        data = orjson.loads(m["data"])
-        if channel == BATCH_QUANTITY_CHANGED_CHANNEL:
-            await handlers.ChangeBatchQuantityCmdHandler(unit_of_work.PGUnitOfWork()).handle(
-                commands.ChangeBatchQuantity(id=UUID(data["id"]), qty=data["qty"]),
-            )
-        elif channel == ORDER_ALLOCATED_CHANNEL:
-            await _add_allocation_to_read_model(
-                events.Allocated(
-                    order_id=UUID(data["order_id"]), sku=data["sku"], qty=data["qty"], batch_id=UUID(data["batch_id"])
-                ),
-            )
-        elif channel == ORDER_DEALLOCATED_CHANNEL:
-            event = events.Deallocated(order_id=UUID(data["order_id"]), sku=data["sku"], qty=data["qty"])
-            await _remove_allocation_from_read_model(event)
-            await _remove_order(event)
-            await handlers.AllocateCmdHandler(unit_of_work.PGUnitOfWork()).handle(
-                commands.Allocate(order_id=event.order_id, sku=event.sku, qty=event.qty)
+    partitions = [p for p in range(config.STREAM_PARTITIONS) if p % config.WORKER_COUNT == config.WORKER_INDEX]
+    # shared by the consumers, so that WORKER_CONCURRENCY bounds the handlers running in this worker
+    dispatcher = KeyedDispatcher(config.WORKER_CONCURRENCY, config.WORKER_LANE_QUEUE_SIZE)
+    consumers = []
+    for p in partitions:
+        # one projection per consumer, so a flush only covers the messages that consumer acknowledges next
+        projection = AllocationsViewProjection(db, allocations_view_cache)
+        consumers.append(
+            stream.StreamConsumer(
+                redis,
+                ALLOCATION_WORKER_GROUP,
+                ALLOCATION_STREAM,
+                p,
+                functools.partial(handle, message_bus(projection)),
+                flush=projection.flush,
+                dispatcher=dispatcher,
             )
+        )
+    await asyncio.gather(OutboxRelay(db, redis).run(), serve_metrics(), *(consumer.run() for consumer in consumers))
 
 
-async def _add_allocation_to_read_model(event: events.Allocated) -> None:
-    async with db.session() as session:
-        await session.execute(
-            sa.text("INSERT INTO allocations_view (order_id, sku, batch_id) VALUES (:order_id, :sku, :batch_id)"),
-            dict(order_id=event.order_id, sku=event.sku, batch_id=event.batch_id),
-        )
+async def serve_metrics() -> None:
+    if config.WORKER_METRICS_PORT:
+        server = await metrics.server("0.0.0.0", config.WORKER_METRICS_PORT)
+        async with server:
+            await server.serve_forever()
 
 
-async def _remove_order(event: events.Deallocated) -> None:
-    async with db.session() as session:
-        await session.execute(
-            sa.text('DELETE FROM "order" WHERE id = :order_id'),
-            dict(order_id=event.order_id),
-        )
+def message_bus(projection: AllocationsViewProjection) -> messagebus.MessageBus:
+    event_handlers: dict[type[events.Event], Sequence[messagebus.EventHandler]] = {
+        **messagebus.EVENT_HANDLERS,
+        events.Allocated: [functools.partial(add_allocations, projection)],
+        events.Reallocated: [functools.partial(move_allocations, projection)],
+        events.BatchChanged: [functools.partial(change_batches, projection)],
+    }
+    bus = messagebus.MessageBus(unit_of_work.PGUnitOfWork, messagebus.command_handlers(), event_handlers)
+    event_handlers[events.Deallocated] = [functools.partial(reallocate, projection, bus)]
+    return bus
+
+
+async def handle(bus: messagebus.MessageBus, channel: str, message: bytes) -> None:
+    # one message at a time rather than through handle_many: the consumer acknowledges, remembers and dead letters
+    # each message by its own outcome, and the projection already batches the writes of a read batch in its flush
+    decoded = channels.decode(channel, message)
+    if decoded is not None:
+        with instrumentation.tracked(channel):
+            await bus.handle(decoded)
+
+
+async def add_allocations(projection: AllocationsViewProjection, allocated: list[events.Allocated]) -> None:
+    for event in allocated:
+        projection.add(event)
+
+
+async def move_allocations(projection: AllocationsViewProjection, reallocated: list[events.Reallocated]) -> None:
+    allocations = [allocated for event in reallocated for allocated in event.allocations]
+    # all removals first, so the projection writes them in one statement and the additions in another
+    for allocated in allocations:
+        projection.remove(events.Deallocated(order_id=allocated.order_id, sku=allocated.sku, qty=allocated.qty))
+    for allocated in allocations:
+        projection.add(allocated)
+
+
+async def change_batches(projection: AllocationsViewProjection, changed: list[events.BatchChanged]) -> None:
+    for event in changed:
+        projection.change(event)
+
+
+async def reallocate(
+    projection: AllocationsViewProjection, bus: messagebus.MessageBus, deallocated: list[events.Deallocated]
+) -> None:
+    # the rows of the orders were deleted with their deallocation, so an allocated order was already reallocated
+    # by an earlier delivery of its event: the projection is put back to that allocation instead
+    allocated = await _allocated_batch_ids(deallocated)
+    for event in deallocated:
+        projection.remove(event)
+    for event in deallocated:
+        if event.order_id in allocated:
+            projection.add(events.Allocated(event.order_id, event.sku, event.qty, allocated[event.order_id]))
+    await bus.handle_many(
+        [
+            commands.Allocate(order_id=e.order_id, sku=e.sku, qty=e.qty)
+            for e in deallocated
+            if e.order_id not in allocated
+        ]
+    )
 
 
-async def _remove_allocation_from_read_model(event: events.Deallocated) -> None:
+async def _allocated_batch_ids(deallocated: list[events.Deallocated]) -> dict[UUID, UUID]:
     async with db.session() as session:
-        await session.execute(
-            sa.text("DELETE FROM allocations_view WHERE order_id = :order_id AND sku = :sku"),
-            dict(order_id=event.order_id, sku=event.sku),
+        result = await session.execute(
+            sa.text("SELECT order_id, batch_id FROM allocation WHERE order_id = ANY(:order_ids)"),
+            dict(order_ids=[event.order_id for event in deallocated]),
         )
+        return {order_id: batch_id for order_id, batch_id in result}
 
 
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
     asyncio.run(main())
@@ -0,0 +1,72 @@
+import asyncio
+import logging
+from uuid import UUID
+
+from app.allocation.adapters import dispatcher, instrumentation, metrics
+from app.allocation.domain import commands
+from app.allocation.service_layer import handlers, messagebus
+from app.config import config
+
+logger = logging.getLogger(__name__)
+
+COALESCED_BATCHES = metrics.Counter("allocation_coalesced_batches_total", "Micro-batches flushed by sku owners")
+COALESCED_ORDERS = metrics.Counter("allocation_coalesced_orders_total", "Allocations flushed by sku owners")
+
+Pending = tuple[commands.Allocate, "asyncio.Future[UUID]"]
+
+
+class CoalescingAllocateCmdHandler(handlers.Handler[commands.Allocate, UUID]):
+    """Allocate through one owner task per sku, which applies the allocations queued meanwhile as one AllocateMany.
+
+    Owners stop after ALLOCATION_COALESCING_IDLE_MS without allocations.
+    """
+
+    def __init__(self, bus: messagebus.MessageBus) -> None:
+        self._bus = bus
+        self._queues: dict[str, asyncio.Queue[Pending]] = {}
+        self._owners: set[asyncio.Task[None]] = set()
+
+    @instrumentation.timed_handler
+    async def handle(self, cmd: commands.Allocate) -> UUID:
+        queue = self._queues.get(cmd.sku)
+        if queue is None:
+            queue = self._queues[cmd.sku] = asyncio.Queue()
+            dispatcher.spawn(self._owners, self._own(cmd.sku, queue))
+        future: asyncio.Future[UUID] = asyncio.get_running_loop().create_future()
+        queue.put_nowait((cmd, future))
+        return await future
+
+    async def _own(self, sku: str, queue: asyncio.Queue[Pending]) -> None:
+        while True:
+            try:
+                first = await asyncio.wait_for(queue.get(), config.ALLOCATION_COALESCING_IDLE_MS / 1000)
+            except asyncio.TimeoutError:
+                # nothing can be queued between this check and the removal, there is no await in between
+                if queue.empty():
+                    del self._queues[sku]
+                    return
+                continue
+            batch = [first]
+            while not queue.empty() and len(batch) < config.ALLOCATION_COALESCING_MAX_BATCH:
+                batch.append(queue.get_nowait())
+            await self._flush(sku, batch)
+
+    async def _flush(self, sku: str, batch: list[Pending]) -> None:
+        COALESCED_BATCHES.inc()
+        COALESCED_ORDERS.inc(len(batch))
+        try:
+            batch_ids = await self._bus.handle(commands.AllocateMany([cmd for cmd, _ in batch]))
+        except Exception as e:
+            logger.exception("Failed to allocate %s orders for %s", len(batch), sku)
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for cmd, future in batch:
+            # the client may have gone away and cancelled its request
+            if future.done():
+                continue
+            if cmd.order_id in batch_ids:
+                future.set_result(batch_ids[cmd.order_id])
+            else:
+                future.set_exception(handlers.InvalidSku(f"Invalid sku {sku}"))
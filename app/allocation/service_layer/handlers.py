@@ -1,11 +1,9 @@
+import functools
+from collections import defaultdict
 from typing import Protocol, TypeVar
 from uuid import UUID
 
-import orjson
-
-from app.allocation.adapters import email
-from app.allocation.adapters.redis import redis
-from app.allocation.constants import ORDER_ALLOCATED_CHANNEL, ORDER_DEALLOCATED_CHANNEL
+from app.allocation.adapters import email, instrumentation
 from app.allocation.domain import commands, events, models
 from app.allocation.service_layer import unit_of_work
 
@@ -27,6 +25,7 @@ class CreateBatchCmdHandler(Handler[commands.CreateBatch, models.Batch]):
     def __init__(self, uow: unit_of_work.AbstractUnitOfWork) -> None:
         self._uow = uow
 
+    @instrumentation.timed_handler
     async def handle(self, cmd: commands.CreateBatch) -> models.Batch:
         async with self._uow:
             product = await self._uow.products.get(cmd.sku)
@@ -34,7 +33,7 @@ class CreateBatchCmdHandler(Handler[commands.CreateBatch, models.Batch]):
                 product = models.Product(sku=cmd.sku, batches=[])
                 await self._uow.products.add(product)
             batch = models.Batch(id=cmd.id, sku=cmd.sku, qty=cmd.qty, eta=cmd.eta)
-            product.batches.append(batch)
+            product.add_batch(batch)
             await self._uow.commit()
             return batch
 
@@ -43,55 +42,88 @@ class AllocateCmdHandler(Handler[commands.Allocate, UUID]):
     def __init__(self, uow: unit_of_work.AbstractUnitOfWork) -> None:
         self._uow = uow
 
+    @instrumentation.timed_handler
     async def handle(self, cmd: commands.Allocate) -> UUID:
+        return await unit_of_work.retry_on_conflict(lambda: self._allocate(cmd), "allocate")
+
+    async def _allocate(self, cmd: commands.Allocate) -> UUID:
         order = models.Order(id=cmd.order_id, sku=cmd.sku, qty=cmd.qty)
         async with self._uow:
-            product = await self._uow.products.get(order.sku)
+            product = await self._uow.products.get(order.sku, allocating=[order])
             if product is None:
                 raise InvalidSku(f"Invalid sku {order.sku}")
             batch_id = product.allocate(order)
-            if batch_id is None:
-                self._send_email(events.OutOfStock(order.sku))
-            else:
-                await self._publish(events.Allocated(order.id, order.sku, order.qty, batch_id))
             await self._uow.commit()
             return batch_id
 
-    def _send_email(self, event: events.OutOfStock) -> None:
-        email.send("stock@made.com", f"Out of stock for {event.sku}")
 
-    async def _publish(self, event: events.Allocated) -> None:
-        await redis.publish(
-            ORDER_ALLOCATED_CHANNEL,
-            orjson.dumps(
-                dict(
-                    order_id=str(event.order_id),
-                    sku=event.sku,
-                    qty=event.qty,
-                    batch_id=str(event.batch_id),
-                )
-            ),
-        )
+class AllocateManyCmdHandler(Handler[commands.AllocateMany, dict[UUID, UUID]]):
+    """Allocate orders product by product: each product is loaded and committed once.
 
+    Returns the allocated batch id (None if out of stock) by order id. Orders for unknown skus are left out.
+    """
 
-class ChangeBatchQuantityCmdHandler(Handler[commands.ChangeBatchQuantity, None]):
     def __init__(self, uow: unit_of_work.AbstractUnitOfWork) -> None:
         self._uow = uow
 
+    @instrumentation.timed_handler
+    async def handle(self, cmd: commands.AllocateMany) -> dict[UUID, UUID]:
+        lines_by_sku: dict[str, list[commands.Allocate]] = defaultdict(list)
+        for line in cmd.orders:
+            lines_by_sku[line.sku].append(line)
+
+        results: dict[UUID, UUID] = {}
+        for sku, lines in lines_by_sku.items():
+            batch_ids = await unit_of_work.retry_on_conflict(
+                functools.partial(self._allocate, sku, lines), "allocate_many"
+            )
+            if batch_ids is not None:
+                results.update(zip((line.order_id for line in lines), batch_ids))
+        return results
+
+    async def _allocate(self, sku: str, lines: list[commands.Allocate]) -> list[UUID] | None:
+        orders = [models.Order(id=line.order_id, sku=line.sku, qty=line.qty) for line in lines]
+        async with self._uow:
+            product = await self._uow.products.get(sku, allocating=orders)
+            if product is None:
+                return None
+            batch_ids = product.allocate_many(orders)
+            await self._uow.commit()
+            return batch_ids
+
+
+class ChangeBatchQuantityCmdHandler(Handler[commands.ChangeBatchQuantity, None]):
+    """Change a batch's quantity, deallocating the orders strategy picks if it is over-allocated.
+
+    With reallocate, the deallocated orders are reallocated to the product's other batches in the same unit of
+    work and published as one Reallocated event. Only the orders that could not be reallocated are published as
+    Deallocated, for the worker to try again.
+    """
+
+    def __init__(
+        self,
+        uow: unit_of_work.AbstractUnitOfWork,
+        reallocate: bool = False,
+        strategy: models.DeallocationStrategy = models.largest_first,
+    ) -> None:
+        self._uow = uow
+        self._reallocate = reallocate
+        self._strategy = strategy
+
+    @instrumentation.timed_handler
     async def handle(self, cmd: commands.ChangeBatchQuantity) -> None:
+        await unit_of_work.retry_on_conflict(lambda: self._change_batch_quantity(cmd), "change_batch_quantity")
+
+    async def _change_batch_quantity(self, cmd: commands.ChangeBatchQuantity) -> None:
         async with self._uow:
             product = await self._uow.products.get_by_batch_id(cmd.id)
-            orders = product.change_batch_quantity(cmd.id, cmd.qty)
-            deallocated_events = [events.Deallocated(order.id, order.sku, order.qty) for order in orders]
-            if deallocated_events:
-                await self._publish(deallocated_events)
+            orders = product.change_batch_quantity(cmd.id, cmd.qty, self._strategy)
+            if self._reallocate and orders:
+                product.reallocate(orders)
             await self._uow.commit()
 
-    async def _publish(self, event: list[events.Deallocated]) -> None:
-        pipe = redis.pipeline()
-        for e in event:
-            pipe.publish(
-                ORDER_DEALLOCATED_CHANNEL,
-                orjson.dumps(dict(order_id=str(e.order_id), sku=e.sku, qty=e.qty)),
-            )
-        await pipe.execute()
+
+async def notify_out_of_stock(out_of_stock: list[events.OutOfStock]) -> None:
+    """Queue the skus for the out of stock digest, which lists each once however many orders ran out of it."""
+    for event in out_of_stock:
+        email.OUT_OF_STOCK.add(event.sku)
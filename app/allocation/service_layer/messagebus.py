@@ -0,0 +1,88 @@
+import functools
+import itertools
+import logging
+import typing
+from collections.abc import Awaitable, Callable, Mapping, Sequence
+from typing import Any
+
+from app.allocation.domain import commands, events, models
+from app.allocation.service_layer import handlers, unit_of_work
+from app.config import config
+
+logger = logging.getLogger(__name__)
+
+Message = commands.Command | events.Event
+# builds the handler of a command around the unit of work the bus gives it
+HandlerFactory = Callable[[unit_of_work.AbstractUnitOfWork], handlers.Handler[Any, Any]]
+# gets every event of its type the bus has at hand at once
+EventHandler = Callable[[list[Any]], Awaitable[None]]
+
+
+class MessageBus:
+    """Route commands to their handler around a new unit of work, and events to their handlers grouped by type.
+
+    The events commands raise are handled once every message was, and their handlers' errors are only logged.
+    """
+
+    def __init__(
+        self,
+        uow_factory: Callable[[], unit_of_work.AbstractUnitOfWork],
+        command_handlers: Mapping[type[commands.Command], HandlerFactory],
+        event_handlers: Mapping[type[events.Event], Sequence[EventHandler]],
+    ) -> None:
+        self._uow_factory = uow_factory
+        self._command_handlers = command_handlers
+        self._event_handlers = event_handlers
+
+    async def handle(self, message: Message) -> Any:
+        """The result of the handler of a command, None for an event."""
+        [result] = await self.handle_many([message])
+        return result
+
+    async def handle_many(self, messages: Sequence[Message]) -> list[Any]:
+        results: list[Any] = []
+        raised: list[events.Event] = []
+        try:
+            for type_, run in itertools.groupby(messages, type):
+                batch = list(run)
+                if issubclass(type_, commands.Command):
+                    for cmd in batch:
+                        uow = self._uow_factory()
+                        results.append(await self._command_handlers[type_](uow).handle(cmd))
+                        raised += uow.collect_new_events()
+                else:
+                    for handler in self._event_handlers.get(typing.cast(type[events.Event], type_), ()):
+                        await handler(batch)
+                    results += [None] * len(batch)
+        finally:
+            await self._handle_raised(raised)
+        return results
+
+    async def _handle_raised(self, raised: list[events.Event]) -> None:
+        by_type: dict[type[events.Event], list[events.Event]] = {}
+        for event in raised:
+            by_type.setdefault(type(event), []).append(event)
+        for type_, batch in by_type.items():
+            for handler in self._event_handlers.get(type_, ()):
+                try:
+                    await handler(batch)
+                except Exception:
+                    logger.exception("Failed to handle %s %s events", len(batch), type_.__name__)
+
+
+def command_handlers() -> dict[type[commands.Command], HandlerFactory]:
+    return {
+        commands.CreateBatch: handlers.CreateBatchCmdHandler,
+        commands.Allocate: handlers.AllocateCmdHandler,
+        commands.AllocateMany: handlers.AllocateManyCmdHandler,
+        commands.ChangeBatchQuantity: functools.partial(
+            handlers.ChangeBatchQuantityCmdHandler,
+            reallocate=config.BULK_REALLOCATION,
+            strategy=models.DEALLOCATION_STRATEGIES[config.DEALLOCATION_STRATEGY],
+        ),
+    }
+
+
+EVENT_HANDLERS: Mapping[type[events.Event], Sequence[EventHandler]] = {
+    events.OutOfStock: [handlers.notify_out_of_stock],
+}
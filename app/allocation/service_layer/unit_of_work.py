@@ -1,15 +1,49 @@
 from __future__ import annotations
 
 import abc
-from typing import Any
+import asyncio
+import random
+from collections.abc import Awaitable, Callable
+from typing import Any, TypeVar
 
 from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm.exc import StaleDataError
 
+from app.allocation.adapters import channels, instrumentation, metrics
 from app.allocation.adapters.db import SESSION_FACTORY, async_scoped_session
-from app.allocation.adapters.repository import AbstractProductRepository, PGProductRepository
+from app.allocation.adapters.outbox import AbstractOutbox, InMemoryOutbox, PGOutbox
+from app.allocation.adapters.repository import (
+    AbstractProductRepository,
+    InMemoryDatabase,
+    InMemoryProductRepository,
+    PGProductRepository,
+    StaleProduct,
+)
+from app.allocation.domain import events
+from app.config import config
+
+R = TypeVar("R")
+
+CONCURRENCY_CONFLICTS = metrics.Counter(
+    "allocation_concurrency_conflicts_total",
+    "Commits rejected because the product was changed concurrently",
+    ("operation",),
+)
+CONCURRENCY_RETRIES_EXHAUSTED = metrics.Counter(
+    "allocation_concurrency_retries_exhausted_total",
+    "Operations that gave up after OCC_RETRY_LIMIT retries",
+    ("operation",),
+)
+
+
+class ConcurrencyConflict(Exception):
+    pass
 
 
 class AbstractUnitOfWork(abc.ABC):
+    def __init__(self) -> None:
+        self._events: list[events.Event] = []
+
     async def __aenter__(self) -> AbstractUnitOfWork:
         return self
 
@@ -20,8 +54,32 @@ class AbstractUnitOfWork(abc.ABC):
     def products(self) -> AbstractProductRepository:
         raise NotImplementedError
 
-    @abc.abstractmethod
+    @abc.abstractproperty
+    def outbox(self) -> AbstractOutbox:
+        raise NotImplementedError
+
     async def commit(self) -> None:
+        """Commit, with the events of the products this unit of work saw.
+
+        Events with a channel are written to the outbox in the same transaction. The others are kept for
+        collect_new_events, once the commit succeeded.
+        """
+        raised = []
+        for product in self.products.seen:
+            raised += product.events
+            product.events = []
+        messages = [channels.encode(event) for event in raised]
+        await self.outbox.add(*(message for message in messages if message is not None))
+        await self._commit()
+        self._events += (event for event, message in zip(raised, messages) if message is None)
+
+    def collect_new_events(self) -> list[events.Event]:
+        """The in-process events of the commits since the last call."""
+        collected, self._events = self._events, []
+        return collected
+
+    @abc.abstractmethod
+    async def _commit(self) -> None:
         raise NotImplementedError
 
     @abc.abstractmethod
@@ -31,28 +89,100 @@ class AbstractUnitOfWork(abc.ABC):
 
 class PGUnitOfWork(AbstractUnitOfWork):
     def __init__(self) -> None:
+        super().__init__()
         self._session_factory: async_scoped_session = None
         self._session: AsyncSession = None
         self._products: PGProductRepository = None
+        self._outbox: PGOutbox = None
 
     @property
     def products(self) -> AbstractProductRepository:
         return self._products
 
+    @property
+    def outbox(self) -> AbstractOutbox:
+        return self._outbox
+
     async def __aenter__(self) -> AbstractUnitOfWork:
         # put below code to __init__, and then run test it will raise error "no event loop"
         # because async client do not create event loop at depends level
         self._session_factory = SESSION_FACTORY
         self._session = self._session_factory()
         self._products = PGProductRepository(self._session)
+        self._outbox = PGOutbox(self._session)
         return await super().__aenter__()
 
     async def __aexit__(self, *args: Any) -> None:
         await super().__aexit__(*args)
         await self._session_factory.remove()
 
-    async def commit(self) -> None:
-        await self._session.commit()
+    @instrumentation.timed(instrumentation.UOW_SECONDS, operation="commit")
+    async def _commit(self) -> None:
+        try:
+            await self._session.commit()
+        except StaleDataError as e:
+            # another transaction bumped the product's version_number since we read it
+            raise ConcurrencyConflict(str(e)) from e
 
+    @instrumentation.timed(instrumentation.UOW_SECONDS, operation="rollback")
     async def rollback(self) -> None:
         await self._session.rollback()
+
+
+class InMemoryUnitOfWork(AbstractUnitOfWork):
+    """Unit of work over an InMemoryDatabase, for tests and simulations that do not need Postgres.
+
+    Every `async with` block works on its own copies of the products it loads. commit writes them back and
+    publishes the outbox messages to db.messages, rollback drops both.
+    """
+
+    def __init__(self, db: InMemoryDatabase) -> None:
+        super().__init__()
+        self._db = db
+        self._products: InMemoryProductRepository = None
+        self._outbox: InMemoryOutbox = None
+
+    @property
+    def products(self) -> AbstractProductRepository:
+        return self._products
+
+    @property
+    def outbox(self) -> AbstractOutbox:
+        return self._outbox
+
+    async def __aenter__(self) -> AbstractUnitOfWork:
+        self._products = InMemoryProductRepository(self._db)
+        self._outbox = InMemoryOutbox()
+        return await super().__aenter__()
+
+    async def _commit(self) -> None:
+        try:
+            self._products.save()
+        except StaleProduct as e:
+            raise ConcurrencyConflict(str(e)) from e
+        self._db.messages += self._outbox.messages
+        self._outbox.messages = []
+
+    async def rollback(self) -> None:
+        self._products = InMemoryProductRepository(self._db)
+        self._outbox = InMemoryOutbox()
+
+
+async def retry_on_conflict(attempt: Callable[[], Awaitable[R]], operation: str) -> R:
+    """Run attempt, a whole unit of work, again while it fails with ConcurrencyConflict.
+
+    Retries up to OCC_RETRY_LIMIT times, sleeping a random time up to an exponentially growing cap in between
+    so that competing writers spread out instead of colliding again.
+    """
+    retries = 0
+    while True:
+        try:
+            return await attempt()
+        except ConcurrencyConflict:
+            CONCURRENCY_CONFLICTS.inc(operation=operation)
+            if retries >= config.OCC_RETRY_LIMIT:
+                CONCURRENCY_RETRIES_EXHAUSTED.inc(operation=operation)
+                raise
+        cap = min(config.OCC_RETRY_BACKOFF_MAX_MS, config.OCC_RETRY_BACKOFF_MS * 2**retries)
+        await asyncio.sleep(random.uniform(0, cap) / 1000)
+        retries += 1
@@ -1,9 +1,70 @@
+from typing import Literal
+
 from pydantic import BaseSettings
 
 
 class Config(BaseSettings):
     PG_DSN: str
     REDIS_DSN: str
+    # per process: the API opens up to (PG_POOL_SIZE + PG_MAX_OVERFLOW) * uvicorn workers connections
+    PG_POOL_SIZE: int = 5
+    PG_MAX_OVERFLOW: int = 10
+    PG_POOL_TIMEOUT: float = 30  # seconds
+    PG_POOL_RECYCLE: int = 1_800  # seconds, -1 to keep connections forever
+    PG_POOL_PRE_PING: bool = False
+    # set both to 0 behind pgbouncer in transaction mode
+    PG_STATEMENT_CACHE_SIZE: int = 100
+    PG_PREPARED_STATEMENT_CACHE_SIZE: int = 100
+    ALLOCATIONS_VIEW_CACHE_TTL: int = 60  # seconds
+    # batch id -> sku lookups of get_by_batch_id remembered per process, 0 to always look the sku up
+    BATCH_SKU_CACHE_SIZE: int = 10_000
+    # GET /allocations/{sku}: largest page a client can ask for, rows per chunk written by the NDJSON stream
+    ALLOCATIONS_PAGE_MAX_SIZE: int = 1_000
+    ALLOCATIONS_STREAM_BATCH_SIZE: int = 500
+    # events of every channel are spread over STREAM_PARTITIONS streams by sku (or batch id).
+    # worker WORKER_INDEX out of WORKER_COUNT consumes the partitions p where p % WORKER_COUNT == WORKER_INDEX
+    STREAM_PARTITIONS: int = 8
+    STREAM_READ_COUNT: int = 100
+    STREAM_BLOCK_MS: int = 1_000
+    # how long consumers that flush in batches wait for STREAM_READ_COUNT messages
+    STREAM_BATCH_LINGER_MS: int = 50
+    STREAM_CLAIM_MIN_IDLE_MS: int = 30_000
+    # deliveries after which a message is moved to its partition's dead letter stream
+    STREAM_MAX_DELIVERIES: int = 10
+    WORKER_COUNT: int = 1
+    WORKER_INDEX: int = 0
+    # lanes handling messages concurrently in a worker, messages with the same key share a lane
+    WORKER_CONCURRENCY: int = 16
+    WORKER_LANE_QUEUE_SIZE: int = 100
+    # retries of a unit of work whose commit lost a race on the product's version_number
+    OCC_RETRY_LIMIT: int = 5
+    OCC_RETRY_BACKOFF_MS: int = 5
+    OCC_RETRY_BACKOFF_MAX_MS: int = 200
+    # allocate through one owner task per sku in the API process, see CoalescingAllocateCmdHandler
+    ALLOCATION_COALESCING: bool = False
+    ALLOCATION_COALESCING_MAX_BATCH: int = 200
+    ALLOCATION_COALESCING_IDLE_MS: int = 10_000
+    # reallocate the orders a batch quantity change deallocates in the same unit of work, instead of one unit
+    # of work per Deallocated event in the worker
+    BULK_REALLOCATION: bool = False
+    # which orders to deallocate from a batch whose quantity went below its allocations, see models.py
+    DEALLOCATION_STRATEGY: Literal["arbitrary", "largest_first", "best_fit"] = "largest_first"
+    OUTBOX_RELAY_BATCH_SIZE: int = 500
+    OUTBOX_RELAY_INTERVAL_MS: int = 50
+    # how long consumers remember handled message ids to drop redeliveries
+    STREAM_DEDUPE_TTL: int = 86_400  # seconds
+    # histograms of handlers, unit of work commits, statements per request or message and Redis round trips
+    INSTRUMENTATION_ENABLED: bool = True
+    # the worker serves GET /metrics on this port, 0 to not serve it
+    WORKER_METRICS_PORT: int = 9100
+    SMTP_HOST: str = "localhost"
+    SMTP_PORT: int = 25
+    SMTP_TIMEOUT: float = 10  # seconds
+    EMAIL_FROM: str = "allocation@made.com"
+    OUT_OF_STOCK_EMAIL: str = "stock@made.com"
+    # emails gather what happened within a window, lines beyond the queue size are dropped
+    EMAIL_DIGEST_WINDOW_MS: int = 60_000
+    EMAIL_DIGEST_QUEUE_SIZE: int = 10_000
 
 
 config = Config()
@@ -0,0 +1,66 @@
+import random
+import timeit
+from datetime import date, timedelta
+
+from app.allocation.domain.models import DEALLOCATION_STRATEGIES, Batch, Order, Product
+
+SIZES = (10, 1_000, 10_000, 100_000)
+NUMBER = 10_000
+
+
+def _batch(allocations: int) -> Batch:
+    batch = Batch(sku="BENCH-SKU", qty=allocations * 2)
+    for _ in range(allocations):
+        batch.allocate(Order(sku="BENCH-SKU", qty=1))
+    return batch
+
+
+def bench_available_quantity() -> None:
+    print("Batch.available_quantity (ns per call)")
+    print(f"{'allocations':>12} {'counter':>12} {'re-sum':>12}")
+    for size in SIZES:
+        batch = _batch(size)
+        counter = timeit.timeit(lambda: batch.available_quantity, number=NUMBER) / NUMBER
+        number = max(1, NUMBER // size)
+        resum = timeit.timeit(lambda: batch.qty - sum(o.qty for o in batch.allocations), number=number) / number
+        print(f"{size:>12} {counter * 1e9:>12.0f} {resum * 1e9:>12.0f}")
+
+
+def bench_product_allocate() -> None:
+    print("Product.allocate with exhausted batches ahead of the only one with stock (us per call)")
+    print(f"{'batches':>12} {'queue':>12} {'sorted':>12}")
+    for size in (10, 100, 1_000):
+        batches = [Batch(sku="BENCH-SKU", qty=0, eta=date.today() + timedelta(days=i)) for i in range(size)]
+        batches.append(Batch(sku="BENCH-SKU", qty=NUMBER * 2, eta=date.today() + timedelta(days=size)))
+        product = Product(sku="BENCH-SKU", batches=batches)
+        number = NUMBER // 10
+        queue = timeit.timeit(lambda: product.allocate(Order(sku="BENCH-SKU", qty=1)), number=number) / number
+        order = Order(sku="BENCH-SKU", qty=1)
+        resort = timeit.timeit(lambda: next(b for b in sorted(batches) if b.can_allocate(order)), number=number)
+        print(f"{size:>12} {queue * 1e6:>12.2f} {resort / number * 1e6:>12.2f}")
+
+
+def bench_deallocation_strategies() -> None:
+    print("Product.change_batch_quantity taking 5% of a batch of orders of 1 to 100 units (evictions, ms per call)")
+    print(f"{'allocations':>12} {'strategy':>14} {'evictions':>10} {'units':>8} {'ms':>10}")
+    rng = random.Random(0)
+    for size in SIZES[1:]:
+        orders = [Order(sku="BENCH-SKU", qty=rng.randint(1, 100)) for _ in range(size)]
+        allocated = sum(order.qty for order in orders)
+        for name, strategy in DEALLOCATION_STRATEGIES.items():
+            elapsed = 0.0
+            number = max(1, NUMBER // size)
+            for _ in range(number):
+                batch = Batch(sku="BENCH-SKU", qty=allocated, allocations=set(orders))
+                product = Product(sku="BENCH-SKU", batches=[batch])
+                start = timeit.default_timer()
+                deallocated = product.change_batch_quantity(batch.id, allocated * 95 // 100, strategy)
+                elapsed += timeit.default_timer() - start
+            units = sum(order.qty for order in deallocated)
+            print(f"{size:>12} {name:>14} {len(deallocated):>10} {units:>8} {elapsed / number * 1000:>10.3f}")
+
+
+if __name__ == "__main__":
+    bench_available_quantity()
+    bench_product_allocate()
+    bench_deallocation_strategies()
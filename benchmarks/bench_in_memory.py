@@ -0,0 +1,53 @@
+"""Allocate commands replayed through the message bus and the handlers on an InMemoryDatabase, commands per second.
+
+One command per unit of work like the API, and AllocateMany commands of MANY orders like the coalescing handler.
+Batches hold enough stock for every order, so each allocation also raises an Allocated event for the outbox.
+"""
+import asyncio
+import random
+import time
+from datetime import date, timedelta
+from uuid import uuid4
+
+from app.allocation.adapters.repository import InMemoryDatabase
+from app.allocation.domain import commands
+from app.allocation.service_layer import messagebus
+from app.allocation.service_layer.unit_of_work import InMemoryUnitOfWork
+
+SKUS = 100
+BATCHES = 10
+ORDERS = 100_000
+MANY = 100
+
+
+async def seed(bus: messagebus.MessageBus) -> list[str]:
+    skus = [f"BENCH-{uuid4()}" for _ in range(SKUS)]
+    await bus.handle_many(
+        [
+            commands.CreateBatch(uuid4(), sku, ORDERS, date.today() + timedelta(days=i))
+            for sku in skus
+            for i in range(BATCHES)
+        ]
+    )
+    return skus
+
+
+async def main() -> None:
+    print(f"{'commands':>16} {'orders':>8} {'seconds':>8} {'orders/s':>10} {'published':>10}")
+    for name, many in (("Allocate", 1), ("AllocateMany", MANY)):
+        db = InMemoryDatabase()
+        bus = messagebus.MessageBus(lambda: InMemoryUnitOfWork(db), messagebus.command_handlers(), {})
+        skus = await seed(bus)
+        orders = [commands.Allocate(uuid4(), random.choice(skus), 1) for _ in range(ORDERS)]
+        if many == 1:
+            replayed: list[commands.Command] = list(orders)
+        else:
+            replayed = [commands.AllocateMany(orders[i : i + many]) for i in range(0, ORDERS, many)]
+        start = time.perf_counter()
+        await bus.handle_many(replayed)
+        elapsed = time.perf_counter() - start
+        print(f"{name:>16} {ORDERS:>8} {elapsed:>8.2f} {ORDERS / elapsed:>10.0f} {len(db.messages):>10}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,83 @@
+"""Bytes per allocation held in memory, traced with tracemalloc.
+
+Domain objects are measured unmapped, then a product with ALLOCATIONS allocations over BATCHES batches is loaded
+from PG_DSN: get loads no allocation, get_by_batch_id loads the ones of a single batch.
+Mapped classes can not be slotted: SQLAlchemy instruments their attributes and keeps its state on the instance.
+"""
+import asyncio
+import gc
+import tracemalloc
+from collections.abc import Awaitable, Callable
+from dataclasses import dataclass
+from typing import Any
+from uuid import UUID, uuid4
+
+from app.allocation.adapters.db import ENGINE, SESSION_FACTORY
+from app.allocation.adapters.orm import metadata, start_mappers
+from app.allocation.adapters.repository import PGProductRepository
+from app.allocation.domain import events, models
+from benchmarks.bench_repository import BATCHES, seed
+
+ALLOCATIONS = 10_000
+
+
+@dataclass
+class DictAllocated:
+    """events.Allocated as it was before it was slotted."""
+
+    order_id: UUID
+    sku: str
+    qty: int
+    batch_id: UUID
+
+
+async def traced(create: Callable[[], Awaitable[Any]]) -> int:
+    gc.collect()
+    tracemalloc.start()
+    objects = await create()
+    gc.collect()
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del objects
+    return size
+
+
+async def main() -> None:
+    sku, batch_id = "BENCH-SKU", uuid4()
+
+    async def orders() -> list[models.Order]:
+        return [models.Order(sku=sku, qty=1) for _ in range(ALLOCATIONS)]
+
+    async def dict_events() -> list[DictAllocated]:
+        return [DictAllocated(uuid4(), sku, 1, batch_id) for _ in range(ALLOCATIONS)]
+
+    async def slotted_events() -> list[events.Allocated]:
+        return [events.Allocated(uuid4(), sku, 1, batch_id) for _ in range(ALLOCATIONS)]
+
+    print(f"{'objects':>28} {'allocations':>12} {'bytes per allocation':>21}")
+    rows = {
+        "Order, unmapped": orders,
+        "Allocated event, __dict__": dict_events,
+        "Allocated event, slots": slotted_events,
+    }
+    for name, create in rows.items():
+        print(f"{name:>28} {ALLOCATIONS:>12} {await traced(create) / ALLOCATIONS:>21.0f}")
+
+    start_mappers()
+    async with ENGINE.begin() as conn:
+        await conn.run_sync(metadata.create_all)
+    sku, batch_id = await seed(ALLOCATIONS)
+    loads = {
+        "product, get": (lambda: PGProductRepository(SESSION_FACTORY()).get(sku), ALLOCATIONS),
+        "product, get_by_batch_id": (
+            lambda: PGProductRepository(SESSION_FACTORY()).get_by_batch_id(batch_id),
+            ALLOCATIONS // BATCHES,
+        ),
+    }
+    for name, (load, loaded) in loads.items():
+        print(f"{name:>28} {loaded:>12} {await traced(load) / loaded:>21.0f}")
+        await SESSION_FACTORY.remove()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,91 @@
+"""A batch quantity change deallocating ORDERS orders against PG_DSN, reallocated like the worker does.
+
+per event: ChangeBatchQuantity publishes one Deallocated per order, and the worker deletes the order and runs
+AllocateCmdHandler for each of them. bulk: ChangeBatchQuantity reallocates them in its own unit of work.
+"""
+import asyncio
+import time
+from datetime import date
+from uuid import UUID, uuid4
+
+import sqlalchemy as sa
+
+from app.allocation.adapters.db import ENGINE, SESSION_FACTORY
+from app.allocation.adapters.orm import metadata, outbox_table, start_mappers
+from app.allocation.adapters.outbox import RELAY_LOCK_ID
+from app.allocation.domain import commands
+from app.allocation.service_layer import handlers, unit_of_work
+
+ORDERS = (100, 1_000)
+
+
+async def seed(orders: int) -> tuple[str, UUID]:
+    sku = f"BENCH-{uuid4()}"
+    shrinking, spare = uuid4(), uuid4()
+    uow = unit_of_work.PGUnitOfWork()
+    await handlers.CreateBatchCmdHandler(uow).handle(commands.CreateBatch(shrinking, sku, orders, None))
+    await handlers.AllocateManyCmdHandler(uow).handle(
+        commands.AllocateMany([commands.Allocate(uuid4(), sku, 1) for _ in range(orders)])
+    )
+    await handlers.CreateBatchCmdHandler(uow).handle(commands.CreateBatch(spare, sku, orders, date.today()))
+    return sku, shrinking
+
+
+async def per_event(sku: str, batch_id: UUID) -> None:
+    session = SESSION_FACTORY()
+    result = await session.execute(
+        sa.text('SELECT o.id, o.qty FROM allocation a JOIN "order" o ON o.id = a.order_id WHERE a.batch_id = :id'),
+        dict(id=batch_id),
+    )
+    deallocated = result.all()
+    await SESSION_FACTORY.remove()
+    await handlers.ChangeBatchQuantityCmdHandler(unit_of_work.PGUnitOfWork()).handle(
+        commands.ChangeBatchQuantity(batch_id, 0)
+    )
+    for order_id, qty in deallocated:
+        session = SESSION_FACTORY()
+        await session.execute(sa.text('DELETE FROM "order" WHERE id = :id'), dict(id=order_id))
+        await session.commit()
+        await SESSION_FACTORY.remove()
+        await handlers.AllocateCmdHandler(unit_of_work.PGUnitOfWork()).handle(commands.Allocate(order_id, sku, qty))
+
+
+async def bulk(sku: str, batch_id: UUID) -> None:
+    await handlers.ChangeBatchQuantityCmdHandler(unit_of_work.PGUnitOfWork(), reallocate=True).handle(
+        commands.ChangeBatchQuantity(batch_id, 0)
+    )
+
+
+async def main() -> None:
+    start_mappers()
+    async with ENGINE.begin() as conn:
+        await conn.run_sync(metadata.create_all)
+    statements: list[str] = []
+    sa.event.listen(ENGINE.sync_engine, "before_cursor_execute", lambda *args: statements.append(args[2]))
+
+    # keep a running worker from relaying the Deallocated events and reallocating the orders itself
+    async with ENGINE.connect() as lock:
+        await lock.execute(sa.select(sa.func.pg_advisory_lock(sa.literal(RELAY_LOCK_ID, sa.BigInteger))))
+        try:
+            await run(statements)
+        finally:
+            async with ENGINE.begin() as conn:
+                await conn.execute(outbox_table.delete().where(outbox_table.c.key.startswith("BENCH-")))
+            await lock.execute(sa.select(sa.func.pg_advisory_unlock(sa.literal(RELAY_LOCK_ID, sa.BigInteger))))
+
+
+async def run(statements: list[str]) -> None:
+    print(f"{'orders':>8} {'mode':>10} {'statements':>11} {'commits':>8} {'ms':>9}")
+    for orders in ORDERS:
+        for name, reallocate in (("per event", per_event), ("bulk", bulk)):
+            sku, batch_id = await seed(orders)
+            del statements[:]
+            start = time.perf_counter()
+            await reallocate(sku, batch_id)
+            elapsed = time.perf_counter() - start
+            commits = sum(1 for statement in statements if statement.startswith("UPDATE product"))
+            print(f"{orders:>8} {name:>10} {len(statements):>11} {commits:>8} {elapsed * 1000:>9.1f}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
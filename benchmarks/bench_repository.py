@@ -0,0 +1,98 @@
+"""Statements and time per product load against PG_DSN, eager loading every allocation vs PGProductRepository.
+
+The product has BATCHES batches sharing ALLOCATIONS allocations.
+"""
+import asyncio
+import time
+from collections.abc import Awaitable, Callable
+from typing import Any
+from uuid import UUID, uuid4
+
+import sqlalchemy as sa
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import selectinload, subqueryload
+
+from app.allocation.adapters.db import ENGINE, SESSION_FACTORY
+from app.allocation.adapters.orm import metadata, start_mappers
+from app.allocation.adapters.repository import PGProductRepository
+from app.allocation.domain import models
+
+BATCHES = 10
+ALLOCATIONS = (0, 100, 1_000, 10_000)
+NUMBER = 20
+
+
+async def eager_get(session: AsyncSession, sku: str) -> models.Product:
+    result = await session.execute(
+        sa.select(models.Product)
+        .where(models.Product.sku == sku)
+        .options(selectinload(models.Product.batches).options(selectinload(models.Batch.allocations)))
+    )
+    return result.scalar_one()
+
+
+async def eager_get_by_batch_id(session: AsyncSession, batch_id: UUID) -> models.Product:
+    result = await session.execute(
+        sa.select(models.Product)
+        .where(models.Product.batches.any(models.Batch.id == batch_id))  # type: ignore
+        .options(subqueryload(models.Product.batches).options(subqueryload(models.Batch.allocations)))
+    )
+    return result.scalar_one()
+
+
+async def seed(allocations: int) -> tuple[str, UUID]:
+    sku = f"BENCH-{uuid4()}"
+    batches = [models.Batch(sku=sku, qty=allocations + 1) for _ in range(BATCHES)]
+    session = SESSION_FACTORY()
+    session.add(models.Product(sku=sku, batches=batches))
+    for i in range(allocations):
+        batches[i % BATCHES].allocate(models.Order(sku=sku, qty=1))
+    batch_id = batches[0].id
+    await session.commit()
+    await SESSION_FACTORY.remove()
+    return sku, batch_id
+
+
+async def measure(load: Callable[[AsyncSession], Awaitable[Any]], statements: list[str]) -> tuple[int, float]:
+    elapsed = 0.0
+    for _ in range(NUMBER):
+        session = SESSION_FACTORY()
+        del statements[:]
+        start = time.perf_counter()
+        await load(session)
+        elapsed += time.perf_counter() - start
+        await SESSION_FACTORY.remove()
+    return len(statements), elapsed / NUMBER
+
+
+async def main() -> None:
+    start_mappers()
+    async with ENGINE.begin() as conn:
+        await conn.run_sync(metadata.create_all)
+    statements: list[str] = []
+    sa.event.listen(ENGINE.sync_engine, "before_cursor_execute", lambda *args: statements.append(args[2]))
+
+    print(f"{'allocations':>12} {'load':>16} {'eager stmts':>12} {'eager ms':>9} {'repo stmts':>11} {'repo ms':>8}")
+    for allocations in ALLOCATIONS:
+        sku, batch_id = await seed(allocations)
+        loads = {
+            "get": (
+                lambda session: eager_get(session, sku),
+                lambda session: PGProductRepository(session).get(sku),
+            ),
+            "get_by_batch_id": (
+                lambda session: eager_get_by_batch_id(session, batch_id),
+                lambda session: PGProductRepository(session).get_by_batch_id(batch_id),
+            ),
+        }
+        for name, (eager, repo) in loads.items():
+            eager_statements, eager_elapsed = await measure(eager, statements)
+            repo_statements, repo_elapsed = await measure(repo, statements)
+            print(
+                f"{allocations:>12} {name:>16} {eager_statements:>12} {eager_elapsed * 1000:>9.1f}"
+                f" {repo_statements:>11} {repo_elapsed * 1000:>8.1f}"
+            )
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
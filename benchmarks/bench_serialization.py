@@ -0,0 +1,63 @@
+"""Serializing ROWS allocations into a JSON response body, rows per second.
+
+pydantic: rows fetched with UUID ids, validated into the Allocation model and dumped through .dict().
+jsonable_encoder: the same models encoded by FastAPI's default path, as returning them from an endpoint would.
+dao rows: rows fetched with text ids and dumped as they are, as dao.allocations now returns them.
+"""
+import json
+import timeit
+from typing import Any
+from uuid import UUID, uuid4
+
+import orjson
+from fastapi.encoders import jsonable_encoder
+from pydantic import BaseModel
+
+ROWS = 10_000
+NUMBER = 20
+
+
+class PydanticAllocation(BaseModel):
+    """dto.Allocation as it was, a pydantic model."""
+
+    order_id: UUID
+    sku: str
+    qty: int
+    batch_id: UUID
+
+
+def pydantic(rows: list[dict[str, Any]]) -> bytes:
+    allocations = [PydanticAllocation(**row) for row in rows]
+    return orjson.dumps([allocation.dict() for allocation in allocations], default=str)
+
+
+def fastapi_default(rows: list[dict[str, Any]]) -> bytes:
+    allocations = [PydanticAllocation(**row) for row in rows]
+    return json.dumps(jsonable_encoder(allocations)).encode()
+
+
+def dao_rows(rows: list[dict[str, Any]]) -> bytes:
+    return orjson.dumps(rows)
+
+
+def main() -> None:
+    batch_id = uuid4()
+    order_ids = [uuid4() for _ in range(ROWS)]
+    uuid_rows: list[dict[str, Any]] = [
+        dict(order_id=order_id, sku="BENCH-SKU", qty=1, batch_id=batch_id) for order_id in order_ids
+    ]
+    text_rows: list[dict[str, Any]] = [
+        dict(order_id=str(order_id), sku="BENCH-SKU", qty=1, batch_id=str(batch_id)) for order_id in order_ids
+    ]
+    print(f"{'path':>18} {'ms per response':>16} {'rows/s':>12}")
+    for name, serialize, rows in (
+        ("jsonable_encoder", fastapi_default, uuid_rows),
+        ("pydantic", pydantic, uuid_rows),
+        ("dao rows", dao_rows, text_rows),
+    ):
+        elapsed = timeit.timeit(lambda: serialize(rows), number=NUMBER) / NUMBER
+        print(f"{name:>18} {elapsed * 1000:>16.2f} {ROWS / elapsed:>12.0f}")
+
+
+if __name__ == "__main__":
+    main()
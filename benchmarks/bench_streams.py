@@ -0,0 +1,62 @@
+"""Worker throughput against a local Redis (REDIS_DSN) for an increasing number of stream consumers.
+
+Each message costs HANDLER_LATENCY of simulated I/O, like a read model write. Consumers own one partition each,
+so throughput scales with the number of partitions while messages of one sku stay ordered.
+"""
+import asyncio
+import time
+from uuid import uuid4
+
+from app.allocation.adapters import stream
+from app.allocation.adapters.redis import Redis
+from app.config import config
+
+STREAM = "bench:events"
+CHANNEL = "bench:order_allocated"
+GROUP = "bench"
+MESSAGES = 2_000
+SKUS = 64
+HANDLER_LATENCY = 0.001
+
+
+async def bench(redis: Redis, consumers: int) -> float:
+    streams = [stream.stream_name(STREAM, p) for p in range(consumers)]
+    await redis.delete(*streams)
+    pipe = redis.pipeline()
+    for i in range(MESSAGES):
+        stream.xadd(pipe, CHANNEL, f"SKU-{i % SKUS}", str(uuid4()).encode(), stream=STREAM, partitions=consumers)
+    await pipe.execute()
+
+    handled = 0
+    done = asyncio.Event()
+
+    async def handler(channel: str, data: bytes) -> None:
+        nonlocal handled
+        await asyncio.sleep(HANDLER_LATENCY)
+        handled += 1
+        if handled == MESSAGES:
+            done.set()
+
+    start = time.perf_counter()
+    tasks = [
+        asyncio.create_task(stream.StreamConsumer(redis, GROUP, STREAM, p, handler).run()) for p in range(consumers)
+    ]
+    await done.wait()
+    elapsed = time.perf_counter() - start
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    await redis.delete(*streams)
+    return MESSAGES / elapsed
+
+
+async def main() -> None:
+    redis = Redis.from_url(config.REDIS_DSN)
+    print(f"{'consumers':>10} {'messages/s':>12}")
+    for consumers in (1, 2, 4, 8):
+        print(f"{consumers:>10} {await bench(redis, consumers):>12.0f}")
+    await redis.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
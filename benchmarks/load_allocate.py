@@ -0,0 +1,73 @@
+"""Concurrent POST /allocate calls against one sku, in process against PG_DSN.
+
+Every allocation bumps the product's version_number, so all but one of the requests racing on the sku conflict
+at commit, unless they are coalesced by a per-sku owner. Goodput counts successful allocations per second;
+p99 is over all requests.
+"""
+import asyncio
+import statistics
+import time
+from collections import Counter
+from uuid import uuid4
+
+from httpx import AsyncClient
+
+from app.allocation.adapters.db import ENGINE
+from app.allocation.adapters.orm import metadata
+from app.allocation.entrypoints.restapi import app
+from app.allocation.service_layer import unit_of_work
+from app.config import config
+
+REQUESTS = 200
+CONCURRENCY = (20, 200)
+# (coalescing, retry limit)
+MODES = ((False, 0), (False, 5), (False, 10), (True, 5))
+
+
+async def bench(client: AsyncClient, concurrency: int) -> tuple[Counter[int], list[float], float]:
+    sku = f"LOAD-{uuid4()}"
+    await client.post("/batches", json={"sku": sku, "quantity": REQUESTS})
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies: list[float] = []
+    statuses: Counter[int] = Counter()
+
+    async def allocate() -> None:
+        async with semaphore:
+            start = time.perf_counter()
+            res = await client.post("/allocate", json={"sku": sku, "quantity": 1})
+            latencies.append(time.perf_counter() - start)
+            statuses[res.status_code] += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(allocate() for _ in range(REQUESTS)))
+    return statuses, latencies, time.perf_counter() - start
+
+
+def _conflicts() -> float:
+    return sum(unit_of_work.CONCURRENCY_CONFLICTS.value(operation=op) for op in ("allocate", "allocate_many"))
+
+
+async def main() -> None:
+    async with ENGINE.begin() as conn:
+        await conn.run_sync(metadata.create_all)
+    print(
+        f"{'concurrency':>12} {'coalescing':>11} {'retries':>8} {'201':>6} {'409':>6} {'conflicts':>10}"
+        f" {'goodput/s':>10} {'p99 ms':>8}"
+    )
+    async with AsyncClient(app=app, base_url="http://testserver") as client:
+        for concurrency in CONCURRENCY:
+            for coalescing, limit in MODES:
+                config.ALLOCATION_COALESCING = coalescing
+                config.OCC_RETRY_LIMIT = limit
+                conflicts = _conflicts()
+                statuses, latencies, elapsed = await bench(client, concurrency)
+                conflicts = _conflicts() - conflicts
+                p99 = statistics.quantiles(latencies, n=100)[98] * 1000
+                print(
+                    f"{concurrency:>12} {coalescing!s:>11} {limit:>8} {statuses[201]:>6} {statuses[409]:>6}"
+                    f" {conflicts:>10.0f} {statuses[201] / elapsed:>10.0f} {p99:>8.0f}"
+                )
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,238 @@
+"""The benchmark suite of the allocation service, written as JSON to compare runs between commits.
+
+    python -m benchmarks.suite --output results.json [--only domain repository api]
+    python -m benchmarks.suite --compare before.json after.json
+
+Repository and API benchmarks run against PG_DSN and REDIS_DSN: the docker-compose services, or any local
+Postgres and Redis stand-in. The API is driven in process through httpx. Mappers are started like in the app, so
+domain objects are measured as the app uses them. Every metric is lower-is-better.
+"""
+import argparse
+import asyncio
+import datetime
+import gc
+import json
+import platform
+import statistics
+import subprocess
+import sys
+import time
+import timeit
+from collections import Counter
+from collections.abc import Awaitable, Callable
+from datetime import date, timedelta
+from typing import Any, NamedTuple
+from uuid import uuid4
+
+import sqlalchemy as sa
+from httpx import AsyncClient
+
+from app.allocation.adapters.db import ENGINE
+from app.allocation.adapters.orm import metadata
+from app.allocation.adapters.repository import PGProductRepository
+from app.allocation.domain.models import DEALLOCATION_STRATEGIES, Batch, Order, Product
+from app.allocation.entrypoints.dependencies import allocations_view_cache
+from app.allocation.entrypoints.restapi import app
+from benchmarks import bench_repository
+
+NUMBER = 1_000
+# domain timings are the best of REPEAT runs, like timeit.repeat
+REPEAT = 5
+ALLOCATIONS = 10_000
+REQUESTS = 100
+CONCURRENCY = (1, 20)
+VIEW_ROWS = 1_000
+
+
+class Result(NamedTuple):
+    name: str
+    value: float
+    unit: str
+
+
+def domain() -> list[Result]:
+    results = []
+    batch = Batch(sku="BENCH-SKU", qty=ALLOCATIONS * 2)
+    for _ in range(ALLOCATIONS):
+        batch.allocate(Order(sku="BENCH-SKU", qty=1))
+    elapsed = min(timeit.repeat(lambda: batch.available_quantity, number=NUMBER, repeat=REPEAT)) / NUMBER
+    results.append(Result(f"domain.batch_available_quantity[allocations={ALLOCATIONS}]", elapsed * 1e9, "ns"))
+
+    batches = [Batch(sku="BENCH-SKU", qty=0, eta=date.today() + timedelta(days=i)) for i in range(1_000)]
+    batches.append(Batch(sku="BENCH-SKU", qty=NUMBER * REPEAT, eta=date.today() + timedelta(days=1_000)))
+    product = Product(sku="BENCH-SKU", batches=batches)
+    allocate = lambda: product.allocate(Order(sku="BENCH-SKU", qty=1))  # noqa: E731
+    elapsed = min(timeit.repeat(allocate, number=NUMBER, repeat=REPEAT)) / NUMBER
+    results.append(Result("domain.product_allocate[batches=1000]", elapsed * 1e6, "us"))
+
+    orders = [Order(sku="BENCH-SKU", qty=qty % 100 + 1) for qty in range(ALLOCATIONS)]
+    allocated = sum(order.qty for order in orders)
+    for name, strategy in DEALLOCATION_STRATEGIES.items():
+        timings = []
+        for _ in range(REPEAT):
+            batch = Batch(sku="BENCH-SKU", qty=allocated, allocations=set(orders))
+            product = Product(sku="BENCH-SKU", batches=[batch])
+            gc.disable()
+            start = time.perf_counter()
+            product.change_batch_quantity(batch.id, allocated * 95 // 100, strategy)
+            timings.append(time.perf_counter() - start)
+            gc.enable()
+        elapsed = min(timings)
+        results.append(
+            Result(f"domain.change_batch_quantity[allocations={ALLOCATIONS},strategy={name}]", elapsed * 1e3, "ms")
+        )
+    return results
+
+
+async def repository() -> list[Result]:
+    sku, batch_id = await bench_repository.seed(ALLOCATIONS)
+    statements: list[str] = []
+    loads: dict[str, Callable[[Any], Awaitable[Any]]] = {
+        "get": lambda session: PGProductRepository(session).get(sku),
+        "get_by_batch_id": lambda session: PGProductRepository(session).get_by_batch_id(batch_id),
+    }
+    results = []
+    for name, load in loads.items():
+        _, elapsed = await bench_repository.measure(load, statements)
+        results.append(Result(f"repository.{name}[allocations={ALLOCATIONS}]", elapsed * 1e3, "ms"))
+    return results
+
+
+async def _load(call: Callable[[], Awaitable[Any]], requests: int, concurrency: int) -> tuple[float, float]:
+    """Seconds the requests took, and the p99 latency of a request."""
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies: list[float] = []
+
+    async def timed() -> None:
+        async with semaphore:
+            start = time.perf_counter()
+            await call()
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(timed() for _ in range(requests)))
+    return time.perf_counter() - start, statistics.quantiles(latencies, n=100)[98]
+
+
+async def api() -> list[Result]:
+    results = []
+    async with AsyncClient(app=app, base_url="http://testserver") as client:
+        for concurrency in CONCURRENCY:
+            sku = f"BENCH-{uuid4()}"
+            await client.post("/batches", json={"sku": sku, "quantity": REQUESTS})
+            statuses: Counter[int] = Counter()
+
+            async def allocate() -> None:
+                res = await client.post("/allocate", json={"sku": sku, "quantity": 1})
+                statuses[res.status_code] += 1
+
+            elapsed, p99 = await _load(allocate, REQUESTS, concurrency)
+            name = f"api.allocate[concurrency={concurrency}]"
+            # 409s are allocations that lost too many races on the product's version
+            results.append(Result(name, elapsed / max(1, statuses[201]) * 1e3, "ms/allocation"))
+            results.append(Result(f"{name}.p99", p99 * 1e3, "ms"))
+            results.append(Result(f"{name}.rejected", (REQUESTS - statuses[201]) / REQUESTS, "ratio"))
+
+        sku = await _seed_allocations_view(VIEW_ROWS)
+        cache = allocations_view_cache()
+
+        async def read(cached: bool) -> None:
+            if not cached:
+                await cache.invalidate(sku)
+            res = await client.get(f"/allocations/{sku}")
+            res.raise_for_status()
+
+        for cached in (False, True):
+            elapsed, _ = await _load(lambda: read(cached), REQUESTS, 1)
+            name = f"api.allocations[rows={VIEW_ROWS},cached={cached}]"
+            results.append(Result(name, elapsed / REQUESTS * 1e3, "ms/request"))
+        await cache.invalidate(sku)
+    return results
+
+
+async def _seed_allocations_view(rows: int) -> str:
+    sku = f"BENCH-{uuid4()}"
+    order_ids = [uuid4() for _ in range(rows)]
+    async with ENGINE.begin() as conn:
+        await conn.execute(
+            sa.text('INSERT INTO "order" (id, sku, qty) VALUES (:id, :sku, 1)'),
+            [dict(id=order_id, sku=sku) for order_id in order_ids],
+        )
+        await conn.execute(
+            sa.text("INSERT INTO allocations_view (order_id, sku, batch_id) VALUES (:order_id, :sku, :batch_id)"),
+            [dict(order_id=order_id, sku=sku, batch_id=uuid4()) for order_id in order_ids],
+        )
+    return sku
+
+
+async def run(only: list[str]) -> list[Result]:
+    results = []
+    if "domain" in only:
+        results += domain()
+    if {"repository", "api"} & set(only):
+        async with ENGINE.begin() as conn:
+            await conn.run_sync(metadata.create_all)
+    if "repository" in only:
+        results += await repository()
+    if "api" in only:
+        results += await api()
+    return results
+
+
+def _commit() -> str | None:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(before: dict[str, Any], after: dict[str, Any], threshold: float) -> int:
+    """Print the change of every metric in both runs, returns the number of regressions."""
+    previous = {result["name"]: result["value"] for result in before["results"]}
+    regressions = 0
+    print(f"{'metric':<70} {'before':>10} {'after':>10} {'change':>8}")
+    for result in after["results"]:
+        if result["name"] not in previous:
+            continue
+        value, old = result["value"], previous[result["name"]]
+        change = value / old - 1 if old else 0.0
+        regressed = change > threshold
+        regressions += regressed
+        flag = "  REGRESSION" if regressed else ""
+        print(f"{result['name']:<70} {old:>10.2f} {value:>10.2f} {change:>+8.1%}{flag}")
+    return regressions
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument(
+        "--only", nargs="+", choices=("domain", "repository", "api"), default=["domain", "repository", "api"]
+    )
+    parser.add_argument("--output", help="write the results to this file instead of stdout")
+    parser.add_argument("--compare", nargs=2, metavar=("BEFORE", "AFTER"), help="compare two result files")
+    parser.add_argument(
+        "--threshold", type=float, default=0.1, help="relative growth --compare reports as a regression"
+    )
+    args = parser.parse_args()
+
+    if args.compare:
+        with open(args.compare[0]) as before, open(args.compare[1]) as after:
+            sys.exit(1 if compare(json.load(before), json.load(after), args.threshold) else 0)
+
+    results = asyncio.run(run(args.only))
+    report = {
+        "commit": _commit(),
+        "created_at": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "results": [result._asdict() for result in results],
+    }
+    content = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(content + "\n")
+    else:
+        print(content)
+
+
+if __name__ == "__main__":
+    main()
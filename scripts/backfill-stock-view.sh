@@ -0,0 +1,7 @@
+#!/bin/bash
+
+set -e
+
+poetry install --sync
+
+python app/allocation/entrypoints/backfill_stock_view.py
@@ -3,9 +3,11 @@ from collections.abc import AsyncGenerator, Generator
 from typing import Any
 
 import pytest
+import sqlalchemy as sa
 from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession, create_async_engine
 
 from app.allocation.adapters.orm import metadata
+from app.allocation.adapters.outbox import RELAY_LOCK_ID
 from app.config import config
 
 
@@ -35,3 +37,11 @@ async def session(engine: AsyncEngine) -> AsyncGenerator[AsyncSession, Any]:
     yield session
     await session.close()
     await trans.rollback()
+
+
+@pytest.fixture
+async def paused_outbox_relay(engine: AsyncEngine) -> AsyncGenerator[None, Any]:
+    # keep the worker from draining the outbox while the test looks at it
+    async with engine.begin() as conn:
+        await conn.execute(sa.select(sa.func.pg_advisory_xact_lock(sa.literal(RELAY_LOCK_ID, sa.BigInteger))))
+        yield
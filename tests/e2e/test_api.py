@@ -4,14 +4,18 @@ from datetime import date
 from typing import Any
 from uuid import UUID, uuid4
 
+import orjson
 import pytest
 import sqlalchemy as sa
 from httpx import AsyncClient
+from pytest_mock import MockerFixture
 from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession
 from sqlalchemy.orm import sessionmaker
 
+from app.allocation.adapters import instrumentation
 from app.allocation.adapters.orm import metadata
 from app.allocation.entrypoints.restapi import app
+from app.config import config
 
 
 @pytest.fixture
@@ -89,3 +93,109 @@ async def test_allocate_api_returns_400_and_error_message_if_invalid_sku(
     # Then: status code 400 and error message
     assert res1.status_code == 400
     assert res1.json() == {"detail": "Invalid sku NOT-EXIST-SKU"}
+
+
+async def test_allocate_bulk_api_returns_result_per_line(session: AsyncSession, client: AsyncClient) -> None:
+    # Given
+    await session.execute(sa.text("INSERT INTO product (sku, version_number) VALUES " "('SKU', 1)"))
+    await session.execute(
+        sa.text("INSERT INTO batch (id, sku, qty, eta) " "VALUES (:id, :sku, :qty, :eta)"),
+        dict(id=UUID("f6e16413-441e-40c0-b2eb-e826b080b448"), sku="SKU", qty=5, eta=None),
+    )
+    await session.commit()
+
+    # When
+    res = await client.post(
+        "/allocate/bulk",
+        json={
+            "lines": [
+                {"sku": "SKU", "quantity": 3},
+                {"sku": "SKU", "quantity": 3},
+                {"sku": "NOT-EXIST-SKU", "quantity": 3},
+            ]
+        },
+    )
+
+    # Then: lines are answered in request order
+    assert res.status_code == 201
+    assert [(line["sku"], line["batch_id"], line["status"]) for line in res.json()] == [
+        ("SKU", "f6e16413-441e-40c0-b2eb-e826b080b448", "allocated"),
+        ("SKU", None, "out_of_stock"),
+        ("NOT-EXIST-SKU", None, "invalid_sku"),
+    ]
+    [[version]] = await session.execute(sa.text("SELECT version_number FROM product WHERE sku = 'SKU'"))
+    assert version == 2
+
+
+async def test_allocate_api_coalesces_concurrent_allocations(
+    session: AsyncSession, client: AsyncClient, mocker: MockerFixture
+) -> None:
+    # Given
+    mocker.patch.object(config, "ALLOCATION_COALESCING", True)
+    mocker.patch.object(config, "ALLOCATION_COALESCING_IDLE_MS", 10)
+    await session.execute(sa.text("INSERT INTO product (sku, version_number) VALUES " "('SKU', 1)"))
+    await session.execute(
+        sa.text("INSERT INTO batch (id, sku, qty, eta) " "VALUES (:id, :sku, :qty, :eta)"),
+        dict(id=UUID("f6e16413-441e-40c0-b2eb-e826b080b448"), sku="SKU", qty=100, eta=None),
+    )
+    await session.commit()
+
+    # When
+    responses = await asyncio.gather(*(client.post("/allocate", json={"sku": "SKU", "quantity": 1}) for _ in range(20)))
+
+    # Then: every allocation succeeds without racing on the product's version
+    assert [res.status_code for res in responses] == [201] * 20
+    [[allocated]] = await session.execute(sa.text("SELECT count(*) FROM allocation"))
+    assert allocated == 20
+    [[version]] = await session.execute(sa.text("SELECT version_number FROM product WHERE sku = 'SKU'"))
+    assert version < 21
+
+
+async def test_allocations_are_paginated_and_streamed(session: AsyncSession, client: AsyncClient) -> None:
+    # Given
+    order_ids = sorted(uuid4() for _ in range(3))
+    for order_id in order_ids:
+        await session.execute(
+            sa.text("INSERT INTO allocations_view (order_id, sku, batch_id) VALUES (:order_id, 'SKU', :batch_id)"),
+            dict(order_id=order_id, batch_id=uuid4()),
+        )
+        await session.execute(
+            sa.text("INSERT INTO \"order\" (id, sku, qty) VALUES (:order_id, 'SKU', 1)"), dict(order_id=order_id)
+        )
+    await session.commit()
+
+    # When: following the next links
+    pages = []
+    url = "/allocations/SKU?limit=2"
+    while url:
+        res = await client.get(url)
+        pages.append([allocation["order_id"] for allocation in res.json()])
+        url = res.links.get("next", {}).get("url")
+
+    # Then
+    assert pages == [[str(order_ids[0]), str(order_ids[1])], [str(order_ids[2])]]
+
+    # When: streaming
+    res = await client.get("/allocations/SKU/stream")
+
+    # Then
+    assert res.headers["content-type"] == "application/x-ndjson"
+    rows = [orjson.loads(line) for line in res.text.splitlines()]
+    assert sorted(row["order_id"] for row in rows) == [str(order_id) for order_id in order_ids]
+    assert (await client.get("/allocations/UNKNOWN/stream")).status_code == 404
+
+
+async def test_allocate_is_instrumented(session: AsyncSession, client: AsyncClient) -> None:
+    # Given
+    await client.post("/batches", json={"sku": "SKU", "quantity": 10})
+    handled = instrumentation.HANDLER_SECONDS.count(handler="AllocateCmdHandler")
+    requests = instrumentation.QUERIES.count(operation="allocate")
+
+    # When
+    await client.post("/allocate", json={"sku": "SKU", "quantity": 1})
+
+    # Then
+    assert instrumentation.HANDLER_SECONDS.count(handler="AllocateCmdHandler") == handled + 1
+    assert instrumentation.QUERIES.count(operation="allocate") == requests + 1
+    res = await client.get("/metrics")
+    assert 'allocation_uow_duration_seconds_count{operation="commit"}' in res.text
@@ -1,16 +1,22 @@
+import asyncio
 from collections.abc import AsyncGenerator
 from typing import Any
 
 import orjson
 import pytest
-from httpx import AsyncClient
-from redis.asyncio.client import PubSub
+from httpx import AsyncClient, Response
 from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession
 from sqlalchemy.orm import sessionmaker
 
+from app.allocation.adapters import stream
 from app.allocation.adapters.orm import metadata
 from app.allocation.adapters.redis import Redis
-from app.allocation.constants import BATCH_QUANTITY_CHANGED_CHANNEL, ORDER_ALLOCATED_CHANNEL, ORDER_DEALLOCATED_CHANNEL
+from app.allocation.constants import (
+    ALLOCATION_STREAM,
+    BATCH_QUANTITY_CHANGED_CHANNEL,
+    ORDER_ALLOCATED_CHANNEL,
+    ORDER_DEALLOCATED_CHANNEL,
+)
 from app.allocation.entrypoints.restapi import app
 from app.config import config
 
@@ -40,7 +46,7 @@ async def session(engine: AsyncEngine) -> AsyncGenerator[AsyncSession, Any]:
 
 
 @pytest.fixture(autouse=True)
-async def clear_db(engine: AsyncEngine) -> AsyncGenerator[AsyncEngine, Any]:
+async def clear_db(engine: AsyncEngine, rc: Redis) -> AsyncGenerator[AsyncEngine, Any]:
     yield engine
     async with engine.begin() as conn:
         for table in reversed(metadata.sorted_tables):
@@ -53,7 +59,7 @@ async def test_allocate_leading_to_add_row_to_allocations_view(client: AsyncClie
 
     # When: allocate order
     allocate_res = await client.post("/allocate", json={"sku": "SKU", "quantity": 10})
-    view_res = await client.get("/allocations/SKU")
+    view_res = await _wait_for_allocations(client, "SKU", 1)
 
     # Then: order is allocated. and allocations_view returns the allocation
     assert allocate_res.status_code == 201
@@ -64,40 +70,112 @@ async def test_allocate_leading_to_add_row_to_allocations_view(client: AsyncClie
     assert view_res.json()[0]["qty"] == 10
 
 
+async def test_allocate_invalidates_cached_allocations_view(client: AsyncClient) -> None:
+    # Given: allocations_view is cached
+    await _create_two_batches(client)
+    await client.post("/allocate", json={"sku": "SKU", "quantity": 1})
+    assert len((await _wait_for_allocations(client, "SKU", 1)).json()) == 1
+
+    # When
+    await client.post("/allocate", json={"sku": "SKU", "quantity": 1})
+
+    # Then
+    view_res = await _wait_for_allocations(client, "SKU", 2)
+    assert len(view_res.json()) == 2
+
+
 async def test_change_batch_quantity_leading_to_reallocation(client: AsyncClient, rc: Redis) -> None:
-    # Given: create batch and subscribe redis channels
+    # Given: create batch
     earlist_batch_id, latest_batch_id = await _create_two_batches(client)
     await client.post("/allocate", json={"sku": "SKU", "quantity": 10})
-    pubsub = await _subscribe(rc)
 
     # When
-    await rc.publish(
+    await stream.xadd(
+        rc,
+        BATCH_QUANTITY_CHANGED_CHANNEL,
+        earlist_batch_id,
+        orjson.dumps({"id": earlist_batch_id, "qty": 5}),
+    )
+
+    # Then: the order is deallocated and then reallocated to the other batch
+    [_, _, allocated, _, deallocated, reallocated] = await _wait_for_messages(rc, "SKU", 6)
+    assert allocated[0] == ORDER_ALLOCATED_CHANNEL
+    assert deallocated[0] == ORDER_DEALLOCATED_CHANNEL
+    assert deallocated[1]["sku"] == "SKU"
+    assert deallocated[1]["qty"] == 10
+    assert reallocated[0] == ORDER_ALLOCATED_CHANNEL
+    assert reallocated[1]["sku"] == "SKU"
+    assert reallocated[1]["qty"] == 10
+    assert reallocated[1]["batch_id"] == latest_batch_id
+
+
+async def test_redelivered_deallocation_keeps_the_reallocation(client: AsyncClient, rc: Redis) -> None:
+    # Given: an order deallocated and reallocated to the other batch
+    earlist_batch_id, latest_batch_id = await _create_two_batches(client)
+    await client.post("/allocate", json={"sku": "SKU", "quantity": 10})
+    await stream.xadd(
+        rc,
         BATCH_QUANTITY_CHANGED_CHANNEL,
+        earlist_batch_id,
         orjson.dumps({"id": earlist_batch_id, "qty": 5}),
     )
+    [*_, (_, deallocated), _] = await _wait_for_messages(rc, "SKU", 6)
+
+    # When: the deallocation is delivered again
+    await stream.xadd(rc, ORDER_DEALLOCATED_CHANNEL, "SKU", orjson.dumps(deallocated))
+    await asyncio.sleep(0.5)
+
+    # Then: the order is not allocated again, and stays allocated to the other batch
+    assert len(await _wait_for_messages(rc, "SKU", 8)) == 7
+    res = await client.get("/stock/SKU")
+    assert [(b["batch_id"], b["allocated"]) for b in res.json()["batches"]] == [
+        (earlist_batch_id, 0),
+        (latest_batch_id, 10),
+    ]
+
+
+async def test_stock_follows_batches_and_allocations(client: AsyncClient) -> None:
+    # Given
+    earlist_batch_id, latest_batch_id = await _create_two_batches(client)
+
+    # When
+    await client.post("/allocate", json={"sku": "SKU", "quantity": 4})
+    await _wait_for_allocations(client, "SKU", 1)
 
     # Then
-    message1 = await pubsub.get_message(timeout=1)
-    message2 = await pubsub.get_message(timeout=1)
-    data1 = orjson.loads(message1["data"])
-    assert message1["channel"].decode() == ORDER_DEALLOCATED_CHANNEL
-    assert data1["sku"] == "SKU"
-    assert data1["qty"] == 10
-    data2 = orjson.loads(message2["data"])
-    assert message2["channel"].decode() == ORDER_ALLOCATED_CHANNEL
-    assert data2["sku"] == "SKU"
-    assert data2["qty"] == 10
-    assert data2["batch_id"] == latest_batch_id
-
-
-async def _subscribe(rc: Redis) -> PubSub:
-    pubsub = rc.pubsub()
-    await pubsub.subscribe(ORDER_ALLOCATED_CHANNEL, ORDER_DEALLOCATED_CHANNEL)
-    confirmation1 = await pubsub.get_message(timeout=1)
-    confirmation2 = await pubsub.get_message(timeout=1)
-    assert confirmation1["type"] == "subscribe"
-    assert confirmation2["type"] == "subscribe"
-    return pubsub
+    res = await client.get("/stock/SKU")
+    assert res.status_code == 200
+    assert res.json() == {
+        "sku": "SKU",
+        "available": 16,
+        "batches": [
+            {"batch_id": earlist_batch_id, "eta": "2021-01-01", "qty": 10, "allocated": 4, "available": 6},
+            {"batch_id": latest_batch_id, "eta": "2021-01-02", "qty": 10, "allocated": 0, "available": 10},
+        ],
+    }
+    assert (await client.get("/stock/UNKNOWN")).status_code == 404
+
+
+async def _wait_for_allocations(client: AsyncClient, sku: str, count: int) -> Response:
+    # events reach the worker through the outbox relay
+    for _ in range(20):
+        res = await client.get(f"/allocations/{sku}")
+        if res.status_code == 200 and len(res.json()) >= count:
+            break
+        await asyncio.sleep(0.1)
+    return res
+
+
+async def _wait_for_messages(rc: Redis, sku: str, count: int) -> list[tuple[str, dict[str, Any]]]:
+    for _ in range(20):
+        entries = await rc.xrange(stream.stream_name(ALLOCATION_STREAM, stream.partition(sku)))
+        messages = [(fields[b"channel"].decode(), orjson.loads(fields[b"data"])) for _, fields in entries]
+        # the batch quantity change may land on the same partition
+        messages = [(channel, data) for channel, data in messages if data.get("sku") == sku]
+        if len(messages) >= count:
+            break
+        await asyncio.sleep(0.1)
+    return messages
 
 
 async def _create_two_batches(client: AsyncClient) -> tuple[str, str]:
@@ -1,10 +1,9 @@
-from uuid import UUID
+from uuid import UUID, uuid4
 
 import sqlalchemy as sa
 from sqlalchemy.ext.asyncio import AsyncSession
 
 from app.allocation.adapters import dao
-from app.allocation.adapters.dto import Allocation
 
 
 async def test_allocations_view(session: AsyncSession) -> None:
@@ -39,10 +38,50 @@ async def test_allocations_view(session: AsyncSession) -> None:
 
     # Then
     assert result == [
-        Allocation(
-            order_id=UUID("b0764de0-5348-47b0-9895-6dabce8e093f"),
-            sku="sku1",
-            qty=22,
-            batch_id=UUID("5ed8a924-d4d7-41c4-af06-0bb85248ed6b"),
-        )
+        {
+            "order_id": "b0764de0-5348-47b0-9895-6dabce8e093f",
+            "sku": "sku1",
+            "qty": 22,
+            "batch_id": "5ed8a924-d4d7-41c4-af06-0bb85248ed6b",
+        }
     ]
+
+
+async def _insert_allocations(session: AsyncSession, sku: str, count: int) -> list[UUID]:
+    order_ids = sorted(uuid4() for _ in range(count))
+    for order_id in order_ids:
+        await session.execute(
+            sa.text("INSERT INTO allocations_view (order_id, sku, batch_id) VALUES (:order_id, :sku, :batch_id)"),
+            dict(order_id=order_id, sku=sku, batch_id=uuid4()),
+        )
+        await session.execute(
+            sa.text('INSERT INTO "order" (id, sku, qty) VALUES (:order_id, :sku, :qty)'),
+            dict(order_id=order_id, sku=sku, qty=1),
+        )
+    return order_ids
+
+
+async def test_allocations_page_continues_after_order_id(session: AsyncSession) -> None:
+    # Given
+    order_ids = await _insert_allocations(session, "sku1", 5)
+    await _insert_allocations(session, "sku2", 1)
+
+    # When
+    first = await dao.allocations_page("sku1", session, limit=3)
+    second = await dao.allocations_page("sku1", session, limit=3, after=UUID(first[-1]["order_id"]))
+
+    # Then
+    assert [allocation["order_id"] for allocation in first] == [str(order_id) for order_id in order_ids[:3]]
+    assert [allocation["order_id"] for allocation in second] == [str(order_id) for order_id in order_ids[3:]]
+
+
+async def test_stream_allocations_in_chunks(session: AsyncSession) -> None:
+    # Given
+    order_ids = await _insert_allocations(session, "sku1", 5)
+
+    # When
+    chunks = [rows async for rows in dao.stream_allocations("sku1", session, size=2)]
+
+    # Then
+    assert [len(rows) for rows in chunks] == [2, 2, 1]
+    assert sorted(row["order_id"] for rows in chunks for row in rows) == [str(order_id) for order_id in order_ids]
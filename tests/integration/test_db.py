@@ -0,0 +1,50 @@
+import sqlalchemy as sa
+from pytest_mock import MockerFixture
+from sqlalchemy.engine import make_url
+
+from app.allocation.adapters import db
+from app.config import config
+
+
+def test_engine_is_shared_per_url() -> None:
+    assert db.engine(config.PG_DSN) is db.ENGINE
+    assert db.DB(config.PG_DSN)._engine is db.ENGINE
+
+
+def test_engine_pool_is_configured(mocker: MockerFixture) -> None:
+    # Given
+    create_async_engine = mocker.patch.object(db, "create_async_engine")
+    mocker.patch.object(db.instrumentation, "instrument_engine")
+
+    # When
+    db.engine.__wrapped__(config.PG_DSN)
+    db.engine.__wrapped__("sqlite+aiosqlite:///:memory:")
+
+    # Then: the pool is built from config, the statement caches are only passed to asyncpg
+    assert isinstance(db.ENGINE.pool, db.InstrumentedAsyncAdaptedQueuePool)
+    pg, sqlite = create_async_engine.call_args_list
+    assert pg.kwargs["pool_size"] == config.PG_POOL_SIZE
+    assert pg.kwargs["max_overflow"] == config.PG_MAX_OVERFLOW
+    assert pg.kwargs["pool_recycle"] == config.PG_POOL_RECYCLE
+    assert pg.kwargs["connect_args"] == {
+        "statement_cache_size": config.PG_STATEMENT_CACHE_SIZE,
+        "prepared_statement_cache_size": config.PG_PREPARED_STATEMENT_CACHE_SIZE,
+    }
+    assert sqlite.kwargs["connect_args"] == {}
+
+
+async def test_pool_exports_checkouts_and_connections_in_use() -> None:
+    # Given
+    database = make_url(config.PG_DSN).database
+    checkouts = db.POOL_CHECKOUTS.value(database=database)
+
+    # When
+    async with db.DB(config.PG_DSN).session() as session:
+        await session.execute(sa.text("SELECT 1"))
+        in_use = db.POOL_IN_USE.value(database=database)
+
+    # Then
+    assert db.POOL_CHECKOUTS.value(database=database) == checkouts + 1
+    assert in_use >= 1
+    assert db.POOL_IN_USE.value(database=database) == in_use - 1
+    assert db.POOL_CHECKOUT_WAIT.value(database=database) > 0
@@ -1,17 +1,24 @@
 # pylint: disable=no-self-use
+import asyncio
 from datetime import date
 from typing import Any
-from collections.abc import AsyncGenerator
 from unittest import mock
+from collections.abc import AsyncGenerator
 from uuid import UUID, uuid4
 
 import pytest
+import sqlalchemy as sa
 from pytest_mock import MockerFixture
 from sqlalchemy.ext.asyncio import AsyncEngine
 
-from app.allocation.adapters.orm import metadata
+from app.allocation.adapters import email
+from app.allocation.adapters.orm import metadata, order_table, outbox_table
 from app.allocation.domain import commands
-from app.allocation.service_layer import handlers, unit_of_work
+from app.allocation.service_layer import handlers, messagebus, unit_of_work
+from app.config import config
+
+
+pytestmark = pytest.mark.usefixtures("paused_outbox_relay")
 
 
 @pytest.fixture(autouse=True)
@@ -23,6 +30,14 @@ async def clear_db(engine: AsyncEngine) -> AsyncGenerator[AsyncEngine, Any]:
             await conn.execute(table.delete())
 
 
+async def _outbox_messages(engine: AsyncEngine) -> list[tuple[str, str, bytes]]:
+    async with engine.connect() as conn:
+        rows = await conn.execute(
+            sa.select(outbox_table.c.channel, outbox_table.c.key, outbox_table.c.data).order_by(outbox_table.c.id)
+        )
+        return [(r.channel, r.key, r.data) for r in rows]
+
+
 class TestAddBatch:
     async def test_for_new_product(self) -> None:
         uow = unit_of_work.PGUnitOfWork()
@@ -50,10 +65,8 @@ class TestAddBatch:
 
 
 class TestAllocate:
-    async def test_returns_allocation(self, mocker: MockerFixture) -> None:
+    async def test_returns_allocation(self, engine: AsyncEngine) -> None:
         uow = unit_of_work.PGUnitOfWork()
-        mock_redis = mocker.patch("app.allocation.service_layer.handlers.redis", return_value=mock.AsyncMock)
-        mock_redis.attach_mock(mock_redis, "publish")
 
         await handlers.CreateBatchCmdHandler(uow).handle(
             commands.CreateBatch(UUID("b4cf5213-6e1f-46cc-8302-aac1f12ac617"), "COMPLICATED-LAMP", 100)
@@ -62,43 +75,83 @@ class TestAllocate:
             commands.Allocate(UUID("c3370153-5d1c-4059-9a2a-4a39267afc27"), "COMPLICATED-LAMP", 10)
         )
 
-        async with uow:
-            assert mock_redis.call_args == mock.call(
+        # the first message is the new batch's BatchChanged
+        assert (await _outbox_messages(engine))[1:] == [
+            (
                 "allocation:order_allocated:v1",
-                b'{"order_id":"c3370153-5d1c-4059-9a2a-4a39267afc27","sku":"COMPLICATED-LAMP","qty":10,"batch_id":"b4cf5213-6e1f-46cc-8302-aac1f12ac617"}',
+                "COMPLICATED-LAMP",
+                b'{"order_id":"c3370153-5d1c-4059-9a2a-4a39267afc27","sku":"COMPLICATED-LAMP","qty":10,"batch_id":"b4cf5213-6e1f-46cc-8302-aac1f12ac617"}',  # noqa: E501
             )
-            assert batch_id == UUID("b4cf5213-6e1f-46cc-8302-aac1f12ac617")
+        ]
+        assert batch_id == UUID("b4cf5213-6e1f-46cc-8302-aac1f12ac617")
+
+    async def test_allocating_an_allocated_order_again_does_nothing(self) -> None:
+        uow = unit_of_work.PGUnitOfWork()
+        await handlers.CreateBatchCmdHandler(uow).handle(commands.CreateBatch(uuid4(), "FORGETFUL-LAMP", 100))
+        cmd = commands.Allocate(uuid4(), "FORGETFUL-LAMP", 10)
+        await handlers.AllocateCmdHandler(uow).handle(cmd)
+
+        # When
+        batch_id = await handlers.AllocateCmdHandler(uow).handle(cmd)
+
+        # Then
+        assert batch_id is None
+        async with uow:
+            [batch] = (await uow.products.get("FORGETFUL-LAMP")).batches
+            assert batch.available_quantity == 90
 
     async def test_errors_for_invalid_sku(self) -> None:
         uow = unit_of_work.PGUnitOfWork()
         with pytest.raises(handlers.InvalidSku, match="Invalid sku NONEXISTENTSKU"):
             await handlers.AllocateCmdHandler(uow).handle(commands.Allocate(uuid4(), "NONEXISTENTSKU", 10))
 
-    async def test_allocate_handler_commit(self, mocker: MockerFixture) -> None:
+    async def test_allocation_is_not_published_on_rollback(self, engine: AsyncEngine, mocker: MockerFixture) -> None:
         uow = unit_of_work.PGUnitOfWork()
-        mock_redis = mocker.patch("app.allocation.service_layer.handlers.redis", return_value=mock.AsyncMock)
-        mock_redis.attach_mock(mock_redis, "publish")
-
         await handlers.CreateBatchCmdHandler(uow).handle(
             commands.CreateBatch(UUID("0cf8c64c-efd3-4b18-994b-9254ee7c3c93"), "OMINOUS-MIRROR", 100, None)
         )
-        await handlers.AllocateCmdHandler(uow).handle(
-            commands.Allocate(UUID("1156164c-1ed1-4726-b315-5db7ac65ebb5"), "OMINOUS-MIRROR", 10)
+        mocker.patch.object(uow, "commit", side_effect=Exception("version conflict"))
+
+        with pytest.raises(Exception, match="version conflict"):
+            await handlers.AllocateCmdHandler(uow).handle(
+                commands.Allocate(UUID("1156164c-1ed1-4726-b315-5db7ac65ebb5"), "OMINOUS-MIRROR", 10)
+            )
+
+        assert [channel for channel, _, _ in await _outbox_messages(engine)] == ["allocation:batch_changed:v1"]
+
+    async def test_concurrent_allocations_are_retried(self) -> None:
+        # Given
+        await handlers.CreateBatchCmdHandler(unit_of_work.PGUnitOfWork()).handle(
+            commands.CreateBatch(uuid4(), "HOT-SKU", 100)
         )
 
-        assert mock_redis.call_args == mock.call(
-            "allocation:order_allocated:v1",
-            b'{"order_id":"1156164c-1ed1-4726-b315-5db7ac65ebb5","sku":"OMINOUS-MIRROR","qty":10,"batch_id":"0cf8c64c-efd3-4b18-994b-9254ee7c3c93"}',
+        # When: every allocation bumps the product's version, so most of them conflict at least once.
+        # each round of conflicts has a winner, so OCC_RETRY_LIMIT retries are enough for this many writers
+        batch_ids = await asyncio.gather(
+            *(
+                handlers.AllocateCmdHandler(unit_of_work.PGUnitOfWork()).handle(
+                    commands.Allocate(uuid4(), "HOT-SKU", 1)
+                )
+                for _ in range(config.OCC_RETRY_LIMIT + 1)
+            )
         )
 
-    async def test_sends_email_on_out_of_stock_error(self, mocker: MockerFixture) -> None:
+        # Then
+        assert None not in batch_ids
         uow = unit_of_work.PGUnitOfWork()
+        async with uow:
+            product = await uow.products.get("HOT-SKU")
+            assert product.batches[0].available_quantity == 100 - len(batch_ids)
+
+    async def test_sends_email_on_out_of_stock_error(self, mocker: MockerFixture) -> None:
+        bus = messagebus.MessageBus(unit_of_work.PGUnitOfWork, messagebus.command_handlers(), messagebus.EVENT_HANDLERS)
         mock_send_mail = mocker.patch("app.allocation.adapters.email.send")
 
-        await handlers.CreateBatchCmdHandler(uow).handle(commands.CreateBatch(uuid4(), "POPULAR-CURTAINS", 9, None))
-        await handlers.AllocateCmdHandler(uow).handle(commands.Allocate(uuid4(), "POPULAR-CURTAINS", 10))
+        await bus.handle(commands.CreateBatch(uuid4(), "POPULAR-CURTAINS", 9, None))
+        await bus.handle(commands.Allocate(uuid4(), "POPULAR-CURTAINS", 10))
+        await email.OUT_OF_STOCK.join()
 
-        assert mock_send_mail.call_args == mock.call("stock@made.com", "Out of stock for POPULAR-CURTAINS")
+        assert mock_send_mail.call_args == mock.call("stock@made.com", "Out of stock", "POPULAR-CURTAINS")
 
 
 class TestChangeBatchQuantity:
@@ -115,7 +168,7 @@ class TestChangeBatchQuantity:
             [batch] = (await uow.products.get(sku="ADORABLE-SETTEE")).batches
             assert batch.available_quantity == 50
 
-    async def test_reallocates_if_necessary(self, mocker: MockerFixture) -> None:
+    async def test_reallocates_if_necessary(self, engine: AsyncEngine) -> None:
         # Given
         uow = unit_of_work.PGUnitOfWork()
 
@@ -125,14 +178,12 @@ class TestChangeBatchQuantity:
         await handlers.CreateBatchCmdHandler(uow).handle(
             commands.CreateBatch(UUID("e9c6851c-e74a-40ac-8e86-3956f4762853"), "INDIFFERENT-TABLE", 50, date.today())
         )
-        with mock.patch("app.allocation.service_layer.handlers.redis", return_value=mock.AsyncMock) as mock_redis:
-            mock_redis.attach_mock(mock_redis, "publish")
-            await handlers.AllocateCmdHandler(uow).handle(
-                commands.Allocate(UUID("57e0e250-93f2-4378-b44e-307838b4c367"), "INDIFFERENT-TABLE", 40)
-            )
-            await handlers.AllocateCmdHandler(uow).handle(
-                commands.Allocate(UUID("1406c359-13b6-422d-8507-b24a0c763abd"), "INDIFFERENT-TABLE", 20)
-            )
+        await handlers.AllocateCmdHandler(uow).handle(
+            commands.Allocate(UUID("57e0e250-93f2-4378-b44e-307838b4c367"), "INDIFFERENT-TABLE", 40)
+        )
+        await handlers.AllocateCmdHandler(uow).handle(
+            commands.Allocate(UUID("1406c359-13b6-422d-8507-b24a0c763abd"), "INDIFFERENT-TABLE", 20)
+        )
 
         async with uow:
             [batch1, batch2] = (await uow.products.get(sku="INDIFFERENT-TABLE")).batches
@@ -140,16 +191,6 @@ class TestChangeBatchQuantity:
             assert batch2.available_quantity == 30
 
         # When
-        def mock_publish(channel: str, message: bytes) -> None:
-            assert channel == "allocation:order_deallocated:v1"
-            assert message == b'{"order_id":"57e0e250-93f2-4378-b44e-307838b4c367","sku":"INDIFFERENT-TABLE","qty":40}'
-
-        mock_pipeline = mock.AsyncMock()
-        mock_pipeline.publish = mock_publish
-        mocker.patch(
-            "app.allocation.service_layer.handlers.redis.pipeline",
-            return_value=mock_pipeline,
-        )
         await handlers.ChangeBatchQuantityCmdHandler(uow).handle(
             commands.ChangeBatchQuantity(UUID("874c6d0d-84e6-4307-b9d5-e23ec78bb727"), 25)
         )
@@ -157,4 +198,57 @@ class TestChangeBatchQuantity:
         # Then
         async with uow:
             [batch1, batch2] = (await uow.products.get(sku="INDIFFERENT-TABLE")).batches
-            assert batch2.available_quantity == 25
+            assert batch1.id == UUID("874c6d0d-84e6-4307-b9d5-e23ec78bb727")
+            assert batch1.available_quantity == 25
+            assert batch2.available_quantity == 30
+        assert (await _outbox_messages(engine))[-1] == (
+            "allocation:order_deallocated:v1",
+            "INDIFFERENT-TABLE",
+            b'{"order_id":"57e0e250-93f2-4378-b44e-307838b4c367","sku":"INDIFFERENT-TABLE","qty":40}',
+        )
+        # the order is deleted with its deallocation, for the worker to allocate it again
+        async with engine.connect() as conn:
+            orders = await conn.execute(sa.select(order_table.c.id).where(order_table.c.sku == "INDIFFERENT-TABLE"))
+            assert list(orders.scalars()) == [UUID("1406c359-13b6-422d-8507-b24a0c763abd")]
+
+    async def test_reallocates_in_the_same_unit_of_work(self, engine: AsyncEngine) -> None:
+        # Given
+        uow = unit_of_work.PGUnitOfWork()
+
+        await handlers.CreateBatchCmdHandler(uow).handle(
+            commands.CreateBatch(UUID("874c6d0d-84e6-4307-b9d5-e23ec78bb727"), "INDIFFERENT-TABLE", 50, None)
+        )
+        await handlers.CreateBatchCmdHandler(uow).handle(
+            commands.CreateBatch(UUID("e9c6851c-e74a-40ac-8e86-3956f4762853"), "INDIFFERENT-TABLE", 100, date.today())
+        )
+        await handlers.AllocateCmdHandler(uow).handle(
+            commands.Allocate(UUID("57e0e250-93f2-4378-b44e-307838b4c367"), "INDIFFERENT-TABLE", 40)
+        )
+        await handlers.AllocateCmdHandler(uow).handle(
+            commands.Allocate(UUID("1406c359-13b6-422d-8507-b24a0c763abd"), "INDIFFERENT-TABLE", 20)
+        )
+
+        # When
+        await handlers.ChangeBatchQuantityCmdHandler(uow, reallocate=True).handle(
+            commands.ChangeBatchQuantity(UUID("874c6d0d-84e6-4307-b9d5-e23ec78bb727"), 25)
+        )
+
+        # Then: the order moved to the other batch, and no Deallocated event was left for the worker
+        async with uow:
+            [batch1, batch2] = (await uow.products.get(sku="INDIFFERENT-TABLE")).batches
+            assert batch1.available_quantity == 25
+            assert batch2.available_quantity == 40
+        async with engine.connect() as conn:
+            allocations = await conn.execute(
+                sa.text("SELECT order_id, batch_id FROM allocation WHERE order_id = :order_id"),
+                dict(order_id=UUID("57e0e250-93f2-4378-b44e-307838b4c367")),
+            )
+            assert allocations.all() == [
+                (UUID("57e0e250-93f2-4378-b44e-307838b4c367"), UUID("e9c6851c-e74a-40ac-8e86-3956f4762853"))
+            ]
+        assert (await _outbox_messages(engine))[-1] == (
+            "allocation:orders_reallocated:v1",
+            "INDIFFERENT-TABLE",
+            b'{"sku":"INDIFFERENT-TABLE","allocations":[{"order_id":"57e0e250-93f2-4378-b44e-307838b4c367",'
+            b'"qty":40,"batch_id":"e9c6851c-e74a-40ac-8e86-3956f4762853"}]}',
+        )
@@ -0,0 +1,21 @@
+import sqlalchemy as sa
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+from app.allocation.adapters import instrumentation
+
+
+async def test_tracked_counts_statements_of_the_block(engine: AsyncEngine) -> None:
+    # Given
+    instrumentation.instrument_engine(engine.sync_engine)
+    before = instrumentation.QUERIES.value(operation="test")
+
+    # When
+    async with engine.connect() as conn:
+        await conn.execute(sa.text("SELECT 1"))
+        with instrumentation.tracked("test"):
+            await conn.execute(sa.text("SELECT 1"))
+            await conn.execute(sa.text("SELECT 2"))
+
+    # Then
+    assert instrumentation.QUERIES.value(operation="test") - before == 2
+    assert instrumentation.QUERY_SECONDS.value(operation="test") > 0
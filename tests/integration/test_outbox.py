@@ -0,0 +1,62 @@
+from collections.abc import AsyncGenerator
+
+import pytest
+import sqlalchemy as sa
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.allocation.adapters import outbox, stream
+from app.allocation.adapters.orm import outbox_table
+from app.allocation.adapters.redis import Redis
+from app.allocation.constants import ALLOCATION_STREAM
+from app.config import config
+
+
+@pytest.fixture
+async def rc() -> AsyncGenerator[Redis, None]:
+    rc = Redis.from_url(config.REDIS_DSN)
+    yield rc
+    # the worker consumes the same stream, so only remove what the test published
+    name = stream.stream_name(ALLOCATION_STREAM, stream.partition("OUTBOX-SKU"))
+    entries = await rc.xrange(name)
+    ids = [entry_id for entry_id, fields in entries if fields[b"channel"] == b"test:outbox"]
+    if ids:
+        await rc.xdel(name, *ids)
+    await rc.close()
+
+
+async def _published(rc: Redis) -> list[dict[bytes, bytes]]:
+    entries = await rc.xrange(stream.stream_name(ALLOCATION_STREAM, stream.partition("OUTBOX-SKU")))
+    return [fields for _, fields in entries if fields[b"channel"] == b"test:outbox"]
+
+
+async def test_relay_publishes_messages_in_order_and_deletes_them(session: AsyncSession, rc: Redis) -> None:
+    # Given: messages written in the session, which the worker's relay can not see
+    await outbox.PGOutbox(session).add(
+        *(outbox.Message("test:outbox", "OUTBOX-SKU", f"{i}".encode()) for i in range(3))
+    )
+    await session.execute(sa.select(sa.func.pg_advisory_xact_lock(sa.literal(outbox.RELAY_LOCK_ID, sa.BigInteger))))
+
+    # When
+    first = await outbox.relay(session, rc, limit=2)
+    second = await outbox.relay(session, rc, limit=2)
+
+    # Then
+    assert (first, second) == (2, 1)
+    published = await _published(rc)
+    assert [fields[b"data"] for fields in published] == [b"0", b"1", b"2"]
+    assert all(fields[b"message_id"] for fields in published)
+    assert (await session.execute(sa.select(sa.func.count()).select_from(outbox_table))).scalar() == 0
+
+
+async def test_relay_skips_while_another_relay_holds_the_lock(
+    session: AsyncSession, paused_outbox_relay: None, rc: Redis
+) -> None:
+    # Given
+    await outbox.PGOutbox(session).add(outbox.Message("test:outbox", "OUTBOX-SKU", b"data"))
+
+    # When
+    relayed = await outbox.relay(session, rc, limit=10)
+
+    # Then
+    assert relayed == 0
+    assert await _published(rc) == []
@@ -0,0 +1,163 @@
+from collections.abc import AsyncGenerator
+from datetime import date
+from uuid import uuid4
+
+import pytest
+import sqlalchemy as sa
+from pytest_mock import MockerFixture
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+from app.allocation.adapters.db import DB
+from app.allocation.adapters.orm import (
+    allocation_table,
+    allocations_view,
+    batch_table,
+    order_table,
+    product_table,
+    stock_view,
+)
+from app.allocation.adapters.projection import AllocationsViewProjection
+from app.allocation.domain import events
+from app.config import config
+
+
+@pytest.fixture
+async def sku(engine: AsyncEngine) -> AsyncGenerator[str, None]:
+    sku = f"PROJECTION-{uuid4()}"
+    yield sku
+    async with engine.begin() as conn:
+        await conn.execute(allocations_view.delete().where(allocations_view.c.sku == sku))
+        await conn.execute(stock_view.delete().where(stock_view.c.sku == sku))
+        batch_ids = sa.select(batch_table.c.id).where(batch_table.c.sku == sku)
+        await conn.execute(allocation_table.delete().where(allocation_table.c.batch_id.in_(batch_ids)))
+        await conn.execute(order_table.delete().where(order_table.c.sku == sku))
+        await conn.execute(batch_table.delete().where(batch_table.c.sku == sku))
+        await conn.execute(product_table.delete().where(product_table.c.sku == sku))
+
+
+async def _rows(engine: AsyncEngine, sku: str) -> set[tuple[str, str]]:
+    async with engine.connect() as conn:
+        result = await conn.execute(
+            sa.select(allocations_view.c.order_id, allocations_view.c.batch_id).where(allocations_view.c.sku == sku)
+        )
+        return {(str(order_id), str(batch_id)) for order_id, batch_id in result}
+
+
+async def test_flush_applies_events_in_order(engine: AsyncEngine, sku: str, mocker: MockerFixture) -> None:
+    # Given: an order allocated, deallocated and allocated again, next to another order
+    cache = mocker.AsyncMock()
+    projection = AllocationsViewProjection(DB(config.PG_DSN), cache)
+    order_id, other_order_id = uuid4(), uuid4()
+    batch1, batch2 = uuid4(), uuid4()
+    projection.add(events.Allocated(order_id=order_id, sku=sku, qty=10, batch_id=batch1))
+    projection.add(events.Allocated(order_id=other_order_id, sku=sku, qty=5, batch_id=batch1))
+    projection.remove(events.Deallocated(order_id=order_id, sku=sku, qty=10))
+    projection.add(events.Allocated(order_id=order_id, sku=sku, qty=10, batch_id=batch2))
+    # a redelivered event
+    projection.add(events.Allocated(order_id=order_id, sku=sku, qty=10, batch_id=batch2))
+
+    # When
+    await projection.flush()
+
+    # Then
+    assert await _rows(engine, sku) == {(str(other_order_id), str(batch1)), (str(order_id), str(batch2))}
+    assert len(projection) == 0
+    cache.invalidate.assert_awaited_once_with(sku)
+
+
+async def test_flush_counts_each_allocation_of_a_batch_once(
+    engine: AsyncEngine, sku: str, mocker: MockerFixture
+) -> None:
+    # Given: two batches, one order allocated twice by redelivery, another moved off the shrunk batch
+    projection = AllocationsViewProjection(DB(config.PG_DSN), mocker.AsyncMock())
+    batch1, batch2 = uuid4(), uuid4()
+    order_id, moved_order_id = uuid4(), uuid4()
+    projection.change(events.BatchChanged(batch_id=batch1, sku=sku, qty=20, eta=None))
+    projection.change(events.BatchChanged(batch_id=batch2, sku=sku, qty=20, eta=date(2021, 1, 1)))
+    projection.add(events.Allocated(order_id=order_id, sku=sku, qty=5, batch_id=batch1))
+    projection.add(events.Allocated(order_id=moved_order_id, sku=sku, qty=10, batch_id=batch1))
+    projection.add(events.Allocated(order_id=order_id, sku=sku, qty=5, batch_id=batch1))
+    await projection.flush()
+    projection.change(events.BatchChanged(batch_id=batch1, sku=sku, qty=10, eta=None))
+    projection.remove(events.Deallocated(order_id=moved_order_id, sku=sku, qty=10))
+    projection.remove(events.Deallocated(order_id=moved_order_id, sku=sku, qty=10))
+    projection.add(events.Allocated(order_id=moved_order_id, sku=sku, qty=10, batch_id=batch2))
+
+    # When
+    await projection.flush()
+
+    # Then
+    async with engine.connect() as conn:
+        result = await conn.execute(
+            sa.select(stock_view.c.batch_id, stock_view.c.qty, stock_view.c.eta, stock_view.c.allocated)
+            .where(stock_view.c.sku == sku)
+            .order_by(stock_view.c.eta.nulls_first())
+        )
+        assert [tuple(row) for row in result] == [
+            (str(batch1), 10, None, 5),
+            (str(batch2), 20, date(2021, 1, 1), 10),
+        ]
+
+
+async def test_failed_flush_drops_buffer(engine: AsyncEngine, sku: str, mocker: MockerFixture) -> None:
+    # Given: a projection whose transaction fails
+    cache = mocker.AsyncMock()
+    db = DB(config.PG_DSN)
+    projection = AllocationsViewProjection(db, cache)
+    projection.add(events.Allocated(order_id=uuid4(), sku=sku, qty=10, batch_id=uuid4()))
+    mocker.patch.object(db, "session", side_effect=Exception("boom"))
+
+    # When
+    with pytest.raises(Exception, match="boom"):
+        await projection.flush()
+
+    # Then: the events are left to redelivery
+    assert len(projection) == 0
+    assert await _rows(engine, sku) == set()
+    cache.invalidate.assert_not_awaited()
+
+
+async def test_backfill_inserts_the_stock_of_batches_without_a_row(
+    engine: AsyncEngine, sku: str, mocker: MockerFixture
+) -> None:
+    # Given: a batch stock_view has no row for, with one of its two allocations projected, and one it has
+    projection = AllocationsViewProjection(DB(config.PG_DSN), mocker.AsyncMock())
+    batch1, batch2 = uuid4(), uuid4()
+    projected_order_id, order_id = uuid4(), uuid4()
+    async with engine.begin() as conn:
+        await conn.execute(product_table.insert().values(sku=sku, version_number=1))
+        await conn.execute(
+            batch_table.insert(),
+            [
+                dict(id=batch1, sku=sku, qty=100, eta=None, allocated_qty=30),
+                dict(id=batch2, sku=sku, qty=50, eta=date(2021, 1, 1), allocated_qty=0),
+            ],
+        )
+        await conn.execute(
+            order_table.insert(), [dict(id=projected_order_id, sku=sku, qty=10), dict(id=order_id, sku=sku, qty=20)]
+        )
+        await conn.execute(
+            allocation_table.insert(), [dict(order_id=o, batch_id=batch1) for o in (projected_order_id, order_id)]
+        )
+        await conn.execute(
+            allocations_view.insert().values(order_id=str(projected_order_id), sku=sku, batch_id=str(batch1))
+        )
+    projection.change(events.BatchChanged(batch_id=batch2, sku=sku, qty=40, eta=date(2021, 1, 1)))
+    await projection.flush()
+
+    # When
+    await projection.backfill_stock()
+    projection.add(events.Allocated(order_id=order_id, sku=sku, qty=20, batch_id=batch1))
+    await projection.flush()
+
+    # Then: the existing row is left alone, and the allocation still in the stream is counted once
+    async with engine.connect() as conn:
+        result = await conn.execute(
+            sa.select(stock_view.c.batch_id, stock_view.c.qty, stock_view.c.eta, stock_view.c.allocated)
+            .where(stock_view.c.sku == sku)
+            .order_by(stock_view.c.eta.nulls_first())
+        )
+        assert [tuple(row) for row in result] == [
+            (str(batch1), 100, None, 30),
+            (str(batch2), 40, date(2021, 1, 1), 0),
+        ]
@@ -0,0 +1,173 @@
+from collections.abc import AsyncGenerator, Generator
+from typing import Any
+from uuid import UUID, uuid4
+
+import pytest
+import sqlalchemy as sa
+from sqlalchemy.engine import Engine
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession
+
+from app.allocation.adapters.orm import metadata
+from app.allocation.adapters.repository import BatchSkuCache, PGProductRepository
+from app.allocation.domain import models
+from app.allocation.service_layer.unit_of_work import PGUnitOfWork
+
+
+@pytest.fixture(autouse=True)
+async def clear_db(engine: AsyncEngine) -> AsyncGenerator[AsyncEngine, Any]:
+    yield engine
+    async with engine.begin() as conn:
+        for table in reversed(metadata.sorted_tables):
+            await conn.execute(table.delete())
+
+
+@pytest.fixture
+def statements() -> Generator[list[str], None, None]:
+    executed: list[str] = []
+
+    def before_cursor_execute(conn: Any, cursor: Any, statement: str, *args: Any) -> None:
+        executed.append(statement)
+
+    # the app's engine and the one of the session fixture
+    sa.event.listen(Engine, "before_cursor_execute", before_cursor_execute)
+    yield executed
+    sa.event.remove(Engine, "before_cursor_execute", before_cursor_execute)
+
+
+@pytest.fixture(autouse=True)
+async def product() -> None:
+    batches = [
+        models.Batch(id=UUID("c1dac0a1-b8e8-4052-a7e4-67061204d4d9"), sku="RETRO-CLOCK", qty=100),
+        models.Batch(id=UUID("c3f04384-8fdf-4d89-8616-9efec913092f"), sku="RETRO-CLOCK", qty=100),
+    ]
+    async with PGUnitOfWork() as uow:
+        await uow.products.add(models.Product(sku="RETRO-CLOCK", batches=batches))
+        for qty in (10, 20):
+            batches[0].allocate(models.Order(sku="RETRO-CLOCK", qty=qty))
+        await uow.commit()
+
+
+async def test_get_loads_allocated_quantity_without_allocations(statements: list[str]) -> None:
+    # When
+    async with PGUnitOfWork() as uow:
+        product = await uow.products.get("RETRO-CLOCK")
+        loaded = len(statements)
+        [batch1, batch2] = product.batches
+
+        # Then
+        assert loaded == 1
+        assert batch1.allocations == set()
+        assert batch1.available_quantity == 70
+        assert batch2.available_quantity == 100
+
+
+async def test_allocations_to_narrowly_loaded_batches_are_saved() -> None:
+    # Given
+    async with PGUnitOfWork() as uow:
+        product = await uow.products.get("RETRO-CLOCK")
+        product.allocate(models.Order(sku="RETRO-CLOCK", qty=70))
+        await uow.commit()
+
+    # When
+    async with PGUnitOfWork() as uow:
+        product = await uow.products.get("RETRO-CLOCK")
+        [batch1, batch2] = product.batches
+
+        # Then
+        assert batch1.available_quantity == 0
+        assert batch2.available_quantity == 100
+
+
+async def test_get_by_batch_id_loads_allocations_of_that_batch(statements: list[str]) -> None:
+    # When
+    async with PGUnitOfWork() as uow:
+        product = await uow.products.get_by_batch_id(UUID("c1dac0a1-b8e8-4052-a7e4-67061204d4d9"))
+        loaded = len(statements)
+        [batch1, _] = product.batches
+
+        # Then
+        assert loaded == 2
+        assert sorted(order.qty for order in batch1.allocations) == [10, 20]
+        assert batch1.available_quantity == 70
+
+
+async def test_deallocation_after_get_by_batch_id_is_saved() -> None:
+    # Given
+    async with PGUnitOfWork() as uow:
+        product = await uow.products.get_by_batch_id(UUID("c1dac0a1-b8e8-4052-a7e4-67061204d4d9"))
+        [deallocated] = product.change_batch_quantity(UUID("c1dac0a1-b8e8-4052-a7e4-67061204d4d9"), 25)
+        deallocated_qty = deallocated.qty
+        await uow.commit()
+
+    # When
+    async with PGUnitOfWork() as uow:
+        product = await uow.products.get("RETRO-CLOCK")
+
+        # Then
+        assert product.batches[0].available_quantity == 25 - (30 - deallocated_qty)
+
+
+async def test_allocated_qty_follows_allocations_and_deallocations(engine: AsyncEngine) -> None:
+    # Given
+    async with PGUnitOfWork() as uow:
+        product = await uow.products.get_by_batch_id(UUID("c1dac0a1-b8e8-4052-a7e4-67061204d4d9"))
+        product.change_batch_quantity(UUID("c1dac0a1-b8e8-4052-a7e4-67061204d4d9"), 15)
+        product.allocate(models.Order(sku="RETRO-CLOCK", qty=40))
+        await uow.commit()
+
+    # When
+    async with engine.connect() as conn:
+        result = await conn.execute(sa.text("SELECT qty, allocated_qty FROM batch ORDER BY id"))
+
+    # Then
+    assert result.all() == [(15, 10), (100, 40)]
+
+
+async def test_get_by_batch_id_remembers_the_sku_of_the_batch(session: AsyncSession, statements: list[str]) -> None:
+    # Given
+    batch_skus = BatchSkuCache(10)
+    await PGProductRepository(session, batch_skus).get_by_batch_id(UUID("c1dac0a1-b8e8-4052-a7e4-67061204d4d9"))
+    session.expunge_all()
+    statements.clear()
+
+    # When
+    product = await PGProductRepository(session, batch_skus).get_by_batch_id(
+        UUID("c1dac0a1-b8e8-4052-a7e4-67061204d4d9")
+    )
+
+    # Then
+    assert product.sku == "RETRO-CLOCK"
+    assert len(statements) == 2
+    assert "batch.id =" not in statements[0]
+
+
+async def test_get_by_batch_id_forgets_a_batch_that_does_not_exist(session: AsyncSession) -> None:
+    # Given
+    batch_skus = BatchSkuCache(10)
+    batch_skus.put(UUID("4ee24a0f-f1d6-4e45-8e4c-3c23e1f0b6a2"), "RETRO-CLOCK")
+
+    # When
+    product = await PGProductRepository(session, batch_skus).get_by_batch_id(
+        UUID("4ee24a0f-f1d6-4e45-8e4c-3c23e1f0b6a2")
+    )
+
+    # Then
+    assert product is None
+    assert len(batch_skus) == 0
+
+
+def test_batch_sku_cache_evicts_the_least_recently_used_batch() -> None:
+    # Given
+    batch_skus = BatchSkuCache(2)
+    first, second, third = uuid4(), uuid4(), uuid4()
+    batch_skus.put(first, "RETRO-CLOCK")
+    batch_skus.put(second, "RETRO-LAMP")
+
+    # When
+    batch_skus.get(first)
+    batch_skus.put(third, "RETRO-CHAIR")
+
+    # Then
+    assert batch_skus.get(second) is None
+    assert batch_skus.get(first) == "RETRO-CLOCK"
+    assert batch_skus.get(third) == "RETRO-CHAIR"
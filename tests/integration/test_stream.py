@@ -0,0 +1,256 @@
+import asyncio
+from collections.abc import AsyncGenerator
+
+import pytest
+from pytest_mock import MockerFixture
+
+from app.allocation.adapters import dispatcher, stream
+from app.allocation.adapters.redis import Redis
+from app.config import config
+
+
+@pytest.fixture
+async def rc() -> AsyncGenerator[Redis, None]:
+    rc = Redis.from_url(config.REDIS_DSN)
+    yield rc
+    await rc.delete(*[stream.stream_name("test", p) for p in range(2)])
+    await rc.delete(*[f"{stream.stream_name('test', p)}:dead" for p in range(2)])
+    if handled := await rc.keys("allocation:handled:v1:test:*"):
+        await rc.delete(*handled)
+
+
+async def _consume(consumer: stream.StreamConsumer, until: asyncio.Event) -> None:
+    task = asyncio.create_task(consumer.run())
+    try:
+        await asyncio.wait_for(until.wait(), timeout=2)
+    finally:
+        task.cancel()
+
+
+async def _pending(rc: Redis, name: str) -> int:
+    return len(await rc.xpending_range(name, "test", "-", "+", 1_000))
+
+
+async def test_consumes_partition_in_publish_order(rc: Redis) -> None:
+    # Given: messages for the same key on two channels
+    for i in range(3):
+        await stream.xadd(rc, "test:a", "SKU", f"a{i}".encode(), stream="test", partitions=2)
+        await stream.xadd(rc, "test:b", "SKU", f"b{i}".encode(), stream="test", partitions=2)
+    handled: list[tuple[str, bytes]] = []
+    done = asyncio.Event()
+
+    async def handler(channel: str, data: bytes) -> None:
+        handled.append((channel, data))
+        if len(handled) == 6:
+            done.set()
+
+    # When
+    consumer = stream.StreamConsumer(rc, "test", "test", stream.partition("SKU", 2), handler)
+    await _consume(consumer, done)
+
+    # Then: messages are handled in publish order and acknowledged
+    assert handled == [
+        ("test:a", b"a0"),
+        ("test:b", b"b0"),
+        ("test:a", b"a1"),
+        ("test:b", b"b1"),
+        ("test:a", b"a2"),
+        ("test:b", b"b2"),
+    ]
+    assert await _pending(rc, stream.stream_name("test", stream.partition("SKU", 2))) == 0
+
+
+async def test_failed_entries_are_claimed_again(rc: Redis, mocker: MockerFixture) -> None:
+    # Given: a handler failing on the first delivery
+    mocker.patch.object(config, "STREAM_CLAIM_MIN_IDLE_MS", 100)
+    await stream.xadd(rc, "test:a", "SKU", b"data", stream="test", partitions=2)
+    deliveries = []
+    done = asyncio.Event()
+
+    async def handler(channel: str, data: bytes) -> None:
+        deliveries.append(data)
+        if len(deliveries) == 1:
+            raise Exception("boom")
+        done.set()
+
+    # When
+    consumer = stream.StreamConsumer(rc, "test", "test", stream.partition("SKU", 2), handler)
+    await _consume(consumer, done)
+
+    # Then
+    assert deliveries == [b"data", b"data"]
+
+
+async def test_messages_behind_a_failed_one_of_their_key_wait_for_it(rc: Redis, mocker: MockerFixture) -> None:
+    # Given: two messages of a key, the first failing on its first delivery, and one of another key
+    mocker.patch.object(config, "STREAM_CLAIM_MIN_IDLE_MS", 100)
+    mocker.patch.object(config, "STREAM_BLOCK_MS", 50)
+    await stream.xadd(rc, "test:a", "SKU", b"a0", stream="test", partitions=1)
+    await stream.xadd(rc, "test:a", "SKU", b"a1", stream="test", partitions=1)
+    await stream.xadd(rc, "test:a", "OTHER", b"b0", stream="test", partitions=1)
+    deliveries: list[bytes] = []
+    done = asyncio.Event()
+
+    async def handler(channel: str, data: bytes) -> None:
+        deliveries.append(data)
+        if deliveries == [b"a0"]:
+            raise Exception("boom")
+        if data == b"a1":
+            done.set()
+
+    # When
+    consumer = stream.StreamConsumer(rc, "test", "test", 0, handler)
+    await _consume(consumer, done)
+
+    # Then: the second message of the key is handled after the first one was, the other key did not wait
+    assert deliveries == [b"a0", b"b0", b"a0", b"a1"]
+    assert await _pending(rc, stream.stream_name("test", 0)) == 0
+
+
+async def test_poison_messages_are_moved_to_the_dead_letter_stream(rc: Redis, mocker: MockerFixture) -> None:
+    # Given: a handler always failing on the first message
+    mocker.patch.object(config, "STREAM_CLAIM_MIN_IDLE_MS", 50)
+    mocker.patch.object(config, "STREAM_MAX_DELIVERIES", 2)
+    mocker.patch.object(config, "STREAM_BLOCK_MS", 50)
+    await stream.xadd(rc, "test:a", "SKU", b"poison", stream="test", partitions=2)
+    await stream.xadd(rc, "test:a", "SKU", b"data", stream="test", partitions=2)
+    name = stream.stream_name("test", stream.partition("SKU", 2))
+    deliveries = []
+
+    async def handler(channel: str, data: bytes) -> None:
+        deliveries.append(data)
+        if data == b"poison":
+            raise Exception("boom")
+
+    # When
+    consumer = stream.StreamConsumer(rc, "test", "test", stream.partition("SKU", 2), handler)
+    task = asyncio.create_task(consumer.run())
+    for _ in range(40):
+        await asyncio.sleep(0.05)
+        if await rc.xlen(f"{name}:dead"):
+            break
+    task.cancel()
+
+    # Then: the poison message was delivered STREAM_MAX_DELIVERIES times, then dead lettered and acknowledged
+    assert deliveries.count(b"poison") == 2
+    [(_, fields)] = await rc.xrange(f"{name}:dead")
+    assert fields[b"data"] == b"poison"
+    assert await _pending(rc, name) == 0
+
+
+async def test_consumer_trims_acknowledged_entries(rc: Redis, mocker: MockerFixture) -> None:
+    # Given
+    mocker.patch.object(config, "STREAM_CLAIM_MIN_IDLE_MS", 50)
+    mocker.patch.object(config, "STREAM_BLOCK_MS", 50)
+    for i in range(3):
+        await stream.xadd(rc, "test:a", "SKU", f"a{i}".encode(), stream="test", partitions=2)
+    name = stream.stream_name("test", stream.partition("SKU", 2))
+
+    async def handler(channel: str, data: bytes) -> None:
+        pass
+
+    # When
+    consumer = stream.StreamConsumer(rc, "test", "test", stream.partition("SKU", 2), handler)
+    task = asyncio.create_task(consumer.run())
+    for _ in range(40):
+        await asyncio.sleep(0.05)
+        if await rc.xlen(name) == 1:
+            break
+    task.cancel()
+
+    # Then: only the last delivered entry is kept
+    assert await rc.xlen(name) == 1
+
+
+async def test_redelivered_message_ids_are_handled_once(rc: Redis) -> None:
+    # Given: the same message published twice, as a relay crashing before it commits would
+    for _ in range(2):
+        await stream.xadd(rc, "test:a", "SKU", b"data", stream="test", partitions=2, message_id="message-1")
+    await stream.xadd(rc, "test:a", "SKU", b"last", stream="test", partitions=2, message_id="message-2")
+    handled = []
+    done = asyncio.Event()
+
+    async def handler(channel: str, data: bytes) -> None:
+        handled.append(data)
+        if data == b"last":
+            done.set()
+
+    # When
+    consumer = stream.StreamConsumer(rc, "test", "test", stream.partition("SKU", 2), handler)
+    await _consume(consumer, done)
+
+    # Then: the duplicate is acknowledged without being handled
+    assert handled == [b"data", b"last"]
+    assert await _pending(rc, stream.stream_name("test", stream.partition("SKU", 2))) == 0
+
+
+async def test_messages_are_acknowledged_after_flush(rc: Redis) -> None:
+    # Given: a consumer whose flush fails, losing what its handler buffered
+    for i in range(3):
+        await stream.xadd(rc, "test:a", "SKU", f"a{i}".encode(), stream="test", partitions=2, message_id=f"m{i}")
+
+    async def buffer(channel: str, data: bytes) -> None:
+        pass
+
+    async def fail() -> None:
+        raise Exception("boom")
+
+    consumer = stream.StreamConsumer(rc, "test", "test", stream.partition("SKU", 2), buffer, flush=fail)
+    task = asyncio.create_task(consumer.run())
+    await asyncio.sleep(0.5)
+    task.cancel()
+    assert await _pending(rc, stream.stream_name("test", stream.partition("SKU", 2))) == 3
+
+    # When: a restarted consumer reads its pending messages again
+    buffered: list[bytes] = []
+    flushed: list[bytes] = []
+    done = asyncio.Event()
+
+    async def handler(channel: str, data: bytes) -> None:
+        buffered.append(data)
+
+    async def flush() -> None:
+        flushed.extend(buffered)
+        del buffered[:]
+        if len(flushed) == 3:
+            done.set()
+
+    consumer = stream.StreamConsumer(rc, "test", "test", stream.partition("SKU", 2), handler, flush=flush)
+    await _consume(consumer, done)
+    await asyncio.sleep(0.1)
+
+    # Then: they are handled again, flushed and acknowledged
+    assert flushed == [b"a0", b"a1", b"a2"]
+    assert await _pending(rc, stream.stream_name("test", stream.partition("SKU", 2))) == 0
+
+
+async def test_dispatcher_handles_other_keys_while_one_is_slow(rc: Redis) -> None:
+    # Given: a slow message followed by messages of another key in the same partition
+    await stream.xadd(rc, "test:a", "SKU-1", b"slow", stream="test", partitions=1)
+    for i in range(2):
+        await stream.xadd(rc, "test:a", "A", f"a{i}".encode(), stream="test", partitions=1)
+    handled: list[bytes] = []
+    blocked = asyncio.Event()
+    done = asyncio.Event()
+
+    async def handler(channel: str, data: bytes) -> None:
+        if data == b"slow":
+            await blocked.wait()
+        handled.append(data)
+        if len(handled) == 2:
+            blocked.set()
+        if len(handled) == 3:
+            done.set()
+
+    # When
+    consumer = stream.StreamConsumer(
+        rc, "test", "test", 0, handler, dispatcher=dispatcher.KeyedDispatcher(lanes=2, queue_size=10)
+    )
+    task = asyncio.create_task(consumer.run())
+    await asyncio.wait_for(done.wait(), timeout=2)
+    await asyncio.sleep(0.1)
+    task.cancel()
+
+    # Then: the other key did not wait, and the batch is acknowledged once all of it is handled
+    assert handled == [b"a0", b"a1", b"slow"]
+    assert await _pending(rc, stream.stream_name("test", 0)) == 0
@@ -10,7 +10,7 @@ from sqlalchemy.orm import sessionmaker
 
 from app.allocation.adapters.orm import metadata
 from app.allocation.domain import models
-from app.allocation.service_layer.unit_of_work import PGUnitOfWork
+from app.allocation.service_layer.unit_of_work import ConcurrencyConflict, PGUnitOfWork
 
 
 @pytest.fixture
@@ -130,6 +130,7 @@ async def test_concurrent_updates_to_version_are_not_allowed(session: AsyncSessi
 
     await asyncio.gather(*[allocate(order1), allocate(order2)])
     [exception] = exceptions
+    assert isinstance(exception, ConcurrencyConflict)
     assert "UPDATE statement on table 'product' expected to update 1 row(s); 0 were matched." in str(exception)
 
     [[version]] = await session.execute(
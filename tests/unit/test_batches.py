@@ -75,3 +75,34 @@ def test_allocation_is_idempotent() -> None:
     batch.allocate(order)
     # Then
     assert batch.available_quantity == 0
+
+
+def test_deallocating_increases_available_quantity() -> None:
+    # Given
+    batch = Batch(sku="SMALL-FORK", qty=10)
+    batch.allocate(Order(sku="SMALL-FORK", qty=4))
+    batch.allocate(Order(sku="SMALL-FORK", qty=6))
+
+    # When
+    order = batch.deallocate_one()
+
+    # Then
+    assert batch.available_quantity == order.qty
+
+
+def test_available_quantity_counts_allocations_not_added_by_allocate() -> None:
+    # Given: allocations populated directly, as the ORM does when loading a batch
+    batch = Batch(sku="SMALL-FORK", qty=10, allocations={Order(sku="SMALL-FORK", qty=3)})
+
+    # When
+    batch.allocate(Order(sku="SMALL-FORK", qty=2))
+
+    # Then
+    assert batch.available_quantity == 5
+
+    # When: the ORM repopulates allocations
+    batch.allocations = {Order(sku="SMALL-FORK", qty=1)}
+    batch.reset_allocated_quantity()
+
+    # Then
+    assert batch.available_quantity == 9
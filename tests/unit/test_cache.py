@@ -0,0 +1,55 @@
+from unittest import mock
+
+from app.allocation.adapters import cache
+
+
+class FakeRedis:
+    def __init__(self) -> None:
+        self.data: dict[str, bytes] = {}
+
+    async def get(self, key: str) -> bytes | None:
+        return self.data.get(key)
+
+    async def set(self, key: str, value: bytes, ex: int) -> None:
+        self.data[key] = value
+
+    async def delete(self, *keys: str) -> None:
+        for key in keys:
+            self.data.pop(key, None)
+
+
+async def test_counts_hits_and_misses() -> None:
+    # Given
+    allocations_view_cache = cache.AllocationsViewCache(FakeRedis(), ttl=60)  # type: ignore
+    hits, misses = cache.CACHE_HITS.value(), cache.CACHE_MISSES.value()
+
+    # When
+    miss = await allocations_view_cache.get("SKU")
+    await allocations_view_cache.set("SKU", b"[]")
+    hit = await allocations_view_cache.get("SKU")
+
+    # Then
+    assert (miss, hit) == (None, b"[]")
+    assert cache.CACHE_HITS.value() == hits + 1
+    assert cache.CACHE_MISSES.value() == misses + 1
+
+
+async def test_invalidate_drops_cached_skus() -> None:
+    # Given
+    redis = FakeRedis()
+    allocations_view_cache = cache.AllocationsViewCache(redis, ttl=60)  # type: ignore
+    await allocations_view_cache.set("SKU1", b"[]")
+    await allocations_view_cache.set("SKU2", b"[]")
+
+    # When
+    await allocations_view_cache.invalidate("SKU1")
+
+    # Then
+    assert await allocations_view_cache.get("SKU1") is None
+    assert await allocations_view_cache.get("SKU2") == b"[]"
+
+
+async def test_sets_ttl() -> None:
+    redis = mock.AsyncMock()
+    await cache.AllocationsViewCache(redis, ttl=30).set("SKU", b"[]")
+    assert redis.set.call_args == mock.call("allocation:allocations_view:v1:SKU", b"[]", ex=30)
@@ -0,0 +1,97 @@
+import asyncio
+from collections.abc import Awaitable, Callable
+
+import pytest
+
+from app.allocation.adapters import dispatcher
+
+# crc32 puts b"SKU-1" on lane 0 and b"A" on lane 1 of 2
+
+
+def _record(calls: list[str], name: str, until: asyncio.Event = None) -> Callable[[], Awaitable[None]]:
+    async def call() -> None:
+        if until is not None:
+            await until.wait()
+        calls.append(name)
+
+    return call
+
+
+async def test_calls_with_same_key_run_in_submission_order() -> None:
+    # Given
+    keyed = dispatcher.KeyedDispatcher(lanes=2, queue_size=10)
+    calls: list[str] = []
+    blocked = asyncio.Event()
+
+    # When: the first call waits
+    futures = [
+        await keyed.submit(b"SKU-1", _record(calls, "first", until=blocked)),
+        await keyed.submit(b"SKU-1", _record(calls, "second")),
+    ]
+    await asyncio.sleep(0)
+    assert calls == []
+    blocked.set()
+    await asyncio.wait(futures)
+
+    # Then
+    assert calls == ["first", "second"]
+
+
+async def test_calls_with_other_keys_run_concurrently() -> None:
+    # Given
+    keyed = dispatcher.KeyedDispatcher(lanes=2, queue_size=10)
+    calls: list[str] = []
+    blocked = asyncio.Event()
+
+    # When: a call of another lane waits
+    slow = await keyed.submit(b"SKU-1", _record(calls, "slow", until=blocked))
+    fast = await keyed.submit(b"A", _record(calls, "fast"))
+    await fast
+
+    # Then
+    assert calls == ["fast"]
+    blocked.set()
+    await slow
+    assert calls == ["fast", "slow"]
+
+
+async def test_failed_call_fails_its_future_only() -> None:
+    # Given
+    keyed = dispatcher.KeyedDispatcher(lanes=2, queue_size=10)
+    calls: list[str] = []
+
+    async def fail() -> None:
+        raise Exception("boom")
+
+    # When
+    failed = await keyed.submit(b"SKU-1", fail)
+    succeeded = await keyed.submit(b"SKU-1", _record(calls, "next"))
+    await asyncio.wait([failed, succeeded])
+
+    # Then
+    with pytest.raises(Exception, match="boom"):
+        failed.result()
+    assert succeeded.result() is None
+    assert calls == ["next"]
+
+
+async def test_submit_waits_for_room_in_lane_and_exports_depth() -> None:
+    # Given: a lane busy with one call and holding another
+    keyed = dispatcher.KeyedDispatcher(lanes=2, queue_size=1)
+    calls: list[str] = []
+    blocked = asyncio.Event()
+    await keyed.submit(b"SKU-1", _record(calls, "busy", until=blocked))
+    await asyncio.sleep(0)
+    await keyed.submit(b"SKU-1", _record(calls, "queued"))
+    assert dispatcher.LANE_QUEUE_DEPTH.value(lane="0") == 1
+
+    # When
+    submit = asyncio.create_task(keyed.submit(b"SKU-1", _record(calls, "waiting")))
+    await asyncio.sleep(0.01)
+
+    # Then: the submission waits until the lane takes the queued call
+    assert not submit.done()
+    blocked.set()
+    await (await submit)
+    assert calls == ["busy", "queued", "waiting"]
+    assert dispatcher.LANE_QUEUE_DEPTH.value(lane="0") == 0
@@ -0,0 +1,106 @@
+import asyncio
+from collections.abc import AsyncGenerator
+from email import message_from_bytes
+from unittest import mock
+
+import pytest
+from pytest_mock import MockerFixture
+
+from app.allocation.adapters import email
+from app.config import config
+
+
+@pytest.fixture
+async def smtp_server(mocker: MockerFixture) -> AsyncGenerator[list[bytes], None]:
+    """A local stand-in for an SMTP server, answering just enough of the protocol. Yields what it received."""
+    received: list[bytes] = []
+
+    async def session(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        writer.write(b"220 localhost\r\n")
+        while line := await reader.readline():
+            command = line[:4].upper()
+            if command == b"DATA":
+                writer.write(b"354 go ahead\r\n")
+                received.append((await reader.readuntil(b"\r\n.\r\n"))[:-5])
+                writer.write(b"250 queued\r\n")
+            elif command == b"QUIT":
+                writer.write(b"221 bye\r\n")
+                break
+            else:
+                writer.write(b"250 ok\r\n")
+            await writer.drain()
+        writer.close()
+
+    server = await asyncio.start_server(session, "127.0.0.1", 0)
+    mocker.patch.object(config, "SMTP_HOST", "127.0.0.1")
+    mocker.patch.object(config, "SMTP_PORT", server.sockets[0].getsockname()[1])
+    async with server:
+        yield received
+
+
+async def test_send_delivers_the_email_over_smtp(smtp_server: list[bytes]) -> None:
+    # When
+    await email.send("stock@made.com", "Out of stock", "POPULAR-CURTAINS")
+
+    # Then
+    [received] = smtp_server
+    message = message_from_bytes(received)
+    assert message["To"] == "stock@made.com"
+    assert message["Subject"] == "Out of stock"
+    assert message.get_payload().strip() == "POPULAR-CURTAINS"
+
+
+async def test_digest_sends_each_line_once_per_window(mocker: MockerFixture) -> None:
+    # Given
+    mocker.patch.object(config, "EMAIL_DIGEST_WINDOW_MS", 50)
+    mock_send = mocker.patch("app.allocation.adapters.email.send")
+    digest = email.Digest("test", "stock@made.com", "Out of stock")
+
+    # When: a flood of lines, some of them added while the sender waits out the window
+    for _ in range(100):
+        digest.add("POPULAR-CURTAINS")
+    await asyncio.sleep(0.01)
+    digest.add("GARISH-RUG")
+    digest.add("POPULAR-CURTAINS")
+    await digest.join()
+
+    # Then
+    assert mock_send.call_args_list == [mock.call("stock@made.com", "Out of stock", "POPULAR-CURTAINS\nGARISH-RUG")]
+
+
+async def test_digest_drops_lines_beyond_its_queue_size(mocker: MockerFixture) -> None:
+    # Given
+    mocker.patch.object(config, "EMAIL_DIGEST_WINDOW_MS", 0)
+    mocker.patch.object(config, "EMAIL_DIGEST_QUEUE_SIZE", 2)
+    mock_send = mocker.patch("app.allocation.adapters.email.send")
+    digest = email.Digest("test_full", "stock@made.com", "Out of stock")
+
+    # When
+    for sku in ("POPULAR-CURTAINS", "GARISH-RUG", "OMINOUS-MIRROR"):
+        digest.add(sku)
+    await digest.join()
+
+    # Then
+    assert mock_send.call_args_list == [mock.call("stock@made.com", "Out of stock", "POPULAR-CURTAINS\nGARISH-RUG")]
+    assert email.DIGEST_LINES_DROPPED.value(digest="test_full") == 1
+
+
+async def test_digest_keeps_sending_after_a_failed_email(smtp_server: list[bytes], mocker: MockerFixture) -> None:
+    # Given
+    mocker.patch.object(config, "EMAIL_DIGEST_WINDOW_MS", 0)
+    digest = email.Digest("test_failed", "stock@made.com", "Out of stock")
+    port = config.SMTP_PORT
+    mocker.patch.object(config, "SMTP_PORT", 1)
+    digest.add("POPULAR-CURTAINS")
+    await digest.join()
+
+    # When
+    mocker.patch.object(config, "SMTP_PORT", port)
+    digest.add("GARISH-RUG")
+    await digest.join()
+
+    # Then
+    assert email.EMAIL_FAILURES.value(digest="test_failed") == 1
+    assert email.EMAILS_SENT.value(digest="test_failed") == 1
+    [received] = smtp_server
+    assert message_from_bytes(received).get_payload().strip() == "GARISH-RUG"
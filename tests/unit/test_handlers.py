@@ -1,15 +1,18 @@
 # pylint: disable=no-self-use
+import asyncio
 from datetime import date
 from typing import Any
 from unittest import mock
 from uuid import UUID, uuid4
 
+import orjson
 import pytest
 from pytest_mock import MockerFixture
 
-from app.allocation.adapters import repository
-from app.allocation.domain import commands, models
-from app.allocation.service_layer import handlers, unit_of_work
+from app.allocation.adapters import email, outbox, repository
+from app.allocation.domain import commands, events, models
+from app.allocation.service_layer import coalescing, handlers, messagebus, unit_of_work
+from app.config import config
 
 
 class FakeRepository(repository.AbstractProductRepository):
@@ -17,19 +20,29 @@ class FakeRepository(repository.AbstractProductRepository):
         super().__init__()
         self._products = set(products)
 
-    async def add(self, product: models.Product) -> None:
+    async def _add(self, product: models.Product) -> None:
         self._products.add(product)
 
-    async def get(self, sku: str) -> models.Product:
+    async def _get(self, sku: str) -> models.Product:
         return next((p for p in self._products if p.sku == sku), None)
 
-    async def get_by_batch_id(self, batch_id: UUID) -> models.Product:
+    async def _get_by_batch_id(self, batch_id: UUID) -> models.Product:
         return next((p for p in self._products for b in p.batches if b.id == batch_id), None)
 
 
+class FakeOutbox(outbox.AbstractOutbox):
+    def __init__(self) -> None:
+        self.messages: list[outbox.Message] = []
+
+    async def add(self, *messages: outbox.Message) -> None:
+        self.messages.extend(messages)
+
+
 class FakeUnitOfWork(unit_of_work.AbstractUnitOfWork):
     def __init__(self) -> None:
+        super().__init__()
         self._products = FakeRepository([])
+        self._outbox = FakeOutbox()
         self.committed = False
 
     async def __aexit__(self, *args: Any) -> None:
@@ -39,13 +52,21 @@ class FakeUnitOfWork(unit_of_work.AbstractUnitOfWork):
     def products(self) -> repository.AbstractProductRepository:
         return self._products
 
-    async def commit(self) -> None:
+    @property
+    def outbox(self) -> FakeOutbox:
+        return self._outbox
+
+    async def _commit(self) -> None:
         self.committed = True
 
     async def rollback(self) -> None:
         pass
 
 
+def bus(uow: FakeUnitOfWork) -> messagebus.MessageBus:
+    return messagebus.MessageBus(lambda: uow, messagebus.command_handlers(), messagebus.EVENT_HANDLERS)
+
+
 class TestAddBatch:
     async def test_for_new_product(self) -> None:
         uow = FakeUnitOfWork()
@@ -72,10 +93,8 @@ class TestAddBatch:
 
 
 class TestAllocate:
-    async def test_returns_allocation(self, mocker: MockerFixture) -> None:
+    async def test_returns_allocation(self) -> None:
         uow = FakeUnitOfWork()
-        mock_redis = mocker.patch("app.allocation.service_layer.handlers.redis", return_value=mock.AsyncMock)
-        mock_redis.attach_mock(mock_redis, "publish")
 
         await handlers.CreateBatchCmdHandler(uow).handle(
             commands.CreateBatch(UUID("b4cf5213-6e1f-46cc-8302-aac1f12ac617"), "COMPLICATED-LAMP", 100)
@@ -84,10 +103,14 @@ class TestAllocate:
             commands.Allocate(UUID("c3370153-5d1c-4059-9a2a-4a39267afc27"), "COMPLICATED-LAMP", 10)
         )
 
-        assert mock_redis.call_args == mock.call(
-            "allocation:order_allocated:v1",
-            b'{"order_id":"c3370153-5d1c-4059-9a2a-4a39267afc27","sku":"COMPLICATED-LAMP","qty":10,"batch_id":"b4cf5213-6e1f-46cc-8302-aac1f12ac617"}',
-        )
+        # the first message is the new batch's BatchChanged
+        assert uow.outbox.messages[1:] == [
+            outbox.Message(
+                "allocation:order_allocated:v1",
+                "COMPLICATED-LAMP",
+                b'{"order_id":"c3370153-5d1c-4059-9a2a-4a39267afc27","sku":"COMPLICATED-LAMP","qty":10,"batch_id":"b4cf5213-6e1f-46cc-8302-aac1f12ac617"}',  # noqa: E501
+            )
+        ]
         assert batch_id == UUID("b4cf5213-6e1f-46cc-8302-aac1f12ac617")
 
     async def test_errors_for_invalid_sku(self) -> None:
@@ -95,10 +118,8 @@ class TestAllocate:
         with pytest.raises(handlers.InvalidSku, match="Invalid sku NONEXISTENTSKU"):
             await handlers.AllocateCmdHandler(uow).handle(commands.Allocate(uuid4(), "NONEXISTENTSKU", 10))
 
-    async def test_allocate_handler_commit(self, mocker: MockerFixture) -> None:
+    async def test_allocate_handler_commit(self) -> None:
         uow = FakeUnitOfWork()
-        mock_redis = mocker.patch("app.allocation.service_layer.handlers.redis", return_value=mock.AsyncMock)
-        mock_redis.attach_mock(mock_redis, "publish")
 
         await handlers.CreateBatchCmdHandler(uow).handle(
             commands.CreateBatch(UUID("0cf8c64c-efd3-4b18-994b-9254ee7c3c93"), "OMINOUS-MIRROR", 100, None)
@@ -107,20 +128,174 @@ class TestAllocate:
             commands.Allocate(UUID("1156164c-1ed1-4726-b315-5db7ac65ebb5"), "OMINOUS-MIRROR", 10)
         )
 
-        assert mock_redis.call_args == mock.call(
-            "allocation:order_allocated:v1",
-            b'{"order_id":"1156164c-1ed1-4726-b315-5db7ac65ebb5","sku":"OMINOUS-MIRROR","qty":10,"batch_id":"0cf8c64c-efd3-4b18-994b-9254ee7c3c93"}',
-        )
+        # the first message is the new batch's BatchChanged
+        assert uow.outbox.messages[1:] == [
+            outbox.Message(
+                "allocation:order_allocated:v1",
+                "OMINOUS-MIRROR",
+                b'{"order_id":"1156164c-1ed1-4726-b315-5db7ac65ebb5","sku":"OMINOUS-MIRROR","qty":10,"batch_id":"0cf8c64c-efd3-4b18-994b-9254ee7c3c93"}',  # noqa: E501
+            )
+        ]
         assert uow.committed
 
     async def test_sends_email_on_out_of_stock_error(self, mocker: MockerFixture) -> None:
         uow = FakeUnitOfWork()
         mock_send_mail = mocker.patch("app.allocation.adapters.email.send")
 
-        await handlers.CreateBatchCmdHandler(uow).handle(commands.CreateBatch(uuid4(), "POPULAR-CURTAINS", 9, None))
-        await handlers.AllocateCmdHandler(uow).handle(commands.Allocate(uuid4(), "POPULAR-CURTAINS", 10))
+        await bus(uow).handle(commands.CreateBatch(uuid4(), "POPULAR-CURTAINS", 9, None))
+        await bus(uow).handle(commands.Allocate(uuid4(), "POPULAR-CURTAINS", 10))
+        await email.OUT_OF_STOCK.join()
+
+        assert mock_send_mail.call_args == mock.call("stock@made.com", "Out of stock", "POPULAR-CURTAINS")
+
+
+class TestAllocateMany:
+    async def test_returns_allocations_by_order_id(self, mocker: MockerFixture) -> None:
+        uow = FakeUnitOfWork()
+        mocker.patch("app.allocation.adapters.email.send")
+
+        await handlers.CreateBatchCmdHandler(uow).handle(
+            commands.CreateBatch(UUID("b4cf5213-6e1f-46cc-8302-aac1f12ac617"), "COMPLICATED-LAMP", 15)
+        )
+        lines = [
+            commands.Allocate(UUID("c3370153-5d1c-4059-9a2a-4a39267afc27"), "COMPLICATED-LAMP", 10),
+            commands.Allocate(UUID("1156164c-1ed1-4726-b315-5db7ac65ebb5"), "NONEXISTENTSKU", 10),
+            commands.Allocate(UUID("57e0e250-93f2-4378-b44e-307838b4c367"), "COMPLICATED-LAMP", 10),
+        ]
+        results = await handlers.AllocateManyCmdHandler(uow).handle(commands.AllocateMany(lines))
+
+        assert results == {
+            UUID("c3370153-5d1c-4059-9a2a-4a39267afc27"): UUID("b4cf5213-6e1f-46cc-8302-aac1f12ac617"),
+            UUID("57e0e250-93f2-4378-b44e-307838b4c367"): None,
+        }
+        assert uow.committed
 
-        assert mock_send_mail.call_args == mock.call("stock@made.com", "Out of stock for POPULAR-CURTAINS")
+    async def test_writes_allocations_to_outbox(self) -> None:
+        uow = FakeUnitOfWork()
+
+        await handlers.CreateBatchCmdHandler(uow).handle(
+            commands.CreateBatch(UUID("b4cf5213-6e1f-46cc-8302-aac1f12ac617"), "COMPLICATED-LAMP", 100)
+        )
+        lines = [commands.Allocate(uuid4(), "COMPLICATED-LAMP", 10) for _ in range(3)]
+        await handlers.AllocateManyCmdHandler(uow).handle(commands.AllocateMany(lines))
+
+        assert [m.channel for m in uow.outbox.messages[1:]] == ["allocation:order_allocated:v1"] * 3
+        assert (await uow.products.get("COMPLICATED-LAMP")).version_number == 1
+
+    async def test_sends_one_email_per_out_of_stock_sku(self, mocker: MockerFixture) -> None:
+        uow = FakeUnitOfWork()
+        mock_send_mail = mocker.patch("app.allocation.adapters.email.send")
+
+        await bus(uow).handle(commands.CreateBatch(uuid4(), "POPULAR-CURTAINS", 9, None))
+        lines = [commands.Allocate(uuid4(), "POPULAR-CURTAINS", 10) for _ in range(3)]
+        await bus(uow).handle(commands.AllocateMany(lines))
+        await email.OUT_OF_STOCK.join()
+
+        assert mock_send_mail.call_args_list == [mock.call("stock@made.com", "Out of stock", "POPULAR-CURTAINS")]
+
+
+class TestMessageBus:
+    async def test_handles_raised_events_grouped_by_type_after_every_command(self, mocker: MockerFixture) -> None:
+        # Given
+        uow = FakeUnitOfWork()
+        mock_send_mail = mocker.patch("app.allocation.adapters.email.send")
+        await bus(uow).handle_many(
+            [
+                commands.CreateBatch(uuid4(), "POPULAR-CURTAINS", 9, None),
+                commands.CreateBatch(uuid4(), "GARISH-RUG", 9, None),
+            ]
+        )
+
+        # When
+        results = await bus(uow).handle_many(
+            [
+                commands.Allocate(uuid4(), "POPULAR-CURTAINS", 10),
+                commands.Allocate(uuid4(), "GARISH-RUG", 10),
+                commands.Allocate(uuid4(), "POPULAR-CURTAINS", 10),
+            ]
+        )
+
+        # Then: one email listing each sku once, queued once every allocation was committed
+        await email.OUT_OF_STOCK.join()
+        assert results == [None] * 3
+        assert mock_send_mail.call_args_list == [
+            mock.call("stock@made.com", "Out of stock", "POPULAR-CURTAINS\nGARISH-RUG")
+        ]
+
+    async def test_handles_runs_of_events_passed_in_at_once(self) -> None:
+        # Given
+        handled: list[list[events.Event]] = []
+
+        async def handler(batch: list[events.Event]) -> None:
+            handled.append(batch)
+
+        event_bus = messagebus.MessageBus(
+            FakeUnitOfWork, {}, {events.OutOfStock: [handler], events.Deallocated: [handler]}
+        )
+        out_of_stock = [events.OutOfStock("POPULAR-CURTAINS"), events.OutOfStock("GARISH-RUG")]
+        deallocated = events.Deallocated(uuid4(), "GARISH-RUG", 10)
+
+        # When
+        await event_bus.handle_many([*out_of_stock, deallocated])
+
+        # Then
+        assert handled == [out_of_stock, [deallocated]]
+
+    async def test_logs_failing_handlers_of_raised_events(self, mocker: MockerFixture) -> None:
+        # Given
+        uow = FakeUnitOfWork()
+        mocker.patch.object(email.OUT_OF_STOCK, "add", side_effect=RuntimeError)
+        await bus(uow).handle(commands.CreateBatch(uuid4(), "POPULAR-CURTAINS", 9, None))
+
+        # When
+        batch_id = await bus(uow).handle(commands.Allocate(uuid4(), "POPULAR-CURTAINS", 10))
+
+        # Then: the allocation is committed regardless
+        assert batch_id is None
+        assert uow.committed
+
+
+class TestCoalescingAllocate:
+    @pytest.fixture(autouse=True)
+    def short_idle(self, mocker: MockerFixture) -> None:
+        mocker.patch.object(config, "ALLOCATION_COALESCING_IDLE_MS", 10)
+
+    async def test_allocates_concurrent_orders_in_one_commit(self) -> None:
+        # Given
+        uow = FakeUnitOfWork()
+        await handlers.CreateBatchCmdHandler(uow).handle(
+            commands.CreateBatch(UUID("b4cf5213-6e1f-46cc-8302-aac1f12ac617"), "COMPLICATED-LAMP", 25)
+        )
+        handler = coalescing.CoalescingAllocateCmdHandler(bus(uow))
+
+        # When
+        batch_ids = await asyncio.gather(
+            *(handler.handle(commands.Allocate(uuid4(), "COMPLICATED-LAMP", 10)) for _ in range(3))
+        )
+
+        # Then: orders are allocated in arrival order, and the product is changed once
+        assert batch_ids == [UUID("b4cf5213-6e1f-46cc-8302-aac1f12ac617")] * 2 + [None]
+        assert (await uow.products.get("COMPLICATED-LAMP")).version_number == 1
+        assert [m.channel for m in uow.outbox.messages[1:]] == ["allocation:order_allocated:v1"] * 2
+
+    async def test_errors_for_invalid_sku(self) -> None:
+        handler = coalescing.CoalescingAllocateCmdHandler(bus(FakeUnitOfWork()))
+        with pytest.raises(handlers.InvalidSku, match="Invalid sku NONEXISTENTSKU"):
+            await handler.handle(commands.Allocate(uuid4(), "NONEXISTENTSKU", 10))
+
+    async def test_owner_stops_when_idle(self) -> None:
+        # Given
+        uow = FakeUnitOfWork()
+        await handlers.CreateBatchCmdHandler(uow).handle(commands.CreateBatch(uuid4(), "COMPLICATED-LAMP", 25))
+        handler = coalescing.CoalescingAllocateCmdHandler(bus(uow))
+
+        # When
+        await handler.handle(commands.Allocate(uuid4(), "COMPLICATED-LAMP", 10))
+        await asyncio.sleep(0.05)
+
+        # Then
+        assert handler._queues == {}
+        assert handler._owners == set()
 
 
 class TestChangeBatchQuantity:
@@ -137,7 +312,7 @@ class TestChangeBatchQuantity:
 
         assert batch.available_quantity == 50
 
-    async def test_reallocates_if_necessary(self, mocker: MockerFixture) -> None:
+    async def test_reallocates_if_necessary(self) -> None:
         # Given
         uow = FakeUnitOfWork()
 
@@ -147,32 +322,62 @@ class TestChangeBatchQuantity:
         await handlers.CreateBatchCmdHandler(uow).handle(
             commands.CreateBatch(UUID("e9c6851c-e74a-40ac-8e86-3956f4762853"), "INDIFFERENT-TABLE", 50, date.today())
         )
-        with mock.patch("app.allocation.service_layer.handlers.redis", return_value=mock.AsyncMock) as mock_redis:
-            mock_redis.attach_mock(mock_redis, "publish")
-            await handlers.AllocateCmdHandler(uow).handle(
-                commands.Allocate(UUID("57e0e250-93f2-4378-b44e-307838b4c367"), "INDIFFERENT-TABLE", 40)
-            )
-            await handlers.AllocateCmdHandler(uow).handle(
-                commands.Allocate(UUID("1406c359-13b6-422d-8507-b24a0c763abd"), "INDIFFERENT-TABLE", 20)
-            )
+        await handlers.AllocateCmdHandler(uow).handle(
+            commands.Allocate(UUID("57e0e250-93f2-4378-b44e-307838b4c367"), "INDIFFERENT-TABLE", 40)
+        )
+        await handlers.AllocateCmdHandler(uow).handle(
+            commands.Allocate(UUID("1406c359-13b6-422d-8507-b24a0c763abd"), "INDIFFERENT-TABLE", 20)
+        )
         [batch1, batch2] = (await uow.products.get(sku="INDIFFERENT-TABLE")).batches
         assert batch1.available_quantity == 10
         assert batch2.available_quantity == 30
 
         # When
-        def mock_publish(channel: str, message: bytes) -> None:
-            assert channel == "allocation:order_deallocated:v1"
-            assert message == b'{"order_id":"57e0e250-93f2-4378-b44e-307838b4c367","sku":"INDIFFERENT-TABLE","qty":40}'
-
-        mock_pipeline = mock.AsyncMock()
-        mock_pipeline.publish = mock_publish
-        mocker.patch(
-            "app.allocation.service_layer.handlers.redis.pipeline",
-            return_value=mock_pipeline,
-        )
         await handlers.ChangeBatchQuantityCmdHandler(uow).handle(
             commands.ChangeBatchQuantity(UUID("874c6d0d-84e6-4307-b9d5-e23ec78bb727"), 25)
         )
 
         # Then
         assert batch1.available_quantity == 25
+        assert uow.outbox.messages[-1] == outbox.Message(
+            "allocation:order_deallocated:v1",
+            "INDIFFERENT-TABLE",
+            b'{"order_id":"57e0e250-93f2-4378-b44e-307838b4c367","sku":"INDIFFERENT-TABLE","qty":40}',
+        )
+
+    async def test_reallocates_in_bulk_and_leaves_the_rest_deallocated(self) -> None:
+        # Given: two orders on the batch to shrink, room for only one of them elsewhere
+        uow = FakeUnitOfWork()
+        await handlers.CreateBatchCmdHandler(uow).handle(
+            commands.CreateBatch(UUID("874c6d0d-84e6-4307-b9d5-e23ec78bb727"), "INDIFFERENT-TABLE", 50, None)
+        )
+        await handlers.AllocateCmdHandler(uow).handle(
+            commands.Allocate(UUID("57e0e250-93f2-4378-b44e-307838b4c367"), "INDIFFERENT-TABLE", 25)
+        )
+        await handlers.AllocateCmdHandler(uow).handle(
+            commands.Allocate(UUID("1406c359-13b6-422d-8507-b24a0c763abd"), "INDIFFERENT-TABLE", 25)
+        )
+        await handlers.CreateBatchCmdHandler(uow).handle(
+            commands.CreateBatch(UUID("e9c6851c-e74a-40ac-8e86-3956f4762853"), "INDIFFERENT-TABLE", 25, date.today())
+        )
+        product = await uow.products.get(sku="INDIFFERENT-TABLE")
+        version_number = product.version_number
+        messages = len(uow.outbox.messages)
+
+        # When
+        await handlers.ChangeBatchQuantityCmdHandler(uow, reallocate=True).handle(
+            commands.ChangeBatchQuantity(UUID("874c6d0d-84e6-4307-b9d5-e23ec78bb727"), 0)
+        )
+
+        # Then
+        [batch1, batch2] = product.batches
+        assert batch1.allocated_quantity == 0
+        assert batch2.available_quantity == 0
+        assert product.version_number == version_number + 1
+        [batch_changed, deallocated, reallocated] = uow.outbox.messages[messages:]
+        assert batch_changed.channel == "allocation:batch_changed:v1"
+        assert reallocated.channel == "allocation:orders_reallocated:v1"
+        assert deallocated.channel == "allocation:order_deallocated:v1"
+        [allocation] = orjson.loads(reallocated.data)["allocations"]
+        assert allocation["batch_id"] == "e9c6851c-e74a-40ac-8e86-3956f4762853"
+        assert orjson.loads(deallocated.data)["order_id"] != allocation["order_id"]
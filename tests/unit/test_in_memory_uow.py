@@ -0,0 +1,180 @@
+import asyncio
+from uuid import UUID, uuid4
+
+import pytest
+
+from app.allocation.adapters.repository import InMemoryDatabase
+from app.allocation.domain import commands, models
+from app.allocation.service_layer import messagebus
+from app.allocation.service_layer.unit_of_work import ConcurrencyConflict, InMemoryUnitOfWork
+
+
+async def _add_product(db: InMemoryDatabase, *batches: models.Batch) -> None:
+    async with InMemoryUnitOfWork(db) as uow:
+        await uow.products.add(models.Product(sku="RETRO-CLOCK", batches=list(batches)))
+        await uow.commit()
+
+
+async def test_commit_saves_product_and_publishes_messages() -> None:
+    # Given
+    db = InMemoryDatabase()
+    batch = models.Batch(id=UUID("9c5d341f-4876-4a54-81f7-720a390884fb"), sku="RETRO-CLOCK", qty=100)
+    await _add_product(db, batch)
+
+    # When
+    async with InMemoryUnitOfWork(db) as uow:
+        product = await uow.products.get("RETRO-CLOCK")
+        product.allocate(models.Order(sku="RETRO-CLOCK", qty=10))
+        await uow.commit()
+
+    # Then: like the ORM, a new product gets version 1 and every allocation one more
+    async with InMemoryUnitOfWork(db) as uow:
+        product = await uow.products.get("RETRO-CLOCK")
+        assert product.version_number == 2
+        [loaded] = product.batches
+        assert loaded.available_quantity == 90
+    assert [message.channel for message in db.messages] == ["allocation:order_allocated:v1"]
+
+
+async def test_get_loads_the_allocations_of_orders_to_allocate() -> None:
+    # Given
+    db = InMemoryDatabase()
+    await _add_product(db, models.Batch(sku="RETRO-CLOCK", qty=100))
+    order = models.Order(sku="RETRO-CLOCK", qty=10)
+    async with InMemoryUnitOfWork(db) as uow:
+        (await uow.products.get("RETRO-CLOCK")).allocate(order)
+        await uow.commit()
+
+    # When
+    async with InMemoryUnitOfWork(db) as uow:
+        product = await uow.products.get("RETRO-CLOCK", allocating=[order])
+        batch_id = product.allocate(order)
+        await uow.commit()
+
+    # Then
+    assert batch_id is None
+    [batch] = db.products["RETRO-CLOCK"].batches
+    assert batch.allocations == {order}
+    assert batch.available_quantity == 90
+
+
+async def test_rollback_uncommitted_work_by_default() -> None:
+    # Given
+    db = InMemoryDatabase()
+    await _add_product(db, models.Batch(sku="RETRO-CLOCK", qty=100))
+
+    # When
+    async with InMemoryUnitOfWork(db) as uow:
+        product = await uow.products.get("RETRO-CLOCK")
+        product.allocate(models.Order(sku="RETRO-CLOCK", qty=10))
+        product.add_batch(models.Batch(sku="RETRO-CLOCK", qty=50))
+
+    # Then
+    async with InMemoryUnitOfWork(db) as uow:
+        product = await uow.products.get("RETRO-CLOCK")
+        assert product.version_number == 1
+        [batch] = product.batches
+        assert batch.available_quantity == 100
+    assert db.messages == []
+
+
+async def test_concurrent_updates_to_version_are_not_allowed() -> None:
+    # Given
+    db = InMemoryDatabase()
+    await _add_product(db, models.Batch(sku="RETRO-CLOCK", qty=100))
+    exceptions = []
+
+    async def allocate(order: models.Order) -> None:
+        try:
+            async with InMemoryUnitOfWork(db) as uow:
+                product = await uow.products.get("RETRO-CLOCK")
+                product.allocate(order)
+                await asyncio.sleep(0.01)
+                await uow.commit()
+        except Exception as e:
+            exceptions.append(e)
+
+    # When
+    await asyncio.gather(
+        allocate(models.Order(sku="RETRO-CLOCK", qty=3)), allocate(models.Order(sku="RETRO-CLOCK", qty=7))
+    )
+
+    # Then
+    [exception] = exceptions
+    assert isinstance(exception, ConcurrencyConflict)
+    [batch] = db.products["RETRO-CLOCK"].batches
+    assert db.products["RETRO-CLOCK"].version_number == 2
+    assert len(batch.allocations) == 1
+
+
+async def test_changes_without_new_version_are_merged_batch_by_batch() -> None:
+    # Given
+    db = InMemoryDatabase()
+    batch = models.Batch(sku="RETRO-CLOCK", qty=100)
+    await _add_product(db, batch)
+
+    async def allocate() -> None:
+        async with InMemoryUnitOfWork(db) as uow:
+            product = await uow.products.get("RETRO-CLOCK")
+            product.allocate(models.Order(sku="RETRO-CLOCK", qty=10))
+            await asyncio.sleep(0.01)
+            await uow.commit()
+
+    async def add_batch() -> None:
+        async with InMemoryUnitOfWork(db) as uow:
+            product = await uow.products.get("RETRO-CLOCK")
+            product.add_batch(models.Batch(sku="RETRO-CLOCK", qty=50))
+            await asyncio.sleep(0.01)
+            await uow.commit()
+
+    # When
+    await asyncio.gather(allocate(), add_batch())
+
+    # Then
+    async with InMemoryUnitOfWork(db) as uow:
+        product = await uow.products.get("RETRO-CLOCK")
+        assert sorted(b.available_quantity for b in product.batches) == [50, 90]
+
+
+async def test_get_by_batch_id_loads_the_allocations_to_deallocate() -> None:
+    # Given
+    db = InMemoryDatabase()
+    batch = models.Batch(sku="RETRO-CLOCK", qty=100)
+    await _add_product(db, batch)
+    bus = messagebus.MessageBus(lambda: InMemoryUnitOfWork(db), messagebus.command_handlers(), {})
+    await bus.handle_many([commands.Allocate(uuid4(), "RETRO-CLOCK", 30) for _ in range(3)])
+
+    # When
+    await bus.handle(commands.ChangeBatchQuantity(batch.id, 50))
+
+    # Then
+    async with InMemoryUnitOfWork(db) as uow:
+        product = await uow.products.get_by_batch_id(batch.id)
+        [loaded] = product.batches
+        assert loaded.available_quantity == 20
+        assert len(loaded.allocations) == 1
+    assert [message.channel for message in db.messages[3:]] == [
+        "allocation:batch_changed:v1",
+        "allocation:order_deallocated:v1",
+        "allocation:order_deallocated:v1",
+    ]
+
+
+async def test_unknown_batch_id() -> None:
+    async with InMemoryUnitOfWork(InMemoryDatabase()) as uow:
+        assert await uow.products.get_by_batch_id(uuid4()) is None
+
+
+async def test_concurrently_added_product_is_not_overwritten() -> None:
+    # Given
+    db = InMemoryDatabase()
+
+    async def add() -> None:
+        async with InMemoryUnitOfWork(db) as uow:
+            await uow.products.add(models.Product(sku="RETRO-CLOCK", batches=[]))
+            await asyncio.sleep(0.01)
+            await uow.commit()
+
+    # When / Then
+    with pytest.raises(ConcurrencyConflict, match="Product RETRO-CLOCK was added concurrently"):
+        await asyncio.gather(add(), add())
@@ -0,0 +1,58 @@
+import asyncio
+
+from app.allocation.adapters import metrics
+
+
+def test_render_prometheus_text_format() -> None:
+    # Given
+    counter = metrics.Counter("test_requests_total", "Requests", labelnames=("path",))
+    gauge = metrics.Gauge("test_in_flight", "In flight requests")
+
+    # When
+    counter.inc(path="/allocate")
+    counter.inc(2, path="/allocate")
+    gauge.inc()
+
+    # Then
+    text = metrics.render()
+    assert "# TYPE test_requests_total counter\n" in text
+    assert 'test_requests_total{path="/allocate"} 3\n' in text
+    assert "test_in_flight 1\n" in text
+
+
+def test_render_histogram_buckets_cumulatively() -> None:
+    # Given
+    histogram = metrics.Histogram("test_duration_seconds", "Durations", labelnames=("path",), buckets=(0.1, 1))
+
+    # When
+    for value in (0.05, 0.1, 0.5, 3):
+        histogram.observe(value, path="/allocate")
+
+    # Then
+    text = metrics.render()
+    assert "# TYPE test_duration_seconds histogram\n" in text
+    assert 'test_duration_seconds_bucket{path="/allocate",le="0.1"} 2\n' in text
+    assert 'test_duration_seconds_bucket{path="/allocate",le="1"} 3\n' in text
+    assert 'test_duration_seconds_bucket{path="/allocate",le="+Inf"} 4\n' in text
+    assert 'test_duration_seconds_count{path="/allocate"} 4\n' in text
+    assert histogram.value(path="/allocate") == 3.65
+    assert histogram.count(path="/allocate") == 4
+
+
+async def test_server_answers_get_metrics() -> None:
+    # Given
+    metrics.Counter("test_served_total", "Served").inc()
+    server = await metrics.server("127.0.0.1", 0)
+    port = server.sockets[0].getsockname()[1]
+
+    # When
+    async with server:
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        writer.write(b"GET /metrics HTTP/1.1\r\nHost: worker\r\n\r\n")
+        response = await reader.read()
+        writer.close()
+
+    # Then
+    assert response.startswith(b"HTTP/1.1 200 OK\r\n")
+    assert b"\r\n\r\n" in response
+    assert b"test_served_total 1\n" in response
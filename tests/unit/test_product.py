@@ -1,6 +1,17 @@
 from datetime import date, timedelta
 
-from app.allocation.domain.models import Batch, Order, Product
+import pytest
+
+from app.allocation.domain import events
+from app.allocation.domain.models import (
+    DEALLOCATION_STRATEGIES,
+    Batch,
+    DeallocationStrategy,
+    Order,
+    Product,
+    best_fit,
+    largest_first,
+)
 
 
 def test_perfers_none_eta_batches_to_allocate() -> None:
@@ -72,3 +83,197 @@ def test_increment_version_number() -> None:
 
     # Then
     assert product.version_number == 8
+
+
+def test_skips_exhausted_batches() -> None:
+    # Given
+    in_stock_batch = Batch(sku="SMALL-FORK", qty=10)
+    shipment_batch = Batch(sku="SMALL-FORK", qty=10, eta=date.today())
+    product = Product(sku="SMALL-FORK", batches=[in_stock_batch, shipment_batch])
+    product.allocate(Order(sku="SMALL-FORK", qty=10))
+
+    # When
+    batch_id = product.allocate(Order(sku="SMALL-FORK", qty=1))
+
+    # Then
+    assert batch_id == shipment_batch.id
+    assert list(product.batch_queue) == [shipment_batch]
+
+
+def test_allocates_to_batch_freed_by_quantity_change() -> None:
+    # Given
+    in_stock_batch = Batch(sku="SMALL-FORK", qty=10)
+    shipment_batch = Batch(sku="SMALL-FORK", qty=10, eta=date.today())
+    product = Product(sku="SMALL-FORK", batches=[in_stock_batch, shipment_batch])
+    product.allocate(Order(sku="SMALL-FORK", qty=10))
+
+    # When
+    product.change_batch_quantity(in_stock_batch.id, 20)
+    batch_id = product.allocate(Order(sku="SMALL-FORK", qty=1))
+
+    # Then
+    assert batch_id == in_stock_batch.id
+
+
+def test_added_batch_is_prioritised_by_eta() -> None:
+    # Given
+    medium = Batch(sku="MINIMALIST-SPOON", qty=100, eta=date.today() + timedelta(days=1))
+    product = Product(sku="MINIMALIST-SPOON", batches=[medium])
+    product.allocate(Order(sku="MINIMALIST-SPOON", qty=10))
+
+    # When
+    earliest = Batch(sku="MINIMALIST-SPOON", qty=100, eta=date.today())
+    product.add_batch(earliest)
+    batch_id = product.allocate(Order(sku="MINIMALIST-SPOON", qty=10))
+
+    # Then
+    assert batch_id == earliest.id
+
+
+def test_batches_appended_directly_are_picked_up() -> None:
+    # Given
+    product = Product(sku="MINIMALIST-SPOON", batches=[])
+    product.allocate(Order(sku="MINIMALIST-SPOON", qty=10))
+
+    # When
+    batch = Batch(sku="MINIMALIST-SPOON", qty=100)
+    product.batches.append(batch)
+
+    # Then
+    assert product.allocate(Order(sku="MINIMALIST-SPOON", qty=10)) == batch.id
+
+
+def test_changing_eta_reprioritises_batch() -> None:
+    # Given
+    earliest = Batch(sku="MINIMALIST-SPOON", qty=100, eta=date.today())
+    latest = Batch(sku="MINIMALIST-SPOON", qty=100, eta=date.today() + timedelta(days=2))
+    product = Product(sku="MINIMALIST-SPOON", batches=[earliest, latest])
+
+    # When
+    product.change_batch_eta(latest.id, date.today() - timedelta(days=1))
+
+    # Then
+    assert product.allocate(Order(sku="MINIMALIST-SPOON", qty=10)) == latest.id
+
+
+def test_allocate_many_increments_version_number_once() -> None:
+    # Given
+    batch = Batch(sku="HIGHBROW-POSTER", qty=15)
+    product = Product(sku="HIGHBROW-POSTER", batches=[batch], version_number=7)
+    orders = [Order(sku="HIGHBROW-POSTER", qty=10) for _ in range(2)]
+
+    # When
+    batch_ids = product.allocate_many(orders)
+
+    # Then
+    assert batch_ids == [batch.id, None]
+    assert product.version_number == 8
+
+
+def test_change_batch_quantity_deallocates_fewest_orders() -> None:
+    # Given: one large order and many small ones
+    batch = Batch(sku="SMALL-FORK", qty=100)
+    product = Product(sku="SMALL-FORK", batches=[batch])
+    small_orders = [Order(sku="SMALL-FORK", qty=1) for _ in range(50)]
+    for order in small_orders:
+        product.allocate(order)
+    large_order = Order(sku="SMALL-FORK", qty=40)
+    product.allocate(large_order)
+
+    # When
+    deallocated = product.change_batch_quantity(batch.id, 60)
+
+    # Then
+    assert deallocated == [large_order]
+    assert batch.available_quantity == 10
+
+
+@pytest.mark.parametrize("strategy", DEALLOCATION_STRATEGIES.values())
+def test_deallocation_strategies_cover_deficit(strategy: DeallocationStrategy) -> None:
+    # Given
+    allocations = {Order(sku="SMALL-FORK", qty=qty) for qty in (1, 2, 3, 5, 8, 13)}
+
+    # When
+    deallocated = strategy(allocations, 15)
+
+    # Then
+    assert sum(order.qty for order in deallocated) >= 15
+    assert len(set(deallocated)) == len(deallocated)
+
+
+def test_largest_first_deallocates_largest_orders() -> None:
+    # Given
+    allocations = {Order(sku="SMALL-FORK", qty=qty) for qty in (1, 2, 3, 5, 8, 13)}
+
+    # When
+    deallocated = largest_first(allocations, 15)
+
+    # Then
+    assert [order.qty for order in deallocated] == [13, 8]
+
+
+def test_best_fit_ends_on_smallest_order_covering_the_rest() -> None:
+    # Given
+    allocations = {Order(sku="SMALL-FORK", qty=qty) for qty in (1, 2, 3, 5, 8, 13)}
+
+    # When
+    deallocated = best_fit(allocations, 15)
+
+    # Then: as many orders as largest first, 6 units less deallocated
+    assert [order.qty for order in deallocated] == [13, 2]
+
+
+def test_records_allocation_events() -> None:
+    # Given
+    batch = Batch(sku="RETRO-CLOCK", qty=10)
+    product = Product(sku="RETRO-CLOCK", batches=[batch])
+    order = Order(sku="RETRO-CLOCK", qty=10)
+
+    # When
+    product.allocate(order)
+    product.allocate(Order(sku="RETRO-CLOCK", qty=1))
+
+    # Then
+    assert product.events == [events.Allocated(order.id, "RETRO-CLOCK", 10, batch.id), events.OutOfStock("RETRO-CLOCK")]
+
+
+def test_reallocate_replaces_deallocated_events_of_reallocated_orders() -> None:
+    # Given: two orders on the batch to shrink, room for only one of them elsewhere
+    shrinking = Batch(sku="RETRO-CLOCK", qty=20)
+    product = Product(sku="RETRO-CLOCK", batches=[shrinking])
+    first, second = Order(sku="RETRO-CLOCK", qty=10), Order(sku="RETRO-CLOCK", qty=10)
+    product.allocate_many([first, second])
+    spare = Batch(sku="RETRO-CLOCK", qty=10, eta=date.today())
+    product.add_batch(spare)
+    product.events.clear()
+
+    # When
+    orders = product.change_batch_quantity(shrinking.id, 0)
+    batch_ids = product.reallocate(orders)
+
+    # Then
+    [left] = [order for order, batch_id in zip(orders, batch_ids) if batch_id is None]
+    [moved] = [order for order, batch_id in zip(orders, batch_ids) if batch_id is not None]
+    assert product.events == [
+        events.BatchChanged(shrinking.id, "RETRO-CLOCK", 0, None),
+        events.Deallocated(left.id, "RETRO-CLOCK", 10),
+        events.Reallocated("RETRO-CLOCK", [events.Allocated(moved.id, "RETRO-CLOCK", 10, spare.id)]),
+    ]
+
+
+def test_records_batch_changes() -> None:
+    # Given
+    product = Product(sku="RETRO-CLOCK", batches=[])
+    batch = Batch(sku="RETRO-CLOCK", qty=10)
+
+    # When
+    product.add_batch(batch)
+    product.change_batch_quantity(batch.id, 5)
+    product.change_batch_eta(batch.id, date(2021, 1, 1))
+
+    # Then
+    assert product.events == [
+        events.BatchChanged(batch.id, "RETRO-CLOCK", 10, None),
+        events.BatchChanged(batch.id, "RETRO-CLOCK", 5, None),
+        events.BatchChanged(batch.id, "RETRO-CLOCK", 5, date(2021, 1, 1)),
+    ]
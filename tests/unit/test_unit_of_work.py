@@ -0,0 +1,69 @@
+from collections.abc import Awaitable, Callable
+
+import pytest
+from pytest_mock import MockerFixture
+
+from app.allocation.service_layer import unit_of_work
+from app.config import config
+
+
+@pytest.fixture(autouse=True)
+def no_backoff(mocker: MockerFixture) -> None:
+    mocker.patch.object(config, "OCC_RETRY_BACKOFF_MS", 0)
+
+
+def _conflicting(conflicts: int) -> tuple[list[int], Callable[[], Awaitable[str]]]:
+    attempts: list[int] = []
+
+    async def attempt() -> str:
+        attempts.append(len(attempts))
+        if len(attempts) <= conflicts:
+            raise unit_of_work.ConcurrencyConflict("product changed concurrently")
+        return "done"
+
+    return attempts, attempt
+
+
+async def test_retries_until_attempt_succeeds() -> None:
+    # Given
+    attempts, attempt = _conflicting(conflicts=2)
+    conflicts = unit_of_work.CONCURRENCY_CONFLICTS.value(operation="test")
+
+    # When
+    result = await unit_of_work.retry_on_conflict(attempt, "test")
+
+    # Then
+    assert result == "done"
+    assert len(attempts) == 3
+    assert unit_of_work.CONCURRENCY_CONFLICTS.value(operation="test") == conflicts + 2
+
+
+async def test_gives_up_after_retry_limit(mocker: MockerFixture) -> None:
+    # Given
+    mocker.patch.object(config, "OCC_RETRY_LIMIT", 2)
+    attempts, attempt = _conflicting(conflicts=3)
+    exhausted = unit_of_work.CONCURRENCY_RETRIES_EXHAUSTED.value(operation="test")
+
+    # When
+    with pytest.raises(unit_of_work.ConcurrencyConflict):
+        await unit_of_work.retry_on_conflict(attempt, "test")
+
+    # Then
+    assert len(attempts) == 3
+    assert unit_of_work.CONCURRENCY_RETRIES_EXHAUSTED.value(operation="test") == exhausted + 1
+
+
+async def test_does_not_retry_other_errors() -> None:
+    # Given
+    attempts = []
+
+    async def attempt() -> None:
+        attempts.append(1)
+        raise ValueError("boom")
+
+    # When
+    with pytest.raises(ValueError):
+        await unit_of_work.retry_on_conflict(attempt, "test")
+
+    # Then
+    assert len(attempts) == 1